@@ -1,8 +1,8 @@
 from pprint import pprint
-import os, sys, json, base64, fnmatch, shutil, fcntl, errno, urllib.parse
+import os, sys, json, base64, shutil, fcntl, errno, urllib.parse, queue, threading, tempfile, time, hashlib
 
 from collections import defaultdict
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Any
 from typing_extensions import TypedDict
 
 from termcolor import colored
@@ -10,15 +10,17 @@ from termcolor import colored
 import pysodium #type: ignore
 
 #=================================================
-from bversion.common import (cpjoin, get_file_list, find_manifest_changes, make_dirs_if_dont_exist,
-                             manifestFileDetails, get_single_file_info, file_or_default, question_user,
-                             file_put_contents, file_get_contents, ignore, find_bvn_dir, hash_file)
+from bversion.common import (cpjoin, get_file_list, scan_file_list, find_manifest_changes, find_sorted_manifest_changes,
+                             make_dirs_if_dont_exist, manifestFileDetails, get_single_file_info, file_or_default,
+                             question_user, file_put_contents, file_get_contents, ignore, find_bvn_dir, hash_file,
+                             path_filter, fileDetails, dir_listing_cache)
 
 from bversion.http.client_http_request import client_http_request
 from bversion.storage.client_db   import client_db
 from bversion.storage.journaling_filesystem       import journaling_filesystem
 from bversion.storage.client_filesystem_interface import client_filesystem_interface
 from bversion import crypto
+from bversion import watcher
 from bversion import version_numbers
 
 #===============================================================================
@@ -29,18 +31,51 @@ class clientConfiguration(TypedDict, total=False):
     private_key:              str # base64 encoded private key
     ignore_filters:           List[str]
     pull_ignore_filters:      List[str]
+    ignore_matcher:           path_filter
+    pull_ignore_matcher:      path_filter
     data_dir:                 str
     conflict_resolution_file: str
+    parallel_connections:     int # number of connections used to download files
+    lock_wait_timeout:        int # seconds to wait for another clients commit to complete
+    lock_poll_interval:       float # seconds between asking the server for the lock while waiting
 
 #===============================================================================
 config:            clientConfiguration         = None
 cdb:               client_db                   = None
 data_store:        client_filesystem_interface = None
 server_connection: client_http_request         = None
+connection_pool:   List[client_http_request]   = [] # additional connections used for parallel transfers
 
 working_copy_base_path: str                    = ''
 relative_cwd: str                              = ''
 
+# Seconds to wait for 'bvn watch' to confirm it has recorded all changes
+watch_sync_timeout = 2
+
+# Number of files requested from the server in each pull_files request,
+# and sent to the server in each push_files request
+pull_batch_size = 1000
+push_batch_size = 1000
+push_batch_bytes = 64 * 1000 * 1000
+
+# When downloading over several connections, the number of files and bytes which may be
+# downloaded into temporary files ahead of being written to the working copy
+pull_read_ahead_files = 256
+pull_read_ahead_bytes = 256 * 1000 * 1000
+
+
+#===============================================================================
+def load_ignore_filters(base_path: str) -> Tuple[List[str], List[str]]:
+    """ Read the ignore and pull ignore filters of a working copy """
+
+    ignore_filters:      str = file_or_default(cpjoin(base_path, '.bvn_ignore'), b'').decode('utf8')
+    pull_ignore_filters: str = file_or_default(cpjoin(base_path, '.bvn_pull_ignore'), b'').decode('utf8')
+
+    # We append the pull ignore filters to the ignore filters in order to stop the client
+    # sending files to the server that cannot be pulled
+    return (['/.bvn/*', '/.bvn_pull_ignore'] + ignore_filters.splitlines() + pull_ignore_filters.splitlines(),
+            pull_ignore_filters.splitlines())
+
 
 #===============================================================================
 def init(unlocked = False):
@@ -71,16 +106,10 @@ def init(unlocked = False):
     except IOError: raise SystemExit('Could not lock working copy')
 
     #-----------
-    ignore_filters:      str = file_or_default(cpjoin(working_copy_base_path, '.bvn_ignore'), b'').decode('utf8')
-    pull_ignore_filters: str = file_or_default(cpjoin(working_copy_base_path, '.bvn_pull_ignore'), b'').decode('utf8')
+    config['ignore_filters'], config['pull_ignore_filters'] = load_ignore_filters(working_copy_base_path)
 
-    #-----------
-    config['ignore_filters']:      List[str] = ['/.bvn/*', '/.bvn_pull_ignore'] + ignore_filters.splitlines()
-    config['pull_ignore_filters']: List[str] = pull_ignore_filters.splitlines()
-
-    # We append the pull ignore filters to the ignore filters in order to stop the client
-    # sending files to the server that cannot be pulled
-    config['ignore_filters'] += config['pull_ignore_filters']
+    config['ignore_matcher']      = path_filter(config['ignore_filters'])
+    config['pull_ignore_matcher'] = path_filter(config['pull_ignore_filters'])
 
     config['data_dir']:            str       = working_copy_base_path
 
@@ -121,7 +150,7 @@ def update_manifest(session_token):
         # Apply pull ignore filters to the server data
         new_server_file_info_for_version = {}
         for path, file_info in server_file_info_for_version.items():
-            if not next((True for flter in config['pull_ignore_filters'] if fnmatch.fnmatch(path, flter)), False):
+            if not config['pull_ignore_matcher'].matches(path):
                 new_server_file_info_for_version[path] = file_info
         server_file_info_for_version = new_server_file_info_for_version
 
@@ -275,20 +304,105 @@ def authenticate(previous_token: str = None) -> str:
 
 #===============================================================================
 def find_local_changes(include_unchanged : bool = False) -> Tuple[dict, Dict[str, manifestFileDetails]]:
-    """ Find things that have changed since the last run, applying ignore filters """
+    """ Find things that have changed since the last run, applying ignore filters. If
+    'bvn watch' is running only the paths it has recorded as changed are checked. """
 
-    old_state = cdb.get_manifest()
-    current_state = get_file_list(config['data_dir'])
+    # The watcher cannot record changes while this connection has uncommitted writes
+    in_transaction = cdb.con.in_transaction
+    use_journal = watcher_is_running() and not in_transaction
+
+    if use_journal and not include_unchanged and cdb.get_watch_state()['journal_valid'] and sync_with_watcher():
+        return find_journaled_changes()
+
+    # Changes made during the scan will be journaled
+    if use_journal:
+        cdb.reset_journal(); cdb.commit()
+
+    # Both the scan and the manifest are ordered by path, so they are compared as streams
+    old_state = cdb.iter_manifest()
+
+    # Directories which are entirely ignored are not read at all, and directories which
+    # have not changed since the last scan are not read again
+    dir_cache = dir_listing_cache(cdb.get_dir_listings())
+    current_state = scan_file_list(config['data_dir'], config['ignore_matcher'].matches_dir, dir_cache = dir_cache)
 
     #Apply ignore filters
-    current_state = [fle for fle in current_state if not
-                     next((True for flter in config['ignore_filters']
-                           if fnmatch.fnmatch(fle['path'], flter)), False)]
+    current_state = (fle for fle in current_state if not config['ignore_matcher'].matches(fle['path']))
 
     # ---------
-    changed_files = find_manifest_changes(current_state, old_state, include_unchanged = include_unchanged)
+    changed_files = find_sorted_manifest_changes(current_state, old_state, include_unchanged = include_unchanged)
     #pprint(changed_files)
 
+    cdb.update_dir_listings(dir_cache.updated, dir_cache.removed())
+
+    # Files which are already changed need checking again until they have been committed
+    if use_journal:
+        cdb.add_dirty_paths([path for path, fle in changed_files.items() if fle['status'] != 'unchanged'])
+
+    if not in_transaction: cdb.commit()
+
+    return changed_files
+
+
+#===============================================================================
+def watcher_is_running() -> bool:
+    pid = cdb.get_watch_state()['watcher_pid']
+    if pid is None: return False
+
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError:    pass
+    return True
+
+
+#===============================================================================
+def sync_with_watcher() -> bool:
+    """ Wait for the watcher to record every change made before now, returns false
+    if it did not respond in time """
+
+    token = base64.b64encode(os.urandom(12)).decode('utf8')
+    file_put_contents(cpjoin(config['data_dir'], '.bvn', watcher.sync_file_name), token.encode('utf8'))
+
+    wait_until = time.time() + watch_sync_timeout
+    while time.time() < wait_until:
+        state = cdb.get_watch_state()
+        if state['sync_token'] == token: return bool(state['journal_valid'])
+        time.sleep(0.01)
+
+    return False
+
+
+#===============================================================================
+def find_journaled_changes() -> Dict[str, manifestFileDetails]:
+    """ Find changes to the paths in the dirty path journal. Paths which are found
+    to match the manifest are removed from the journal. """
+
+    matcher = config['ignore_matcher']
+    changed_files: Dict[str, manifestFileDetails] = {}
+
+    for dirty_path in cdb.get_dirty_paths():
+        path = dirty_path['path']
+        full_path = cpjoin(config['data_dir'], path)
+
+        # The path may be a file or a directory, either on disk or in the manifest
+        current_state: List[fileDetails] = []
+        if os.path.isdir(full_path):
+            if not matcher.matches_dir(path):
+                current_state = list(scan_file_list(full_path, matcher.matches_dir, int_path = path))
+        elif os.path.isfile(full_path):
+            current_state = [get_single_file_info(full_path, path)]
+
+        current_state = [fle for fle in current_state if not matcher.matches(fle['path'])]
+
+        old_state = {fle['path'] : fle for fle in cdb.get_manifest_files_below(path)}
+        manifest_item = cdb.get_single_file_from_manifest(path)
+        if manifest_item is not None: old_state[path] = manifest_item
+
+        changes = find_manifest_changes(current_state, old_state)
+        if changes == {}: cdb.remove_dirty_path(dirty_path)
+        changed_files.update(changes)
+
+    cdb.commit()
     return changed_files
 
 
@@ -525,7 +639,8 @@ def resolve_update_conflicts(session_token: str, changes: list, version_id: str,
 
                     else:
                         make_dirs_if_dont_exist(cpjoin(config['conflict_comparison_file_root'], *fle['path'].split('/')[:-1]) + '/')
-                        result(cpjoin(config['conflict_comparison_file_root'], fle['path']))
+                        try: verified_writer(result, fle['hash'])(cpjoin(config['conflict_comparison_file_root'], fle['path']))
+                        except download_hash_mismatch: errors.append(fle['path'])
 
                 print('Server versions of conflicting files written to .bvn/conflict_files\n')
 
@@ -542,6 +657,230 @@ def resolve_update_conflicts(session_token: str, changes: list, version_id: str,
 
 
 
+#===============================================================================
+class download_hash_mismatch(Exception):
+    pass
+
+
+#===============================================================================
+def verified_writer(write_to_file, expected_hash: str):
+    """ Wrap a download writer so that the file is hashed as it is written, raising
+    download_hash_mismatch if it is not the file the server said it was sending """
+
+    def writer(path):
+        hasher = hashlib.sha256()
+        write_to_file(path, hasher)
+
+        if hasher.hexdigest() != expected_hash:
+            os.remove(path)
+            raise download_hash_mismatch('Downloaded file does not match its hash')
+
+    return writer
+
+
+#===============================================================================
+def hash_working_copy_file(int_path: str) -> str:
+    """ Hash a file in the working copy. If its modification time, size and inode are
+    those recorded in the manifest when it was pulled or committed, the hash recorded
+    with them is used instead of reading the file again. """
+
+    full_path = cpjoin(config['data_dir'], int_path)
+    file_info = get_single_file_info(full_path, int_path)
+
+    manifest_item = cdb.get_single_file_from_manifest(int_path)
+    if manifest_item is not None and all(manifest_item[k] == file_info[k] for k in ['last_mod', 'size', 'inode']):
+        return manifest_item['server_file_hash']
+
+    return hash_file(full_path)
+
+
+#===============================================================================
+def get_connection_pool(size: int) -> List[client_http_request]:
+    """ Returns size connections to the server, the first being server_connection """
+
+    while len(connection_pool) < size - 1:
+        connection_pool.append(server_connection.clone())
+
+    return [server_connection] + connection_pool[:size - 1]
+
+
+#===============================================================================
+def drop_connection(connection: client_http_request) -> None:
+    """ Close a connection which was left part way through a responce, it is replaced by a
+    new connection the next time one is needed """
+
+    global server_connection
+
+    connection.close()
+    if connection is server_connection: server_connection = connection.clone()
+    elif connection in connection_pool: connection_pool.remove(connection)
+
+
+#===============================================================================
+def request_pull_batch(connection: client_http_request, session_token: str, version_id: str, paths: List[str]):
+    if paths == []: return iter([])
+
+    frames, headers = connection.request_frames("pull_files", {
+        'session_token' : session_token,
+        'repository'    : config['repository'],
+        'use_head'      : str(int(False)),
+        'version_id'    : version_id
+        }, {'files' : paths})
+
+    if headers['status'] != 'ok':
+        raise SystemExit('Server error:' + headers['msg'])
+
+    return frames
+
+
+#===============================================================================
+def pull_files(session_token: str, version_id: str, paths: List[str]):
+    """ Download files from the server, yielding (frame info, writer) for each path in
+    order. The writer is passed to fs_put. When more than one connection is configured,
+    files are split between them and downloaded concurrently into temporary files, up
+    to pull_read_ahead_files or pull_read_ahead_bytes ahead of the file being written to
+    the working copy, so that files are still written serially. Files are checked against
+    the hash the server sent with them as they are received, a file which does not match
+    either raises download_hash_mismatch from its writer or has a failed status. If the
+    caller stops early, requests in progress are abandoned and their connections closed. """
+
+    connections = get_connection_pool(config.get('parallel_connections', 4))
+
+    # ===================
+    if len(connections) == 1:
+        for batch_start in range(0, len(paths), pull_batch_size):
+            batch = paths[batch_start : batch_start + pull_batch_size]
+            frames = request_pull_batch(server_connection, session_token, version_id, batch)
+
+            received = 0; frame = None
+            try:
+                for frame_info, frame in frames:
+                    received += 1
+                    yield frame_info, (verified_writer(frame.write_to_file, frame_info['file_info']['hash'])
+                                       if frame_info['status'] == 'ok' else None)
+
+            finally:
+                if received != len(batch) or frame is not None and frame.remaining != 0:
+                    drop_connection(server_connection)
+        return
+
+    # ===================
+    # Requests are kept small enough that every connection is used even for a few files,
+    # and that the read ahead limit does not stop them running concurrently
+    chunk_size = max(1, min(pull_batch_size,
+                            -(-len(paths) // len(connections)),
+                            pull_read_ahead_files // len(connections)))
+
+    pending: 'queue.Queue[Tuple[int, List[str]]]' = queue.Queue()
+    for chunk_start in range(0, len(paths), chunk_size):
+        pending.put((chunk_start, paths[chunk_start : chunk_start + chunk_size]))
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'download_tmp_', dir = cpjoin(config['data_dir'], '.bvn'))
+
+    state           = threading.Condition()
+    results: Dict[int, Any] = {} # index of path : (frame info, temporary file, size) or an exception
+    active          = set()      # connections which are part way through a request
+    consumed        = 0          # index of the next file to yield
+    in_flight_bytes = 0
+    running         = len(connections)
+    stop            = False
+
+    def may_download(index, size):
+        # The next file to be yielded can always be downloaded, so workers cannot all wait on each other
+        return index == consumed or (index < consumed + pull_read_ahead_files and
+                                     in_flight_bytes + size <= pull_read_ahead_bytes)
+
+    def download_chunk(connection, chunk_start, chunk):
+        nonlocal in_flight_bytes
+
+        index = chunk_start
+        frames = request_pull_batch(connection, session_token, version_id, chunk)
+        for frame_info, frame in frames:
+            tmp_path = None; size = 0
+
+            if frame_info['status'] == 'ok':
+                size = frame.remaining
+                with state:
+                    while not stop and not may_download(index, size): state.wait()
+                    if stop: return False
+                    in_flight_bytes += size
+
+                tmp_path = cpjoin(tmp_dir, str(index))
+                try: verified_writer(frame.write_to_file, frame_info['file_info']['hash'])(tmp_path)
+                except download_hash_mismatch as e:
+                    frame_info = dict(frame_info, status = 'fail', msg = str(e)); tmp_path = None
+
+            with state:
+                results[index] = (frame_info, tmp_path, size)
+                state.notify_all()
+            index += 1
+
+        if index != chunk_start + len(chunk): raise Exception('Server did not send every file requested')
+        return True
+
+    def worker(connection):
+        nonlocal running
+
+        try:
+            while not stop:
+                try: chunk_start, chunk = pending.get_nowait()
+                except queue.Empty: return
+
+                with state: active.add(connection)
+                try:
+                    completed = download_chunk(connection, chunk_start, chunk)
+
+                except BaseException as e: # pylint: disable=broad-except
+                    with state:
+                        first_missing = next(i for i in range(chunk_start, chunk_start + len(chunk) + 1) if i not in results)
+                        if first_missing < chunk_start + len(chunk): results[first_missing] = e
+                    completed = False
+
+                with state: active.discard(connection)
+                if not completed:
+                    drop_connection(connection); return
+
+        finally:
+            with state:
+                running -= 1
+                state.notify_all()
+
+    def mover(tmp_path):
+        return lambda path: shutil.move(tmp_path, path)
+
+    threads = [threading.Thread(target = worker, args = (connection,), daemon = True) for connection in connections]
+    for t in threads: t.start()
+
+    try:
+        for index in range(len(paths)):
+            with state:
+                while index not in results and running > 0: state.wait()
+                if index not in results: raise Exception('Download stopped before all files were received')
+                result = results.pop(index)
+
+            if isinstance(result, BaseException): raise result
+
+            frame_info, tmp_path, size = result
+            yield frame_info, (mover(tmp_path) if tmp_path is not None else None)
+
+            if tmp_path is not None: ignore(os.remove, tmp_path)
+            with state:
+                consumed += 1
+                in_flight_bytes -= size
+                state.notify_all()
+
+    finally:
+        # Abort requests in progress rather than waiting for them to complete, their
+        # workers then close the connections
+        with state:
+            stop = True
+            for connection in active: connection.abort()
+            state.notify_all()
+
+        for t in threads: t.join()
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+
 #===============================================================================
 def update(session_token: str, test_overrides = None, include_unchanged = False):
     """ Compare changes on the client to changes on the server and update local files
@@ -597,50 +936,53 @@ def update(session_token: str, test_overrides = None, include_unchanged = False)
         # Filter out pull ignore files
         filtered_pull_files = []
         for fle in changes['client_pull_files']:
-            if not next((True for flter in config['pull_ignore_filters'] if fnmatch.fnmatch(fle['path'], flter)), False):
+            if not config['pull_ignore_matcher'].matches(fle['path']):
                 filtered_pull_files.append(fle)
 
         if filtered_pull_files != []:
             print('Pulling files from server...')
 
         #----------
-        pulled_items = 0
+        # Chech we don't already have the files due to a previous run that failed mid-process,
+        # thus a failed update resumes from the last file that was completely written
+        need_files: List[str] = []
         for fle in filtered_pull_files:
-            # ==============
             file_in_manifest = cdb.get_single_file_from_manifest(fle['path'])
-            file_hash = fle['hash']
-
-            # Chech we don't already have the file due to a previous run that failed mid-process
-            have_file = False
-            if file_in_manifest is not None and file_in_manifest['server_file_hash'] == file_hash:
-                have_file = True
-
-            # ===================
-            if not have_file:
-                req_result, headers = server_connection.request("pull_file", {
-                    'session_token' : session_token,
-                    'repository'    : config['repository'],
-                    'path'          : fle['path'],
-                    'use_head'      : str(int(False)),
-                    'version_id'    : result['head']
-                    }, gen = True)
-
-                if headers['status'] != 'ok':
-                    affected_files['errors'].append('Failed to pull file ' + fle['path'])
+            if file_in_manifest is None or file_in_manifest['server_file_hash'] != fle['hash']:
+                need_files.append(fle['path'])
 
-                else:
-                    make_dirs_if_dont_exist(data_store.jfs.get_full_file_path(cpjoin(*fle['path'].split('/')[:-1]) + '/'))
+        need_paths = set(need_files)
 
-                    print(colored('Pulling file: ' + fle['path'], 'green'))
-                    data_store.fs_put(fle['path'], req_result, additional_manifest_data = {'server_file_hash' : file_hash})
-                    affected_files['pulled_files'].append(fle['path'])
+        pulled_items = 0
+        pulled = pull_files(session_token, result['head'], need_files)
+        try:
+            for fle in filtered_pull_files:
+                if fle['path'] in need_paths:
+                    frame_info, writer = next(pulled)
 
-            # test override to allow testing of checkout being killed part completed
-            if test_overrides['kill_mid_update'] > 0:
-                if pulled_items == test_overrides['kill_mid_update']:
-                    raise Exception('killed part way through update for testing')
+                    if frame_info['status'] != 'ok':
+                        affected_files['errors'].append('Failed to pull file ' + fle['path'])
+
+                    else:
+                        make_dirs_if_dont_exist(data_store.jfs.get_full_file_path(cpjoin(*fle['path'].split('/')[:-1]) + '/'))
+
+                        print(colored('Pulling file: ' + fle['path'], 'green'))
+                        try:
+                            data_store.fs_put(fle['path'], writer, additional_manifest_data = {'server_file_hash' : fle['hash']})
+                            affected_files['pulled_files'].append(fle['path'])
+                        except download_hash_mismatch:
+                            affected_files['errors'].append('Failed to pull file ' + fle['path'])
+
+                # test override to allow testing of checkout being killed part completed
+                if test_overrides['kill_mid_update'] > 0:
+                    if pulled_items == test_overrides['kill_mid_update']:
+                        raise Exception('killed part way through update for testing')
+
+                pulled_items += 1
 
-            pulled_items += 1
+        finally:
+            # Stops any download workers and removes their temporary files
+            pulled.close()
 
     # Files which have been deleted on server and need deleting on client
     if changes['to_delete_on_client'] != []:
@@ -693,6 +1035,126 @@ def update(session_token: str, test_overrides = None, include_unchanged = False)
     return affected_files
 
 
+#===============================================================================
+def make_push_batches(to_push):
+    """ Split files to push into batches, limiting both the number of files and
+    their total size, so that large changesets can be sent in parallel """
+
+    batches: List[list] = []
+    batch_bytes = 0
+    for item in to_push:
+        size = os.stat(item[1]).st_size
+        if batches == [] or len(batches[-1]) >= push_batch_size or batch_bytes + size > push_batch_bytes:
+            batches.append([])
+            batch_bytes = 0
+
+        batches[-1].append(item)
+        batch_bytes += size
+
+    return batches
+
+
+#===============================================================================
+def send_file_batches(session_token: str, route: str, batches, on_frame_sent, join_commit_session = False):
+    """ Send batches of files to push_files or stage_files. If there is more than one
+    batch and more than one connection configured, batches are sent concurrently.
+    When pushing to the active commit, additional connections must join the commit
+    session. Returns the file info of the sent files, and a list of errors. """
+
+    headers = {'session_token' : session_token, 'repository' : config['repository']}
+
+    connections = [server_connection]
+    if len(batches) > 1:
+        for connection in get_connection_pool(config.get('parallel_connections', 4))[1:]:
+            if not join_commit_session or connection.request("join_commit", headers)[1]['status'] == 'ok':
+                connections.append(connection)
+
+    pending: 'queue.Queue[list]' = queue.Queue()
+    for batch in batches: pending.put(batch)
+
+    pushed: List[dict] = []
+    errors: List[dict] = []
+    exceptions: List[BaseException] = []
+    mutex = threading.Lock()
+
+    def worker(connection):
+        while True:
+            with mutex:
+                if errors != [] or exceptions != []: return
+
+            try: batch = pending.get_nowait()
+            except queue.Empty: return
+
+            try:
+                body, result_headers = connection.send_frames(route, headers, batch, on_frame_sent)
+            except BaseException as e: # pylint: disable=broad-except
+                with mutex: exceptions.append(e)
+                return
+
+            with mutex:
+                if result_headers['status'] == 'ok':
+                    pushed.extend(json.loads(body)['files'])
+                else:
+                    print(result_headers)
+                    errors.append({
+                        'error' : result_headers,
+                        'files' : [info['path'] for info, _ in batch]})
+
+    if len(connections) == 1:
+        worker(server_connection)
+    else:
+        threads = [threading.Thread(target = worker, args = (connection,), daemon = True) for connection in connections]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+    if exceptions != []: raise exceptions[0]
+    return pushed, errors
+
+
+#===============================================================================
+def stage_files(session_token: str, push_files, on_frame_sent) -> Dict[str, str]:
+    """ Upload changed files to the servers staging area, which does not need the
+    commit lock. Staged files are recorded locally so that an interrupted commit
+    does not upload them again, unless they have been modified since. Returns a
+    dict of path to hash of every file to be committed. """
+
+    staged = cdb.get_staged_files()
+    result: Dict[str, str] = {}
+
+    to_stage = []
+    for fle in push_files:
+        if fle['path'] in staged and staged[fle['path']]['last_mod'] == fle['last_mod']:
+            result[fle['path']] = staged[fle['path']]['hash']
+            continue
+
+        print(colored('Sending: ' + fle['path'], 'green'))
+        to_stage.append(({'path' : fle['path'], 'last_mod' : fle['last_mod']}, cpjoin(config['data_dir'], fle['path'])))
+
+    # The client db can only be used from this thread, so files sent by the upload workers
+    # are collected and recorded here, including if the upload fails part way through
+    sent = []
+    sent_lock = threading.Lock()
+
+    def record_sent(frame_info, file_hash):
+        with sent_lock: sent.append((frame_info, file_hash))
+        on_frame_sent(frame_info, file_hash)
+
+    try:
+        staged_files, errors = send_file_batches(session_token, "stage_files", make_push_batches(to_stage), record_sent)
+
+    finally:
+        for frame_info, file_hash in sent:
+            cdb.add_staged_file(frame_info['path'], frame_info['last_mod'], file_hash)
+        cdb.commit()
+
+    if errors != []:
+        pprint(errors)
+        raise SystemExit('Failed to upload files')
+
+    for file_info in staged_files: result[file_info['path']] = file_info['hash']
+    return result
+
+
 #===============================================================================
 def commit(session_token: str, commit_message = '', test_overrides = None):
 
@@ -713,15 +1175,52 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
     if all(v == [] for k,v in changes.items()):
         print('Nothing to commit'); return None
 
+    #======================
+    pushed_items = 0
+    pushed_items_lock = threading.Lock()
+
+    def on_frame_sent(frame_info, file_hash): # pylint: disable=unused-argument
+        nonlocal pushed_items
+
+        with pushed_items_lock:
+            # test override to allow testing of checkout being killed part completed
+            if testing:
+                test_overrides['result'].append(frame_info['path'])
+
+            if 'kill_mid_commit' in test_overrides and test_overrides['kill_mid_commit'] > 0:
+                if pushed_items == test_overrides['kill_mid_commit']:
+                    raise Exception('killed part way through commit for testing')
 
-    # Acquire the commit lock and check we still have the latest revision
+            pushed_items += 1
+
+    # Upload file contents before taking the commit lock, so that large uploads do not block
+    # other clients from committing
+    staged = stage_files(session_token, changes['client_push_files'], on_frame_sent)
+
+
+    # Acquire the commit lock and check we still have the latest revision. If another client
+    # is committing, wait in the servers queue for the lock
     manifest_meta = cdb.get_system_meta()
-    body, headers = server_connection.request("begin_commit", {
+    request_headers = {
         "session_token"     : session_token,
         'user'              : config['user'],
         'repository'        : config['repository'],
-        "previous_revision" : manifest_meta['have_revision']})
+        "previous_revision" : manifest_meta['have_revision'],
+        'wait_for_lock'     : '1'}
+
+    wait_until = time.time() + config.get('lock_wait_timeout', 3600)
+    last_position = None
+    while True:
+        body, headers = server_connection.request("begin_commit", request_headers)
 
+        if headers['status'] == 'ok' or 'lock_ticket' not in headers or time.time() > wait_until: break
+
+        if headers['queue_position'] != last_position:
+            print('Waiting for another commit to complete, position in queue: ' + headers['queue_position'])
+            last_position = headers['queue_position']
+
+        request_headers['lock_ticket'] = headers['lock_ticket']
+        time.sleep(config.get('lock_poll_interval', 1))
 
     if headers['status'] != 'ok': raise SystemExit(headers['msg'])
 
@@ -740,7 +1239,7 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
             if not os.path.isfile(local_path):
                 changes['to_delete_on_server'].append(fle)
 
-            elif fle['hash'] == hash_file(local_path):
+            elif fle['hash'] == hash_working_copy_file(fle['path']):
                 filtered_previous[fle['path']] = fle
 
     previous_uploads = filtered_previous
@@ -767,10 +1266,9 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
             errors.append('Delete failed')
 
 
-    # Push files
+    # Add the staged files to the commit
     if changes['client_push_files'] != [] and errors == []:
-        pushed_items = 0
-
+        to_add = []
         for fle in changes['client_push_files']:
             if fle['path'] in previous_uploads:
 
@@ -782,47 +1280,53 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
 
                 continue
 
-            print(colored('Sending: ' + fle['path'], 'green'))
-
-            headers = server_connection.send_file("push_file", {
-                'session_token' : session_token,
-                'repository'    : config['repository'],
-                'path'          : fle['path'],
-            }, cpjoin(config['data_dir'], fle['path']))[1] # Only care about headers
-
-            if headers['status'] == 'ok':
-                changes_made.append({
-                    'status'    : 'new/changed',
-                    'path'      : fle['path'],
-                    'file_info' : json.loads(headers['file_info_json'])
-                })
-            else:
-                print(headers)
-                errors.append({
-                    'error' : headers,
-                    'file' : fle['path']})
-                break
+            to_add.append({'path' : fle['path'], 'hash' : staged[fle['path']]})
 
+        body, headers = server_connection.request("add_staged", {
+            'session_token' : session_token,
+            'repository'    : config['repository']
+            }, {'files' : to_add})
 
-            # test override to allow testing of checkout being killed part completed
-            if testing:
-                test_overrides['result'].append(fle['path'])
+        pushed = []
+        if headers['status'] == 'ok':
+            add_result = json.loads(body)
+            pushed = add_result['files']
+
+            # Staged files which were garbage collected on the server before this commit
+            # began need to be pushed again
+            to_push = [({'path' : path}, cpjoin(config['data_dir'], path)) for path in add_result['missing']]
+            if to_push != []:
+                repushed, push_errors = send_file_batches(session_token, "push_files", make_push_batches(to_push),
+                                                          on_frame_sent, join_commit_session = True)
+                pushed += repushed
+                errors += push_errors
 
-            if 'kill_mid_commit' in test_overrides and test_overrides['kill_mid_commit'] > 0:
-                if pushed_items == test_overrides['kill_mid_commit']:
-                    raise Exception('killed part way through commit for testing')
+        else:
+            errors.append({'error' : headers, 'files' : [it['path'] for it in to_add]})
 
-            pushed_items += 1
+        for file_info in pushed:
+            changes_made.append({
+                'status'    : 'new/changed',
+                'path'      : file_info['path'],
+                'file_info' : file_info
+            })
 
 
     # commit and release the lock. If errors occurred roll back and release the lock
     mode = 'commit' if errors == [] else 'abort'
 
+    # The server hash each change was based on, so that the server can tell a path changed
+    # since our base revision by one of our own rebased commits from a change by someone else
+    base_hashes = {}
+    for change in changes_made:
+        manifest_file = cdb.get_single_file_from_manifest(change['path'])
+        base_hashes[change['path']] = None if manifest_file is None else manifest_file['server_file_hash']
+
     headers = server_connection.request("commit", {
         "session_token"  : session_token,
         'repository'     : config['repository'],
         'commit_message' : commit_message,
-        'mode'           : mode})[1] # Only care about headers
+        'mode'           : mode}, {'base_hashes' : base_hashes})[1] # Only care about headers
 
     if mode == 'abort':
         print('Something went wrong, errors:')
@@ -832,10 +1336,16 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
     elif headers['status'] == 'ok':
         print('\nCommit ok')
 
-        # Update the manifest
-        manifest_meta = cdb.get_system_meta()
-        manifest_meta['have_revision'] = headers['head']
-        cdb.update_system_meta(manifest_meta)
+        # Update the manifest. If the server rebased the commit over changes made by other
+        # clients, the working copy does not have those yet, so it remains at the revision
+        # it was based on until the next update.
+        if headers.get('rebased', '0') == '1':
+            print('Other changes were committed on the server, run update to get them')
+        else:
+            manifest_meta = cdb.get_system_meta()
+            manifest_meta['have_revision'] = headers['head']
+            cdb.update_system_meta(manifest_meta)
+        cdb.clear_staged_files()
 
         for change in changes_made:
             if change['status'] == 'deleted':
@@ -850,6 +1360,9 @@ def commit(session_token: str, commit_message = '', test_overrides = None):
 
         return headers['head']
 
+    else:
+        raise SystemExit(headers['msg'])
+
 
 #===============================================================================
 def revert(session_token, args):
@@ -900,7 +1413,7 @@ def revert(session_token, args):
     # Apply pull ignore filters
     filtered_files_in_revision = {}
     for path, fle in files_in_revision.items():
-        if next((True for flter in config['pull_ignore_filters'] if fnmatch.fnmatch(fle['path'], flter)), False):
+        if config['pull_ignore_matcher'].matches(fle['path']):
             filtered_files_in_revision[path] = fle
     files_in_revision = filtered_files_in_revision
 
@@ -932,12 +1445,11 @@ def revert(session_token, args):
         if filters == []:
             raise SystemExit('No files provided')
 
-        filters = normalise_filters(filters)
+        matcher = path_filter(normalise_filters(filters))
 
         # Work out which files are impacted by the filters
         for fle in files_in_revision.values():
-            matches_file = next((True for flter in filters if fnmatch.fnmatch(fle['path'], flter)), False)
-            if matches_file:
+            if matcher.matches(fle['path']):
                 files_to_revert.append(fle['path'])
 
     if files_to_revert == []:
@@ -985,14 +1497,18 @@ def revert(session_token, args):
         if headers['status'] == 'ok':
             # If we are using the local revision, we need to add the file to the manifest,
             # otherwise just download it so it will appear as a changed file, and can be committed.
-            if version_id == meta['have_revision']:
-                file_hash = json.loads(headers['file_info_json'])['hash']
-                data_store.fs_put(file_path, req_result, additional_manifest_data = {'server_file_hash' : file_hash})
+            file_hash = json.loads(headers['file_info_json'])['hash']
+            try:
+                if version_id == meta['have_revision']:
+                    data_store.fs_put(file_path, verified_writer(req_result, file_hash), additional_manifest_data = {'server_file_hash' : file_hash})
 
-            else:
-                tmp_path = cpjoin(working_copy_base_path, '.bvn', 'download_tmp')
-                req_result(tmp_path)
-                os.rename(tmp_path, cpjoin(working_copy_base_path, file_path))
+                else:
+                    tmp_path = cpjoin(working_copy_base_path, '.bvn', 'download_tmp')
+                    verified_writer(req_result, file_hash)(tmp_path)
+                    os.rename(tmp_path, cpjoin(working_copy_base_path, file_path))
+
+            except download_hash_mismatch:
+                print('error with downloading ' + file_path)
         else:
             print('error with downloading ' + file_path)
 
@@ -1012,6 +1528,22 @@ def display_status():
     print()
 
 
+#===============================================================================
+def watch_working_copy():
+    """ Record changes to the working copy until interrupted, see watcher.py """
+
+    base_path, _ = find_bvn_dir()
+    if not os.path.isdir(cpjoin(base_path, '.bvn')): raise SystemExit('No BVersion working copy found')
+
+    try:
+        lockfile = open(cpjoin(base_path, '.bvn', 'watch_lock_file'), 'w')
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError: raise SystemExit('This working copy is already being watched')
+
+    watch_db = client_db(cpjoin(base_path, '.bvn', 'manifest.db'))
+    watcher.watch(base_path, watch_db, lambda: path_filter(load_ignore_filters(base_path)[0]))
+
+
 #===============================================================================
 def pull_ignore(filters, require_commit_changes):
 
@@ -1023,12 +1555,12 @@ def pull_ignore(filters, require_commit_changes):
         raise SystemExit("Please commit your local changes first.")
 
     filters = normalise_filters(filters)
+    matcher = path_filter(filters)
 
     # Work out which files are impacted by the filters
     affected_local_files = []
     for path, fle in cdb.get_manifest().items():
-        affects_existing = next((True for flter in filters if fnmatch.fnmatch(fle['path'], flter)), False)
-        if affects_existing:
+        if matcher.matches(fle['path']):
             affected_local_files.append(fle['path'])
 
     if affected_local_files != []:
@@ -1117,9 +1649,7 @@ def list_ignored_files():
     current_state = get_file_list(config['data_dir'])
 
     #Apply ignore filters
-    current_state = [fle for fle in current_state if
-                     next((True for flter in config['ignore_filters']
-                           if fnmatch.fnmatch(fle['path'], flter)), False)]
+    current_state = [fle for fle in current_state if config['ignore_matcher'].matches(fle['path'])]
 
     for fle in current_state:
         print(fle['path'])
@@ -1173,7 +1703,7 @@ def list_remote_files(session_token, args):
     if only_show_ignored:
         filtered_files_in_revision = {}
         for path, fle in files_in_revision.items():
-            if next((True for flter in config['pull_ignore_filters'] if fnmatch.fnmatch(fle['path'], flter)), False):
+            if config['pull_ignore_matcher'].matches(fle['path']):
                 filtered_files_in_revision[path] = fle
         files_in_revision = filtered_files_in_revision
 
@@ -1286,6 +1816,10 @@ def run():
 
     list-ignored-files           : Lists files in the working copy that are being ignored due to .bvn_ignore
 
+    watch                        : Watch the working copy for changes using inotify (Linux only), so that
+                                   status, update and commit only need to check changed files. Runs
+                                   until interrupted.
+
     list-versions                : Lists all revisions on the server.
 
     list-files                   : Lists all files in the specified revision. When no arguments are provided,
@@ -1393,6 +1927,11 @@ def run():
         list_ignored_files()
 
 
+    #----------------------------
+    elif args [0] == 'watch':
+        watch_working_copy()
+
+
     #----------------------------
     elif args [0] == 'list-versions':
         init()
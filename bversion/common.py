@@ -1,7 +1,8 @@
-import os.path, hashlib, errno, copy
+import os, os.path, hashlib, errno, re, fnmatch, time, threading
 import collections
-from typing import List, Dict, Any, cast, Tuple
-from typing_extensions import TypedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, cast, Tuple, Optional, Callable, Iterable, Iterator
+from typing_extensions import TypedDict, NotRequired
 from termcolor import colored
 
 #===============================================================================
@@ -137,15 +138,20 @@ class fileDetails (TypedDict):
     created:          float
     last_mod:         float
     server_file_hash: str
+    size:             NotRequired[int]
+    inode:            NotRequired[int]
 
 ############################################################################################
 def get_single_file_info(f_path: str, int_path: str) -> fileDetails:
-    """ Gets the creates and last change times for a single file,
+    """ Gets the creates and last change times, size and inode of a single file,
     f_path is the path to the file on disk, int_path is an internal
     path relative to a root directory.  """
+    stat = os.stat(f_path)
     return { 'path'     : force_unicode(int_path),
-             'created'  : os.path.getctime(f_path),
-             'last_mod' : os.path.getmtime(f_path)}
+             'created'  : stat.st_ctime,
+             'last_mod' : stat.st_mtime,
+             'size'     : stat.st_size,
+             'inode'    : stat.st_ino}
 
 ############################################################################################
 def hash_file(file_path: str, block_size: int = 65536) -> str:
@@ -158,28 +164,189 @@ def hash_file(file_path: str, block_size: int = 65536) -> str:
             sha.update(file_buffer)
     return sha.hexdigest()
 
+############################################################################################
+class path_filter:
+    """ Matches paths against a list of fnmatch style filters. Filters without wildcards
+    are looked up in a set, the rest are compiled into a single regular expression. """
+
+    def __init__(self, filters: List[str]):
+        self.filters = list(filters)
+
+        is_glob = lambda flter: any(c in flter for c in '*?[')
+        self.literals = {os.path.normcase(flter) for flter in self.filters if not is_glob(flter)}
+        self.pattern  = self.compile([flter for flter in self.filters if is_glob(flter)])
+
+        # A directory can be skipped if a filter ending in a wildcard matches the directory
+        # path followed by a slash, as the wildcard also matches anything below it
+        self.dir_pattern = self.compile([flter for flter in self.filters if flter.endswith('*')])
+
+    #=============================================
+    @staticmethod
+    def compile(filters: List[str]):
+        if filters == []: return None
+        return re.compile('|'.join(fnmatch.translate(os.path.normcase(flter)) for flter in filters))
+
+    #=============================================
+    def matches(self, path: str) -> bool:
+        """ Check if a file path matches any filter """
+
+        path = os.path.normcase(path)
+        if path in self.literals: return True
+        return self.pattern is not None and self.pattern.match(path) is not None
+
+    #=============================================
+    def matches_dir(self, dir_path: str) -> bool:
+        """ Check if every path within a directory matches a filter, so it can be skipped """
+
+        return self.dir_pattern is not None and self.dir_pattern.match(os.path.normcase(dir_path) + '/') is not None
+
+############################################################################################
+class dir_listing_cache:
+    """ Directory listings from a previous scan, keyed by the directories modification
+    time, which changes whenever an entry is added, removed or renamed. The modification
+    times of files are not affected, so files still need to be stat'ed. Directories
+    modified within racy_seconds of the scan are not cached, as a later change may not
+    alter the modification time. Used from the scanners worker threads. """
+
+    racy_seconds = 2
+
+    def __init__(self, listings: Dict[str, Dict[str, Any]]):
+        self.listings = listings # internal path : {'mtime_ns', 'files', 'dirs'}
+        self.updated: Dict[str, Dict[str, Any]] = {}
+        self.seen: Dict[str, None] = {}
+        self.racy_after = time.time_ns() - self.racy_seconds * 1000000000
+
+    #=============================================
+    def get(self, int_path: str, mtime_ns: int) -> Optional[Dict[str, Any]]:
+        self.seen[int_path] = None
+        listing = self.listings.get(int_path)
+        return listing if listing is not None and listing['mtime_ns'] == mtime_ns else None
+
+    #=============================================
+    def put(self, int_path: str, mtime_ns: int, files: List[str], dirs: List[str]) -> None:
+        if mtime_ns >= self.racy_after: return
+        self.updated[int_path] = {'mtime_ns' : mtime_ns, 'files' : files, 'dirs' : dirs}
+
+    #=============================================
+    def removed(self) -> List[str]:
+        """ Cached directories which were not found by the scan, only valid after a complete scan """
+        return [int_path for int_path in self.listings if int_path not in self.seen]
+
+############################################################################################
+# Number of threads used to read directories when scanning a working copy
+scan_workers = 8
+
+# Number of directories which may be read ahead of the point the caller has reached
+scan_read_ahead = 256
+
+def scan_file_list(path: str, skip_dir: Optional[Callable[[str], bool]] = None,
+                   max_workers: int = scan_workers, int_path: str = os.path.sep,
+                   dir_cache: Optional[dir_listing_cache] = None,
+                   max_read_ahead: int = scan_read_ahead) -> Iterator[fileDetails]:
+    """ Recursively lists all files below 'path', yielding them ordered by path
+    as they are found. Up to max_read_ahead directories are read in parallel, ahead
+    of the point the caller has reached. skip_dir is called with the internal path of each directory,
+    if it returns true the directory is not read. int_path is the internal path of
+    'path' itself, when scanning part of a working copy. If a dir_cache is passed,
+    directories which have not changed since it was made are not read again. """
+
+    def read_dir(f_path, int_path):
+        """ Returns the sorted names of the files and directories in a directory """
+
+        mtime_ns = None
+        if dir_cache is not None:
+            mtime_ns = os.stat(f_path).st_mtime_ns
+            listing = dir_cache.get(int_path, mtime_ns)
+            if listing is not None: return listing['files'], listing['dirs']
+
+        files = []; dirs = []; has_symlinks = False
+        with os.scandir(f_path) as it:
+            for entry in it:
+                try:
+                    if   entry.is_dir():  dirs.append(entry.name)
+                    elif entry.is_file(): files.append(entry.name)
+                    has_symlinks = has_symlinks or entry.is_symlink()
+                except FileNotFoundError: # removed since the directory was read
+                    pass
+
+        files.sort(); dirs.sort()
+
+        # The target of a symlink can change without the directory changing
+        if dir_cache is not None and not has_symlinks:
+            dir_cache.put(int_path, mtime_ns, files, dirs)
+
+        return files, dirs
+
+    def scan_dir(f_path, int_path):
+        """ Read one directory, with one scandir call and one stat per file. Reads of
+        sub directories are started before returning if the read ahead limit allows,
+        otherwise they are read when the caller reaches them. """
+
+        try: files, dirs = read_dir(f_path, int_path)
+        except FileNotFoundError: return []
+
+        # Directories are ordered as if their name ended in a slash, so that files are
+        # found in the order of their full paths
+        entries = sorted([(name, False) for name in files] + [(name + '/', True) for name in dirs])
+
+        result = []
+        for name, is_dir in entries:
+            name           = name.rstrip('/')
+            entry_int_path = cpjoin(int_path, name)
+            entry_path     = os.path.join(f_path, name)
+
+            if is_dir:
+                if skip_dir is not None and skip_dir(entry_int_path): continue
+                if read_ahead.acquire(blocking = False):
+                    result.append(executor.submit(scan_dir, entry_path, entry_int_path))
+                else:
+                    result.append((entry_path, entry_int_path))
+
+            else:
+                try: stat = os.stat(entry_path)
+                except FileNotFoundError: continue # removed since the directory was read
+
+                result.append({'path'     : force_unicode(entry_int_path),
+                               'created'  : stat.st_ctime,
+                               'last_mod' : stat.st_mtime})
+
+        return result
+
+    def walk(entries):
+        for item in entries:
+            if isinstance(item, Future):
+                sub_entries = item.result()
+                read_ahead.release()
+                yield from walk(sub_entries)
+
+            elif isinstance(item, tuple):
+                yield from walk(scan_dir(*item))
+
+            else:
+                yield cast(fileDetails, item)
+
+    # Permits are only returned as the caller consumes directories, so if it stops
+    # at most max_read_ahead reads are left to finish in the background
+    read_ahead = threading.Semaphore(max_read_ahead)
+    executor = ThreadPoolExecutor(max_workers = max_workers)
+    try:
+        yield from walk(scan_dir(path, int_path))
+    finally:
+        executor.shutdown(wait = False)
+
 ############################################################################################
 def get_file_list(path: str) -> List[fileDetails]:
     """ Recursively lists all files in a file system below 'path'. """
-    f_list = []
-    def recur_dir(path, newpath = os.path.sep):
-        files = os.listdir(path)
-        for fle in files:
-            f_path = cpjoin(path, fle)
-            if os.path.isdir(f_path): recur_dir(f_path, cpjoin(newpath, fle))
-            elif os.path.isfile(f_path): f_list.append(get_single_file_info(f_path, cpjoin(newpath, fle)))
-
-    recur_dir(path)
-    return f_list
+    return list(scan_file_list(path))
 
 ############################################################################################
 class manifestFileDetails(fileDetails):
     status: str
 
 ############################################################################################
-def find_manifest_changes(new_file_state : List[fileDetails], old_file_state : Dict[str, manifestFileDetails], include_unchanged : bool = False) -> Dict[str, manifestFileDetails]:
+def find_manifest_changes(new_file_state : Iterable[fileDetails], old_file_state : Dict[str, manifestFileDetails], include_unchanged : bool = False) -> Dict[str, manifestFileDetails]:
     """ Find what has changed between two sets of files """
-    prev_state_dict = copy.deepcopy(old_file_state)
+    prev_state_dict = dict(old_file_state) # items are copied before being changed
     changed_files = {}
 
     # Find files which are new on the server
@@ -209,3 +376,51 @@ def find_manifest_changes(new_file_state : List[fileDetails], old_file_state : D
         changed_files[itm['path']] = n_itm
 
     return changed_files
+
+############################################################################################
+# A compact manifest record, (path, last_mod, created, server_file_hash)
+manifestRow = Tuple[str, float, float, str]
+
+def find_sorted_manifest_changes(new_file_state : Iterable[fileDetails], old_file_state : Iterable[manifestRow],
+                                 include_unchanged : bool = False) -> Dict[str, manifestFileDetails]:
+    """ Find what has changed between two sets of files, as find_manifest_changes. Both
+    sets must be ordered by path, allowing them to be compared as streams without
+    holding either in memory. """
+
+    def row_details(row: manifestRow, status: str) -> manifestFileDetails:
+        return {'path' : row[0], 'last_mod' : row[1], 'created' : row[2], 'server_file_hash' : row[3], 'status' : status}
+
+    def item_details(itm: fileDetails, status: str) -> manifestFileDetails:
+        n_itm = cast(manifestFileDetails, itm.copy())
+        n_itm['status'] = status
+        return n_itm
+
+    changed_files = {}
+    old_rows = iter(old_file_state)
+    old_row  = next(old_rows, None)
+    previous_path = None
+
+    for itm in new_file_state:
+        if previous_path is not None and itm['path'] <= previous_path: raise Exception('File list is not sorted')
+        previous_path = itm['path']
+
+        # any files before this one in the old file state have been deleted locally
+        while old_row is not None and old_row[0] < itm['path']:
+            changed_files[old_row[0]] = row_details(old_row, 'deleted')
+            old_row = next(old_rows, None)
+
+        if old_row is not None and old_row[0] == itm['path']:
+            if itm['last_mod'] != old_row[1]:
+                changed_files[itm['path']] = item_details(itm, 'changed')
+            elif include_unchanged:
+                changed_files[itm['path']] = item_details(itm, 'unchanged')
+            old_row = next(old_rows, None)
+
+        else:
+            changed_files[itm['path']] = item_details(itm, 'new')
+
+    while old_row is not None:
+        changed_files[old_row[0]] = row_details(old_row, 'deleted')
+        old_row = next(old_rows, None)
+
+    return changed_files
@@ -0,0 +1,171 @@
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
+
+from bversion.http.http_common import read_body, parse_http_request_preamble, max_preamble_size
+from bversion.http.http_server import (ConnectionContext, Request, Responce,
+                                       ServeFile, ServeFrames, responce_preamble)
+
+#===============================================================================
+# Event loop server
+#
+# Connections are served by a single event loop, thus a connection which is
+# idle between requests costs only a socket and a coroutine. The request
+# handlers are blocking, so they run in a bounded thread pool, reading the
+# request body back through the event loop.
+#===============================================================================
+class blocking_stream_reader:
+    """ Reads from an asyncio stream from the thread pool, providing the read and
+    readinto methods read_body uses. The stream does it's own buffering, so reads
+    never take more than is asked for. """
+
+    def __init__(self, reader: asyncio.StreamReader, loop):
+        self.reader = reader
+        self.loop   = loop
+
+    def read(self, length: int) -> bytes:
+        return asyncio.run_coroutine_threadsafe(self.reader.read(length), self.loop).result()
+
+    def readinto(self, view: memoryview) -> int:
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+#===============================================================================
+class AsyncHTTPServer:
+    def __init__(self, host, port, connection_handler, max_workers: int = 32, backlog: int = 128,
+                 connection_timeout: int = 300):
+        self.host               = host
+        self.port               = port
+        self.connection_handler = connection_handler
+        self.backlog            = backlog
+        self.connection_timeout = connection_timeout
+
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.idle_connections: Dict[asyncio.StreamWriter, None] = {}
+        self.connection_tasks: Set['asyncio.Task'] = set()
+        self.shutting_down    = False
+        self.shutdown_timeout = 30.0
+        self.stopped          = None
+        self.loop             = None
+
+
+    #=============================================
+    async def send_responce(self, writer: asyncio.StreamWriter, rsp: Responce) -> None:
+        writer.write(responce_preamble(rsp))
+
+        if isinstance(rsp.body, ServeFile):
+            await writer.drain()
+            with open(rsp.body.path, 'rb') as f:
+                await self.loop.sendfile(writer.transport, f)
+        elif isinstance(rsp.body, ServeFrames):
+            for header, path in rsp.body.headers_and_paths():
+                writer.write(header)
+                await writer.drain()
+                if path is None: continue
+                with open(path, 'rb') as f:
+                    await self.loop.sendfile(writer.transport, f)
+        else:
+            writer.write(rsp.body)
+
+        await writer.drain()
+
+
+    #=============================================
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connection_tasks.add(asyncio.current_task())
+        addr = writer.get_extra_info('peername')
+        context = ConnectionContext()
+
+        try:
+            while not self.shutting_down:
+                self.idle_connections[writer] = None
+
+                # read request preamble
+                try:
+                    data = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.connection_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+
+                del self.idle_connections[writer]
+
+                # parse the header
+                request = parse_http_request_preamble(data[:-4])
+
+                if request['method'].lower() != 'post':
+                    print('error parsing request')
+                    break
+
+                request_headers = {k.lower() : v for k,v in dict(request['headers']).items()}
+
+                # handle the request
+                print('Connection from:', addr[0], ':', addr[1],' ', request['path'])
+
+                body_length = int(request_headers['content-length'])
+                body_reader = read_body(blocking_stream_reader(reader, self.loop), body_length)
+                rq = Request(addr[0], addr[1], request['path'], request_headers, body_reader)
+
+                def handle() -> Responce:
+                    rsp = self.connection_handler(rq, context)
+                    body_reader.dump() # discard any of the body which the handler did not read
+                    return rsp
+
+                rsp = await self.loop.run_in_executor(self.executor, handle)
+                await self.send_responce(writer, rsp)
+
+        except Exception as e: # pylint: disable=broad-except
+            print('Connection from', addr[0], ':', addr[1], 'closed:', e)
+
+        finally:
+            self.idle_connections.pop(writer, None)
+            await self.loop.run_in_executor(self.executor, context.shutdown_handler)
+            writer.close()
+            self.connection_tasks.discard(asyncio.current_task())
+
+
+    #=============================================
+    async def serve(self) -> None:
+        self.loop    = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            backlog = self.backlog, limit = max_preamble_size,
+                                            reuse_address = True)
+        print("socket bound to port", self.port)
+        print("socket is listening")
+
+        await self.stopped.wait()
+        server.close()
+
+        # drain in-flight requests
+        if self.connection_tasks:
+            await asyncio.wait(list(self.connection_tasks), timeout = self.shutdown_timeout)
+
+
+    #=============================================
+    def shutdown(self, timeout: float = 30) -> None:
+        """ Stop accepting connections, close idle ones and wait up to timeout
+        for in-flight requests to complete. Must be called on the event loop. """
+
+        self.shutting_down    = True
+        self.shutdown_timeout = timeout
+
+        for writer in list(self.idle_connections): writer.close()
+        self.stopped.set()
+
+
+    #=============================================
+    def serve_forever(self, shutdown_timeout: float = 30) -> None:
+        async def main():
+            loop = asyncio.get_running_loop()
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                loop.add_signal_handler(signum, self.shutdown, shutdown_timeout)
+            await self.serve()
+
+        try:
+            asyncio.run(main())
+        finally:
+            self.executor.shutdown(wait = False)
@@ -1,12 +1,15 @@
 import os, json, urllib.parse
 from typing import Dict
 from bversion.http.http_client import HTTPClient
+from bversion.http.http_common import read_frames, encode_frames, framed_length
 
 class client_http_request:
 ############################################################################################
     def __init__(self, server_base_url: str):
         "Configure the servers base URL"
 
+        self.server_url = server_base_url
+
         res = urllib.parse.urlparse(server_base_url)
         scheme               = res.scheme.lower()
         server_base_url      = res.hostname
@@ -22,6 +25,24 @@ class client_http_request:
                         port = port,
                         tls  = (scheme == 'https'))
 
+############################################################################################
+    def clone(self):
+        """ Open another connection to the same server """
+
+        return client_http_request(self.server_url)
+
+############################################################################################
+    def abort(self):
+        """ Abandon a request in progress, which may be being made by another thread. The
+        connection cannot be used afterwards. """
+
+        self.c.abort()
+
+############################################################################################
+    def close(self):
+        self.c.abort()
+        self.c.close()
+
 ############################################################################################
     def begin(self, url: str, body_length: int, add_headers: Dict[str, str], content_type: str):
         headers = {
@@ -49,14 +70,37 @@ class client_http_request:
             return body.read_all(), parsed_preamble['headers']
 
         else:
-            def writer(path):
-                with open(path, 'wb') as f:
-                    while True:
-                        chunk = body.read(1000 * 1000)
-                        if chunk is None: break
-                        f.write(chunk)
+            return body.write_to_file, parsed_preamble['headers']
+
+############################################################################################
+    def request_frames(self, url, headers, data = None):
+        """ Make a request which returns a framed body, returning an iterator over the
+        frames, see http_common.read_frames. The frames must be read to the end before
+        making another request. """
+
+        jsn = json.dumps(data) if data is not None else '{}'
 
-            return writer, parsed_preamble['headers']
+        conn = self.begin(url, len(jsn), headers, content_type = 'application/json')
+        conn.send(jsn.encode('utf8'))
+        parsed_preamble, body = conn.read_responce()
+
+        if parsed_preamble['headers'].get('status') != 'ok':
+            body.dump()
+            return iter([]), parsed_preamble['headers']
+
+        return read_frames(body), parsed_preamble['headers']
+
+############################################################################################
+    def send_frames(self, url, headers, frames, on_frame_sent = None):
+        """ Send a list of (info, file path) as a framed request body, see http_common.encode_frames """
+
+        conn = self.begin(url, framed_length(frames), headers, content_type = 'application/octet-stream')
+
+        for chunk in encode_frames(frames, on_frame_sent):
+            conn.send(chunk)
+
+        parsed_preamble, body = conn.read_responce()
+        return body.read_all(), parsed_preamble['headers']
 
 ############################################################################################
     def send_file(self, url, headers, file_path):
@@ -65,10 +109,7 @@ class client_http_request:
         conn = self.begin(url, size, headers, content_type = 'application/octet-stream')
 
         with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(1000 * 1000)
-                if chunk == b'': break
-                conn.send(chunk)
+            conn.send_file(f, size)
 
         parsed_preamble, body = conn.read_responce()
         return body.read_all(), parsed_preamble['headers']
@@ -1,21 +1,28 @@
 import socket, ssl
 from typing import Dict
 
-from bversion.http.http_common import read_body, generate_headers, parse_http_responce_preamble
+from bversion.http.http_common import read_body, buffered_reader, generate_headers, parse_http_responce_preamble
 
 #=====================================================================
 class HTTPClient:
     def __init__(self):
-        self.s = None
+        self.s      = None
+        self.reader = None
 
     def connect(self, host: str, port: int, tls: bool = False):
         self.s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
 
         if tls: self.s = ssl.wrap_socket(self.s, ssl_version=ssl.PROTOCOL_TLS)
         self.s.connect((host,port))
+        self.reader = buffered_reader(self.s.recv_into)
 
     def send(self, data: bytes):
-        self.s.send(data)
+        self.s.sendall(data)
+
+    def send_file(self, f, count: int):
+        """ Send count bytes of an open file, using sendfile where the socket allows it """
+
+        self.s.sendfile(f, 0, count)
 
     def send_headers(self, uri: str, headers: Dict[str, str]):
         msg = b"POST " + uri.encode('utf8') + b" HTTP/1.1\r\n"
@@ -26,21 +33,18 @@ class HTTPClient:
         )
 
     def read_responce(self):
-        parsed_preamble, body_partial = self.read_headers()
-        body = read_body(self.s.recv, int(parsed_preamble['headers']['content-length']), body_partial)
+        parsed_preamble = self.read_headers()
+        body = read_body(self.reader, int(parsed_preamble['headers']['content-length']))
         return parsed_preamble, body
 
     def read_headers(self):
-        data = b""
+        return parse_http_responce_preamble(self.reader.read_preamble())
 
-        # read request preamble
-        while True:
-            data += self.s.recv(1024)
-            if b"\r\n\r\n" in data: break
+    def abort(self):
+        """ Shut down the socket, unblocking a request in progress in another thread """
 
-        preamble, body_partial = data.split(b"\r\n\r\n", 1)
-        parsed_preamble = parse_http_responce_preamble(preamble)
-        return parsed_preamble, body_partial
+        try: self.s.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
 
     def close(self):
         self.s.close()
@@ -1,4 +1,5 @@
-from typing import List, Dict, Union
+import os, json, struct, hashlib
+from typing import List, Dict, Union, Iterator, Tuple, Callable, Optional
 from typing_extensions import TypedDict
 
 #=====================================================================
@@ -58,45 +59,254 @@ def parse_http_request_preamble(preamble: bytes) -> httpRequestPreamble:
             'path'    : split_status[1].decode('utf8'),
             'headers'  : parse_headers(headers_raw)}
 
+#=====================================================================
+# Buffered socket reading
+#
+# Data is received with recv_into, into a buffer which is allocated once
+# per connection, rather than allocating a new bytes object for every recv.
+# Reads at least as large as the buffer are received directly into the
+# callers buffer, so bulk transfers are not copied through it.
+#=====================================================================
+max_preamble_size = 64 * 1024
+read_buffer_size  = 256 * 1024
+copy_buffer_size  = 1024 * 1024
+
+class buffered_reader:
+    def __init__ (self, recv_into: Callable[[memoryview], int], buffer_size: int = read_buffer_size):
+        self.recv_into = recv_into
+        self.data      = bytearray(buffer_size)
+        self.view      = memoryview(self.data)
+        self.start     = 0
+        self.end       = 0
+
+    def fill(self) -> int:
+        """ Receive into the free space in the buffer, moving unread data to the start of it first """
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > 0:
+            length = self.end - self.start
+            self.view[:length] = self.view[self.start : self.end]
+            self.start = 0; self.end = length
+
+        received = self.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def buffered(self) -> int:
+        """ Number of bytes which have been received but not read """
+
+        return self.end - self.start
+
+    def read_preamble(self, max_size: int = max_preamble_size) -> bytes:
+        """ Read a request or responce preamble, up to the blank line which ends it """
+
+        searched = 0
+        while True:
+            pos = self.data.find(b"\r\n\r\n", self.start + searched, self.end)
+            if pos != -1:
+                preamble = bytes(self.view[self.start : pos])
+                self.start = pos + 4
+                return preamble
+
+            if self.end - self.start > min(max_size, len(self.data) - 1): raise Exception('Preamble too large')
+            searched = max(0, self.end - self.start - 3)
+            if self.fill() == 0: raise Exception('Socket closed')
+
+    def readinto(self, view: memoryview) -> int:
+        """ Read into a writable buffer, returns 0 if the socket is closed """
+
+        if self.start == self.end:
+            if len(view) >= len(self.data): return self.recv_into(view)
+            if self.fill() == 0: return 0
+
+        length = min(len(view), self.end - self.start)
+        view[:length] = self.view[self.start : self.start + length]
+        self.start += length
+        return length
+
+    def read(self, length: int) -> bytes:
+        """ Read up to length bytes, returns b'' if the socket is closed """
+
+        if self.start == self.end and self.fill() == 0: return b''
+
+        length = min(length, self.end - self.start)
+        data = bytes(self.view[self.start : self.start + length])
+        self.start += length
+        return data
+
+#=====================================================================
+def receive_to_file(readinto: Callable[[memoryview], int], path: str, length: int, hasher = None) -> None:
+    """ Write up to length bytes from readinto to a file, optionally updating a hashlib
+    object with them. The data is hashed and written from a reusable buffer. """
+
+    view = memoryview(bytearray(max(1, min(length, copy_buffer_size))))
+    with open(path, 'wb') as f:
+        while True:
+            received = readinto(view)
+            if received == 0: break
+            if hasher is not None: hasher.update(view[:received])
+            f.write(view[:received])
+
 #=====================================================================
 class read_body:
-    def __init__ (self, reader, body_length: int, body_partial: bytes):
+    def __init__ (self, reader, body_length: int):
         self.reader       = reader
         self.body_length  = body_length
-        self.body_partial = body_partial
         self.have_read    = 0
 
     def read(self, length = None) -> Union[bytes, None]:
-        if self.have_read >= self.body_length: return None
+        remaining = self.body_length - self.have_read
+        if remaining <= 0: return None
+
+        data = self.reader.read(remaining if length is None else min(length, remaining))
+        if data == b'': raise Exception('Socket closed')
 
-        if length is None: length = self.body_length - self.have_read
+        self.have_read += len(data)
+        return data
 
-        retbuffer: bytes
-        if len(self.body_partial) > 0:
-            retbuffer = self.body_partial[0:length]
-            self.body_partial = self.body_partial[length:]
+    def readinto(self, view: memoryview) -> int:
+        """ Read into a writable buffer, returns 0 at the end of the body """
 
-        else:
-            data = self.reader(length)
-            if data == b'': raise Exception('Socket closed')
-            retbuffer = data
+        remaining = self.body_length - self.have_read
+        if remaining <= 0: return 0
 
-        self.have_read += len(retbuffer)
-        return retbuffer
+        received = self.reader.readinto(view[:remaining])
+        if received == 0: raise Exception('Socket closed')
+
+        self.have_read += received
+        return received
 
     def read_all(self) -> bytes:
-        retbuffer: bytes = b''
+        data = bytearray(self.body_length - self.have_read)
+        view = memoryview(data)
 
-        while True:
-            chunk = self.read(1000 * 1000)
-            if chunk is None: break
-            retbuffer += chunk
+        offset = 0
+        while offset < len(data):
+            offset += self.readinto(view[offset:])
+
+        return bytes(data)
+
+    def write_to_file(self, path: str, hasher = None) -> None:
+        """ Write the rest of the body to a file, optionally updating a hashlib object with it """
 
-        return retbuffer
+        receive_to_file(self.readinto, path, self.body_length - self.have_read, hasher)
 
     def dump(self):
         """ Read whole body and discard it """
 
-        while True:
-            res = self.read(10000)
-            if res is None: break
+        view = memoryview(bytearray(max(1, min(self.body_length - self.have_read, copy_buffer_size))))
+        while self.readinto(view) != 0: pass
+
+
+#=====================================================================
+# Framed bodies
+#
+# Responces containing many files are sent as a sequence of frames, each
+# being a 4 byte big endian length, a JSON object describing the frame, an
+# 8 byte big endian length and then that many bytes of data. The body ends
+# after the last frame.
+#=====================================================================
+frame_info_length = struct.Struct('>I')
+frame_data_length = struct.Struct('>Q')
+
+def encode_frame_header(info: dict, data_length: int) -> bytes:
+    info_json = json.dumps(info).encode('utf8')
+    return frame_info_length.pack(len(info_json)) + info_json + frame_data_length.pack(data_length)
+
+#=====================================================================
+def read_exactly(body, length: int) -> Optional[bytes]:
+    """ Read length bytes from a body, returns None if the body ended
+    before any were read, and raises if it ended part way through """
+
+    retbuffer = bytearray()
+    while len(retbuffer) < length:
+        chunk = body.read(length - len(retbuffer))
+        if chunk is None:
+            if len(retbuffer) == 0: return None
+            raise Exception('Framed body ended part way through a frame')
+        retbuffer += chunk
+
+    return bytes(retbuffer)
+
+#=====================================================================
+class frame_reader:
+    """ Reads the data of a single frame """
+
+    def __init__ (self, body, data_length: int):
+        self.body      = body
+        self.remaining = data_length
+
+    def read(self, length = None) -> Optional[bytes]:
+        if self.remaining == 0: return None
+        if length is None: length = self.remaining
+
+        chunk = read_exactly(self.body, min(length, self.remaining))
+        if chunk is None: raise Exception('Framed body ended part way through a frame')
+        self.remaining -= len(chunk)
+        return chunk
+
+    def readinto(self, view: memoryview) -> int:
+        if self.remaining == 0: return 0
+
+        received = self.body.readinto(view[:self.remaining])
+        if received == 0: raise Exception('Framed body ended part way through a frame')
+        self.remaining -= received
+        return received
+
+    def write_to_file(self, path: str, hasher = None) -> None:
+        """ Write the frame data to a file, optionally updating a hashlib object with it """
+
+        receive_to_file(self.readinto, path, self.remaining, hasher)
+
+    def dump(self) -> None:
+        view = memoryview(bytearray(max(1, min(self.remaining, copy_buffer_size))))
+        while self.readinto(view) != 0: pass
+
+#=====================================================================
+def read_frames(body) -> Iterator[Tuple[dict, frame_reader]]:
+    """ Iterate the frames of a framed body, yielding the frame info and a reader
+    for the frame data. Any data which is not read is discarded. """
+
+    while True:
+        raw_length = read_exactly(body, frame_info_length.size)
+        if raw_length is None: return
+
+        info_json = read_exactly(body, frame_info_length.unpack(raw_length)[0])
+        raw_data_length = read_exactly(body, frame_data_length.size)
+        if info_json is None or raw_data_length is None:
+            raise Exception('Framed body ended part way through a frame')
+
+        frame = frame_reader(body, frame_data_length.unpack(raw_data_length)[0])
+        yield json.loads(info_json), frame
+        frame.dump()
+
+#=====================================================================
+def framed_length(frames: List[Tuple[dict, str]]) -> int:
+    """ Length of the body encode_frames will generate """
+
+    return sum(len(encode_frame_header(info, os.stat(path).st_size)) + os.stat(path).st_size
+               for info, path in frames)
+
+#=====================================================================
+def encode_frames(frames: List[Tuple[dict, str]],
+                  on_frame_sent: Optional[Callable[[dict, str], None]] = None) -> Iterator[bytes]:
+    """ Lazily generate a framed body from a list of file info and file paths.
+    on_frame_sent is called with the frame info and the sha256 of the data
+    after the last chunk of each frame is consumed. """
+
+    for info, path in frames:
+        size = os.stat(path).st_size
+        yield encode_frame_header(info, size)
+
+        hasher = hashlib.sha256()
+        remaining = size
+        with open(path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1000 * 1000))
+                if chunk == b'': raise Exception('File changed while sending: ' + path)
+                hasher.update(chunk)
+                remaining -= len(chunk)
+                yield chunk
+
+        if on_frame_sent is not None: on_frame_sent(info, hasher.hexdigest())
@@ -1,11 +1,16 @@
 import json
 import os
 import socket
-from io import BytesIO
-from typing import Union
+import queue
+import selectors
+import threading
+import time
+from typing import Union, List, Dict, Tuple, Optional
 import _thread
 
-from bversion.http.http_common import read_body, parse_http_request_preamble
+from bversion.common import ignore
+
+from bversion.http.http_common import read_body, buffered_reader, parse_http_request_preamble, encode_frame_header
 
 #=====================
 class ConnectionContext:
@@ -15,6 +20,7 @@ class ConnectionContext:
 
         self.shutdown_handler = null_haldler
         self.lock             = False
+        self.commit_session   = None
 
 #=====================
 class Request:
@@ -33,96 +39,143 @@ class ServeFile:
     def __init__ (self, path: str):
         self.path = path
 
+#=====================
+class ServeFrames:
+    """ A framed body made up of a sequence of files, see http_common """
+
+    def __init__ (self):
+        self.frames: List[Tuple[dict, Optional[str]]] = []
+
+    def add(self, info: dict, path: Optional[str] = None):
+        self.frames.append((info, path))
+
+    def headers_and_paths(self) -> List[Tuple[bytes, Optional[str]]]:
+        return [(encode_frame_header(info, 0 if path is None else os.stat(path).st_size), path)
+                for info, path in self.frames]
+
+    def __len__(self):
+        return sum(len(header) + (0 if path is None else os.stat(path).st_size)
+                   for header, path in self.headers_and_paths())
+
 #=====================
 class Responce:
-    def __init__ (self, headers = None, body: Union[bytes, ServeFile] = b""):
+    def __init__ (self, headers = None, body: Union[bytes, ServeFile, ServeFrames] = b""):
         if headers is None: headers = {}
         self.headers = headers
         self.body    = body
 
 #=============================================
-def HTTPServer(host, port, connection_handler):
-    def handle_connection(c, addr):
-        # Object locked to the thread
-        context = ConnectionContext()
+def responce_preamble(rsp: Responce) -> bytes:
+    """ Generate the status line and headers for a responce """
 
-        try:
-            while True:
-                data = b""
+    responce_headers =  b"HTTP/1.1 200 OK\r\n"
+    responce_headers += b"Connection: Keep-Alive\r\n"
 
-                # read request preamble
-                while True:
-                    data += c.recv(1024)
-                    if data == b'': raise Exception('Socket closed')
-                    if b"\r\n\r\n" in data: break
+    responce_content_length: int
+
+    if isinstance(rsp.body, ServeFile):
+        responce_content_length = os.stat(rsp.body.path).st_size
+    else:
+        responce_content_length = len(rsp.body)
 
-                preamble, body_partial = data.split(b"\r\n\r\n", 1)
+    responce_headers += b"Content-Length: " + bytes(str(responce_content_length), encoding='utf8') + b'\r\n'
 
+    for k, v in rsp.headers.items():
+        if isinstance(k, str): k=k.encode('utf8')
+        if isinstance(v, str): v=v.encode('utf8')
+        responce_headers += k + b':' + v + b'\r\n'
 
-                # parse the header
-                request = parse_http_request_preamble(preamble)
+    responce_headers += b"\r\n"
+    return responce_headers
 
-                if request['method'].lower() != 'post':
-                    print('error parsing request')
-                    break
 
-                request_headers = {k.lower() : v for k,v in dict(request['headers']).items()}
+#=============================================
+class HTTPConnection:
+    """ A persistent connection, and the state which lasts between it's requests """
+
+    def __init__ (self, c, addr):
+        self.socket      = c
+        self.addr        = addr
+        self.context     = ConnectionContext() # Object locked to the connection
+        self.last_active = time.time()
 
-                # handle the request
-                print('Connection from:', addr[0], ':', addr[1],' ', request['path'])
+        # Data received after the end of one request belongs to the next, so the reader lasts for the connection
+        self.reader = buffered_reader(c.recv_into)
+
+    def close(self) -> None:
+        self.context.shutdown_handler()
+        self.socket.close()
+
+
+#=============================================
+def serve_request(conn: HTTPConnection, connection_handler) -> bool:
+    """ Read one request from a connection and send the responce, returns false
+    if the connection should be closed """
 
-                body_length = int(request_headers['content-length'])
-                body_reader = read_body(c.recv, body_length, body_partial)
-                rq = Request(addr[0], addr[1], request['path'], request_headers, body_reader)
-                rsp: Responce = connection_handler(rq, context)
-                body_reader.dump() # as we are using persistant connections, we need to read and discard any
-                                   # remaining body from the socket
+    c = conn.socket
 
-                # generate client responce
-                responce_headers =  b"HTTP/1.1 200 OK\r\n"
-                responce_headers += b"Connection: Keep-Alive\r\n"
+    # read request preamble
+    preamble = conn.reader.read_preamble()
 
-                responce_content_length: int
+    # parse the header
+    request = parse_http_request_preamble(preamble)
 
-                if isinstance(rsp.body, ServeFile):
-                    responce_content_length = os.stat(rsp.body.path).st_size
-                else:
-                    responce_content_length = len(rsp.body)
+    if request['method'].lower() != 'post':
+        print('error parsing request')
+        return False
 
-                responce_headers += b"Content-Length: " + bytes(str(responce_content_length), encoding='utf8') + b'\r\n'
+    request_headers = {k.lower() : v for k,v in dict(request['headers']).items()}
 
-                for k, v in rsp.headers.items():
-                    if isinstance(k, str): k=k.encode('utf8')
-                    if isinstance(v, str): v=v.encode('utf8')
-                    responce_headers += k + b':' + v + b'\r\n'
+    # handle the request
+    print('Connection from:', conn.addr[0], ':', conn.addr[1],' ', request['path'])
 
-                responce_headers += b"\r\n"
-                c.send(responce_headers)
+    body_length = int(request_headers['content-length'])
+    body_reader = read_body(conn.reader, body_length)
+    rq = Request(conn.addr[0], conn.addr[1], request['path'], request_headers, body_reader)
+    rsp: Responce = connection_handler(rq, conn.context)
+    body_reader.dump() # as we are using persistant connections, we need to read and discard any
+                       # remaining body from the socket
 
-                if isinstance(rsp.body, ServeFile):
-                    c.sendfile(open(rsp.body.path, 'rb'), 0)
-                else:
-                    reader = BytesIO(rsp.body)
-                    while True:
-                        chunk = reader.read(4096)
-                        if chunk == b'': break
-                        c.send(chunk)
+    # generate client responce
+    c.sendall(responce_preamble(rsp))
 
-        except:
-            context.shutdown_handler()
-            c.close()
-            raise
+    if isinstance(rsp.body, ServeFile):
+        with open(rsp.body.path, 'rb') as f:
+            c.sendfile(f, 0)
+    elif isinstance(rsp.body, ServeFrames):
+        for header, path in rsp.body.headers_and_paths():
+            c.sendall(header)
+            if path is None: continue
+            with open(path, 'rb') as f:
+                c.sendfile(f, 0)
+    else:
+        c.sendall(rsp.body)
 
-        context.shutdown_handler()
-        c.close()
+    conn.last_active = time.time()
+    return True
+
+
+#=============================================
+def handle_connection(c, addr, connection_handler):
+    """ Serve requests on a persistent connection until the client closes it """
+
+    conn = HTTPConnection(c, addr)
+    try:
+        while serve_request(conn, connection_handler): pass
+    finally:
+        conn.close()
+
+
+#=============================================
+def HTTPServer(host, port, connection_handler, backlog = 5):
+    """ Serve each connection on a new thread, with no limit on concurrency """
 
-    #============
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind((host, port))
     print("socket bound to port", port)
 
     # put the socket into listening mode
-    s.listen(5)
+    s.listen(backlog)
     print("socket is listening")
 
     try:
@@ -131,9 +184,184 @@ def HTTPServer(host, port, connection_handler):
             c.settimeout(300)
 
             # Start a new thread and return its identifier
-            _thread.start_new_thread(handle_connection, (c, addr))
+            _thread.start_new_thread(handle_connection, (c, addr, connection_handler))
     except:
         s.close()
         raise
 
     s.close()
+
+
+#=============================================
+busy_responce = (b"HTTP/1.1 503 Busy\r\n"
+                 b"Connection: close\r\n"
+                 b"Content-Length: 0\r\n"
+                 b"status:fail\r\n"
+                 b"msg:The server is busy, please try again later\r\n"
+                 b"\r\n")
+
+class ThreadPoolHTTPServer:
+    """ Serve requests using a fixed number of worker threads. Between requests connections
+    are watched by a selector on the accept thread, so that an idle keep-alive connection
+    does not hold a worker. When a request arrives it's connection waits in a bounded
+    queue for a free worker, and is refused once the queue is full. Calling shutdown
+    stops accepting connections, closes idle connections and waits for in-flight
+    requests to complete. """
+
+    def __init__(self, host, port, connection_handler, max_workers: int = 32, backlog: int = 128,
+                 max_queued: int = 256, connection_timeout: int = 300):
+        self.host               = host
+        self.port               = port
+        self.connection_handler = connection_handler
+        self.max_workers        = max_workers
+        self.backlog            = backlog
+        self.connection_timeout = connection_timeout
+
+        self.pending: 'queue.Queue' = queue.Queue(maxsize = max_queued) # connections with a request to serve
+        self.returned: 'queue.Queue' = queue.Queue() # connections handed back by workers after a request
+        self.workers: List[threading.Thread] = []
+        self.selector           = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.mutex              = threading.Lock()
+        self.shutting_down      = threading.Event()
+        self.listen_socket      = None
+
+    #=============================================
+    def wake(self) -> None:
+        """ Interrupt the selector, so that the accept thread notices returned connections or shutdown """
+
+        ignore(self.wake_w.send, b'x')
+
+    #=============================================
+    def hand_back(self, conn: HTTPConnection) -> None:
+        """ Called by workers after a request, to wait for the next without holding the worker """
+
+        with self.mutex:
+            if self.shutting_down.is_set():
+                conn.close()
+                return
+            self.returned.put(conn)
+
+        self.wake()
+
+    #=============================================
+    def dispatch(self, conn: HTTPConnection) -> None:
+        """ Queue a connection which has received a request for a worker """
+
+        if self.shutting_down.is_set():
+            ignore(conn.close)
+            return
+
+        try:
+            self.pending.put_nowait(conn)
+        except queue.Full:
+            print('Refusing request from', conn.addr[0], ':', conn.addr[1], 'queue is full')
+            ignore(conn.socket.sendall, busy_responce)
+            conn.close()
+
+    #=============================================
+    def worker(self) -> None:
+        while True:
+            conn = self.pending.get()
+            if conn is None: break
+
+            try:
+                # A request already received in full would not wake the selector, so serve it now
+                keep_open = serve_request(conn, self.connection_handler)
+                while keep_open and conn.reader.buffered() > 0 and not self.shutting_down.is_set():
+                    keep_open = serve_request(conn, self.connection_handler)
+
+            except Exception as e: # pylint: disable=broad-except
+                print('Connection from', conn.addr[0], ':', conn.addr[1], 'closed:', e)
+                keep_open = False
+
+            if keep_open: self.hand_back(conn)
+            else:         conn.close()
+
+    #=============================================
+    def close_idle_connections(self, idle_before: float) -> None:
+        for key in list(self.selector.get_map().values()):
+            conn = key.data
+            if isinstance(conn, HTTPConnection) and conn.last_active < idle_before:
+                self.selector.unregister(conn.socket)
+                ignore(conn.close)
+
+    #=============================================
+    def serve_forever(self) -> None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        print("socket bound to port", self.port)
+
+        s.listen(self.backlog)
+        s.setblocking(False)
+        self.listen_socket = s
+        print("socket is listening")
+
+        self.selector.register(s, selectors.EVENT_READ)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+        for _ in range(self.max_workers):
+            t = threading.Thread(target = self.worker, daemon = True)
+            t.start()
+            self.workers.append(t)
+
+        try:
+            while not self.shutting_down.is_set():
+                for key, _ in self.selector.select(timeout = 1):
+                    if key.fileobj is s:
+                        try: c, addr = s.accept()
+                        except BlockingIOError: continue
+
+                        c.settimeout(self.connection_timeout)
+                        self.selector.register(c, selectors.EVENT_READ, HTTPConnection(c, addr))
+
+                    elif key.fileobj is self.wake_r:
+                        ignore(self.wake_r.recv, 4096)
+
+                    else:
+                        self.selector.unregister(key.fileobj)
+                        self.dispatch(key.data)
+
+                while True:
+                    try: conn = self.returned.get_nowait()
+                    except queue.Empty: break
+                    self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+
+                self.close_idle_connections(time.time() - self.connection_timeout)
+
+        finally:
+            s.close()
+
+            # Connections waiting between requests will not receive another, close them now.
+            # Workers close connections themselves once shutting_down is set.
+            with self.mutex:
+                self.shutting_down.set()
+
+            while True:
+                try: conn = self.returned.get_nowait()
+                except queue.Empty: break
+                ignore(conn.close)
+
+            self.close_idle_connections(float('inf'))
+            self.selector.close()
+
+    #=============================================
+    def shutdown(self, timeout: float = 30) -> None:
+        """ Stop accepting connections and drain in-flight requests """
+
+        with self.mutex:
+            self.shutting_down.set()
+        self.wake()
+
+        # Connections which have not been picked up by a worker yet
+        while True:
+            try: conn = self.pending.get_nowait()
+            except queue.Empty: break
+            if conn is not None: ignore(conn.close)
+
+        for _ in self.workers: self.pending.put(None)
+
+        deadline = time.time() + timeout
+        for t in self.workers:
+            t.join(max(0, deadline - time.time()))
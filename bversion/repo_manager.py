@@ -166,8 +166,8 @@ def backup():
                 index_object_order = []
 
                 index_objects[commit_hash] = {
-                    'type'   : 'file',
-                    'source' : cpjoin(repository_path, 'index', commit_hash[:2], commit_hash[2:]),
+                    'type'   : 'index',
+                    'hash'   : commit_hash,
                     'dest'   : cpjoin('index', commit_hash[:2], commit_hash[2:])
                 }
                 index_object_order.append(commit_hash)
@@ -190,8 +190,8 @@ def backup():
                 # ===============================================
                 for tree_object_hash in tree_objects:
                     index_objects[tree_object_hash] = {
-                        'type'   : 'file',
-                        'source' : cpjoin(repository_path, 'index', tree_object_hash[:2], tree_object_hash[2:]),
+                        'type'   : 'index',
+                        'hash'   : tree_object_hash,
                         'dest'   : cpjoin('index', tree_object_hash[:2], tree_object_hash[2:])
                     }
 
@@ -243,6 +243,15 @@ def backup():
                                          remote_file_path = repository_name + '/' + it['path'],
                                          file_handle = fle)
 
+                    # Index objects may be stored loose or within a pack, so are read through the data store
+                    elif it['type'] == 'index':
+                        print('Uploading: ' + repository_name + '/' + it['dest'])
+
+                        fle = BytesIO(data_store.read_index_object_bytes(it['hash']))
+                        streaming_upload(s3_conn, config,
+                                         remote_file_path = repository_name + '/' + it['dest'],
+                                         file_handle = fle)
+
                     else:
                         file_hash = ''.join(it['dest'].split('/')[-2:])
 
@@ -383,6 +392,8 @@ def run():
 
     restore                      : Restore repositories
 
+    pack                         : Move loose index objects into packs
+
     """)
 
     #----------------------------
@@ -452,6 +463,36 @@ def run():
                 else:
                     break
 
+    #----------------------------
+    elif args[0] == 'pack':
+
+        print()
+
+        for repository_name, details in config['repositories'].items():
+            print('Packing index objects in repository: ' + repository_name)
+
+            repository_path = details['path']
+
+            # --------
+            path_override = None
+            if 'transient_db_path_override' in details:
+                path_override = details['transient_db_path_override']
+
+            data_store = versioned_storage(repository_path, path_override = path_override)
+
+            # --------
+            while True:
+                status, packs = data_store.pack_objects()
+                if status is False and packs == ['failed to lock']:
+                    print('Could not aquire lock, waiting to retry')
+                    time.sleep(60)
+                else:
+                    break
+
+            for pack_name in packs:
+                print('Created pack: ' + pack_name)
+            print()
+
     #----------------------------
     elif args[0] == 'backup':
         backup()
@@ -1,13 +1,15 @@
-from typing import Dict, Callable, Union, Optional
-import json, base64, re
+from typing import Dict, Callable, Union, Optional, Tuple
+import json, base64, re, hashlib, os, tempfile, threading, time
 import pysodium # type: ignore
 
 #====
-from bversion.http.http_server import Request, Responce, ServeFile, ConnectionContext
-from bversion.common import cpjoin
+from bversion.http.http_server import Request, Responce, ServeFile, ServeFrames, ConnectionContext
+from bversion.http.http_common import read_frames
+from bversion.common import cpjoin, ignore
 from bversion.storage.versioned_storage import versioned_storage
 from bversion.merge_client_and_server_changes import merge_client_and_server_changes
 from bversion.storage.server_db import get_server_db_instance_for_thread
+from bversion.storage.object_cache import index_object_cache
 
 from bversion import version_numbers
 
@@ -25,6 +27,7 @@ no_active_commit_msg  = "A commit must be started before attempting this operati
 unsuported_client_msg = "Please update your BVersion client."
 
 extend_session_duration = (60 * 60) * 2 # 2 hours
+session_flush_interval  = 30
 
 #===============================================================================
 # Ensure that the servers transient database tables are created
@@ -33,6 +36,10 @@ def init_server(new_config : dict):
     global config
     config = new_config
 
+    if 'index_cache_max_entries' in config or 'index_cache_max_bytes' in config:
+        index_object_cache.configure(config.get('index_cache_max_entries', index_object_cache.max_entries),
+                                     config.get('index_cache_max_bytes',   index_object_cache.max_bytes))
+
     for data in config['repositories'].values():
         repository_path = data['path']
 
@@ -43,6 +50,11 @@ def init_server(new_config : dict):
                                                 path_override = data['transient_db_path_override'])
         sdb.db_init()
 
+    global session_flusher
+    if session_flusher is None:
+        session_flusher = threading.Thread(target = session_flush_loop, daemon = True)
+        session_flusher.start()
+
 
 #===============================================================================
 # Decorator to make defining routes easy
@@ -67,7 +79,7 @@ def endpoint(request: Request, context: ConnectionContext):
 
 
 #===============================================================================
-def server_responce(headers: Dict[str, str], body: Union[bytes, ServeFile]):
+def server_responce(headers: Dict[str, str], body: Union[bytes, ServeFile, ServeFrames]):
     return Responce(headers, body)
 
 
@@ -78,7 +90,7 @@ def fail(msg: str = ''):
 
 
 #===============================================================================
-def success(headers: Optional[Dict[str, str]] = None, data: Union[dict, bytes, ServeFile] = b''):
+def success(headers: Optional[Dict[str, str]] = None, data: Union[dict, bytes, ServeFile, ServeFrames] = b''):
     """ Generate success JSON to send to client """
     passed_headers: Dict[str, str] = {} if headers is None else headers
     if isinstance(data, dict): data = json.dumps(data).encode('utf8')
@@ -102,10 +114,11 @@ def begin_auth(request: Request, context: ConnectionContext) -> Responce: # pyli
     repository_path = config['repositories'][repository]['path']
     sdb = get_server_db_instance_for_thread(repository_path,
                                             path_override = config['repositories'][repository]['transient_db_path_override'])
-    sdb.gc_tokens()
+    with sdb.transaction():
+        sdb.gc_tokens()
 
-    # Issue a new token
-    auth_token = sdb.issue_token(request.remote_addr)
+        # Issue a new token
+        auth_token = sdb.issue_token(request.remote_addr)
 
     return success({'auth_token' : auth_token})
 
@@ -135,7 +148,7 @@ def authenticate(request: Request, context: ConnectionContext) -> Responce: # py
     if 'session_token' in request.headers:
         session_token = request.headers['session_token']
 
-        if sdb.validate_session(session_token, client_ip) != []:
+        if get_session_cache(repository).get(session_token.encode('utf8'), client_ip) is not None:
             return success({
                 'server_version' : str(version_numbers.server_version).encode('utf8'),
                 'session_token'  : session_token
@@ -180,41 +193,284 @@ def authenticate(request: Request, context: ConnectionContext) -> Responce: # py
             return fail(user_auth_fail_msg)
 
 
+#===============================================================================
+# Session cache
+#
+# Session tokens are checked against an in memory table, so that authenticating
+# a request does not write to the transient database. Sessions are read from the
+# database when first used, extended expiry times are written back in batches by
+# a background thread, which also garbage collects expired sessions. Other server
+# processes sharing the database have their own cache, so a session which looks
+# to have expired is read again before it is rejected.
+#===============================================================================
+class session_cache:
+    def __init__(self, repository: str):
+        self.repository = repository
+        self.sessions: Dict[bytes, dict] = {}
+        self.extended: Dict[bytes, dict] = {} # sessions with an expiry which has not been written
+        self.mutex = threading.Lock()
+
+    #=============================================
+    def get_db(self):
+        data = config['repositories'][self.repository]
+        return get_server_db_instance_for_thread(data['path'], path_override = data['transient_db_path_override'])
+
+    #=============================================
+    def get(self, session_token: bytes, client_ip: str) -> Optional[dict]:
+        """ Returns the session if the token is valid for the clients ip """
+
+        with self.mutex:
+            session = self.sessions.get(session_token)
+
+        if session is None or session['expires'] < time.time():
+            session = self.load(session_token, client_ip)
+
+        if session is None or session['ip'] != client_ip: return None
+        return session
+
+    #=============================================
+    def load(self, session_token: bytes, client_ip: str) -> Optional[dict]:
+        """ Read a session from the database. An expired session remains valid while
+        it is used by the active commit, as uploading large files can outlast it. """
+
+        sdb = self.get_db()
+        res = sdb.get_session_token(session_token, client_ip)
+        if res == []: return None
+
+        session = res[0]
+        if session['expires'] < time.time():
+            active_commit = sdb.get_active_commit()
+            if active_commit is None or active_commit['session_token'] != session_token: return None
+
+        with self.mutex:
+            self.sessions[session_token] = session
+        return session
+
+    #=============================================
+    def extend(self, session: dict) -> None:
+        with self.mutex:
+            session['expires'] = time.time() + extend_session_duration
+            self.extended[session['token']] = session
+
+    #=============================================
+    def flush(self) -> None:
+        """ Write extended sessions to the database and remove expired ones """
+
+        with self.mutex:
+            extended = list(self.extended.values())
+            self.extended = {}
+
+        try:
+            sdb = self.get_db()
+            active_commit = sdb.get_active_commit()
+            keep = None if active_commit is None else active_commit['session_token']
+
+            with sdb.transaction():
+                sdb.write_sessions(extended)
+                sdb.gc_session_tokens(keep)
+
+        except:
+            with self.mutex:
+                for session in extended: self.extended.setdefault(session['token'], session)
+            raise
+
+        now = time.time()
+        with self.mutex:
+            for token in [token for token, session in self.sessions.items() if session['expires'] < now and token != keep]:
+                del self.sessions[token]
+
+session_caches: Dict[str, session_cache] = {}
+session_caches_lock = threading.Lock()
+session_flusher: Optional[threading.Thread] = None
+
+
+#===============================================================================
+def get_session_cache(repository: str) -> session_cache:
+    with session_caches_lock:
+        if repository not in session_caches: session_caches[repository] = session_cache(repository)
+        return session_caches[repository]
+
+
+#===============================================================================
+def flush_session_caches() -> None:
+    """ Write all session caches to the database, a cache which fails is retried next time """
+
+    with session_caches_lock:
+        caches = list(session_caches.values())
+
+    for cache in caches:
+        if cache.repository not in config['repositories']: continue
+
+        try: cache.flush()
+        except Exception as e: # pylint: disable=broad-except
+            print('Failed to write sessions of repository ' + cache.repository + ': ' + str(e))
+
+
+#===============================================================================
+def session_flush_loop() -> None:
+    while True:
+        time.sleep(config.get('session_flush_interval', session_flush_interval))
+        flush_session_caches()
+
+
 #===============================================================================
 def have_authenticated_user(client_ip: str, repository: str, session_token: bytes):
-    """ check user submitted session token against the db and that ip has not changed """
+    """ check user submitted session token and that ip has not changed, extending the session """
 
     if repository not in config['repositories']: return False
 
-    repository_path = config['repositories'][repository]['path']
-    sdb = get_server_db_instance_for_thread(repository_path,
-                                            path_override = config['repositories'][repository]['transient_db_path_override'])
+    cache = get_session_cache(repository)
+    session = cache.get(session_token, client_ip)
 
-    # Garbage collect session tokens. We must not garbage collect the authentication token of the client
-    # which is currently doing a commit. Large files can take a long time to upload and during this time,
-    # the locks expiration is not being updated thus can expire. This is a problem here as session tokens
-    # table is garbage collected every time a user authenticates. It does not matter if the user_lock
-    # expires while the client also holds the flock, as it is updated to be in the future at the end of
-    # the current operation. We exclude any tokens owned by the client which currently doing a commit
-    # for this reason.
-    active_commit = sdb.get_active_commit()
-
-    if active_commit is None:
-        sdb.gc_session_tokens(None)
-    else:
-        sdb.gc_session_tokens(active_commit['session_token'])
+    if session is not None and repository in config['users'][session['username']]['uses_repositories']:
+        cache.extend(session)
+        return session
 
-    # Get the session token
-    res = sdb.get_session_token(session_token, client_ip)
+    return False
 
-    if res != [] and repository in config['users'][res[0]['username']]['uses_repositories']:
-        sdb.update_session_token_expiry(extend_session_duration, session_token, client_ip)
-        sdb.con.commit() # we commit at the end to make sure that all opperations have the same view
 
-        return res[0]
+#===============================================================================
+# Commit sessions
+#
+# The write lock is held by a commit session rather than a single connection,
+# allowing a client to upload files in parallel over several connections. The
+# connection which begins the commit creates the session, and other connections
+# using the same session token may join it. The lock is released when the commit
+# completes, or when the last connection in the session closes. Changes to the
+# active commit are serialised using the sessions mutex.
+#===============================================================================
+class commit_session:
+    def __init__(self, key: Tuple[str, bytes], data_store: versioned_storage):
+        self.key         = key
+        self.data_store  = data_store
+        self.connections = 0
+        self.active      = True
+        self.mutex       = threading.Lock()
+        self.base_revision: Optional[str] = None
+
+commit_sessions: Dict[Tuple[str, bytes], commit_session] = {}
+commit_sessions_lock = threading.Lock()
+
+
+#===============================================================================
+# Lock queue
+#
+# Clients which cannot acquire the write lock immediately join a FIFO queue,
+# identified by a ticket. If the lock is unavailable the request returns the
+# ticket and the clients queue position straight away, rather than holding a
+# server worker while it waits. The client keeps it's place by retrying with
+# the ticket, tickets which are not retried within lock_ticket_expiry are
+# dropped from the queue.
+#===============================================================================
+lock_ticket_expiry = 60
+
+class lock_queue:
+    def __init__(self):
+        self.tickets: Dict[str, float] = {} # ticket : time last seen, in queue order
+        self.mutex = threading.Lock()
+
+    #=============================================
+    def join(self, ticket: Optional[str]) -> str:
+        """ Join the queue or refresh an existing place, must be called holding mutex """
+
+        if ticket is None or ticket not in self.tickets:
+            ticket = base64.b64encode(pysodium.randombytes(18)).decode('utf8')
+
+        self.tickets[ticket] = time.time()
+        return ticket
+
+    #=============================================
+    def position(self, ticket: str) -> int:
+        """ One based position of a ticket in the queue, must be called holding mutex """
+
+        expire_before = time.time() - config.get('lock_ticket_expiry', lock_ticket_expiry)
+        for it in [it for it, last_seen in self.tickets.items() if last_seen < expire_before and it != ticket]:
+            del self.tickets[it]
+
+        return list(self.tickets.keys()).index(ticket) + 1
+
+    #=============================================
+    def leave(self, ticket: str) -> None:
+        with self.mutex:
+            self.tickets.pop(ticket, None)
+
+lock_queues: Dict[str, lock_queue] = {}
+
+
+#===============================================================================
+def get_lock_queue(repository: str) -> lock_queue:
+    with commit_sessions_lock:
+        if repository not in lock_queues: lock_queues[repository] = lock_queue()
+        return lock_queues[repository]
+
+
+#===============================================================================
+def acquire_lock_in_turn(data_store: versioned_storage, repository: str, ticket: Optional[str], wait: bool):
+    """ Try to take the write lock in FIFO order, without blocking. Returns if the lock
+    was acquired, the ticket, and the position in the queue if it was not. If the client
+    is not going to wait, it does not keep it's place in the queue. """
+
+    queue = get_lock_queue(repository)
+
+    with queue.mutex:
+        ticket = queue.join(ticket)
+        position = queue.position(ticket)
+
+        if position != 1 or not data_store.lock():
+            if not wait: del queue.tickets[ticket]
+            return False, ticket, position
+
+    queue.leave(ticket)
+    return True, ticket, 0
 
-    sdb.con.commit()
-    return False
+
+#===============================================================================
+def attach_commit_session(context: ConnectionContext, session: commit_session) -> None:
+    with commit_sessions_lock:
+        session.connections += 1
+
+    context.lock           = True
+    context.commit_session = session
+    context.shutdown_handler = lambda: detach_commit_session(context)
+
+
+#===============================================================================
+def detach_commit_session(context: ConnectionContext) -> None:
+    """ Remove a connection from it's commit session, ending the session
+    if it was the last connection in it """
+
+    session = context.commit_session
+    context.lock           = False
+    context.commit_session = None
+    if session is None: return
+
+    with commit_sessions_lock:
+        session.connections -= 1
+        if session.connections > 0: return
+
+    end_commit_session(session)
+
+
+#===============================================================================
+def end_commit_session(session: commit_session) -> None:
+    """ Release the write lock, any connections still attached to the session
+    can no longer modify the active commit """
+
+    with commit_sessions_lock:
+        if not session.active: return
+        session.active = False
+        if commit_sessions.get(session.key) is session: del commit_sessions[session.key]
+
+    session.data_store.unlock()
+
+
+#===============================================================================
+def get_commit_session(context: ConnectionContext) -> Optional[commit_session]:
+    """ Returns the active commit session of a connection, or None if it does not hold the lock """
+
+    session = context.commit_session
+    if not context.lock or session is None or not session.active: return None
+    return session
 
 
 #===============================================================================
@@ -304,6 +560,50 @@ def pull_file(request: Request, context: ConnectionContext) -> Responce: # pylin
     return success({'file_info_json' : json.dumps(file_info)}, ServeFile(full_file_path))
 
 
+#===============================================================================
+@route('pull_files')
+def pull_files(request: Request, context: ConnectionContext) -> Responce: # pylint: disable=W0613
+    """ Get many files from the server in a single framed responce. Each frame holds
+    the file info and contents of one file, in the order they were requested. """
+
+    session_token = request.headers['session_token'].encode('utf8')
+    repository    = request.headers['repository']
+
+    #===
+    current_user = have_authenticated_user(request.remote_addr, repository, session_token)
+    if current_user is False: return fail(user_auth_fail_msg)
+
+
+    #===
+    data_store = versioned_storage(config['repositories'][repository]['path'],
+                                   path_override = config['repositories'][repository]['transient_db_path_override'])
+
+    use_head = bool(int(request.headers['use_head']))
+
+    if use_head:
+        version_id = data_store.get_head()
+    else:
+        version_id = request.headers['version_id']
+
+    try:
+        lookup = data_store.get_version_lookup(version_id)
+    except IOError:
+        return fail('Invalid object hash')
+
+    # =============
+    body = ServeFrames()
+    for path in request.get_json()['files']:
+        file_info = lookup.get_file(path)
+
+        if file_info is None:
+            body.add({'path' : path, 'status' : 'fail', 'msg' : 'File does not exist'})
+        else:
+            full_file_path: str = cpjoin(data_store.get_file_directory_path(file_info['hash']), file_info['hash'][2:])
+            body.add({'path' : path, 'status' : 'ok', 'file_info' : file_info}, full_file_path)
+
+    return success({'version_id' : version_id}, body)
+
+
 #===============================================================================
 @route('list_versions')
 def list_versions(request: Request, context: ConnectionContext) -> Responce: # pylint: disable=W0613
@@ -319,7 +619,9 @@ def list_versions(request: Request, context: ConnectionContext) -> Responce: # p
         data_store = versioned_storage(config['repositories'][repository]['path'],
                                        path_override = config['repositories'][repository]['transient_db_path_override'])
 
-        return success({}, {'versions' : data_store.get_commit_chain()})
+        offset = int(request.headers.get('offset', 0))
+
+        return success({}, {'versions' : data_store.get_commit_chain(offset = offset)})
 
     except IOError:
         return fail('Invalid object hash')
@@ -401,27 +703,33 @@ def begin_commit(request: Request, context: ConnectionContext) -> Responce:
                                    path_override = config['repositories'][repository]['transient_db_path_override'])
 
     # ==
-    have_lock = data_store.lock()
+    detach_commit_session(context)
+
+    have_lock, ticket, position = acquire_lock_in_turn(data_store, repository, request.headers.get('lock_ticket'),
+                                                       wait = bool(int(request.headers.get('wait_for_lock', '0'))))
     if not have_lock:
-        return fail(lock_fail_msg)
+        return server_responce({'status'         : 'fail',
+                                'msg'            : lock_fail_msg,
+                                'lock_ticket'    : ticket,
+                                'queue_position' : str(position)}, b'')
 
     else:
-        context.lock = True
-        def unlock():
-            if context.lock is True:
-                data_store.unlock()
-                context.lock = False
-
-        context.shutdown_handler = unlock
-
-    # Commits can only take place if the committing user has the latest revision,
-    # as committing from an outdated state could cause unexpected results, and may
-    # have conflicts. Conflicts are resolved during a client update so they are
-    # handled by the client, and a server interface for this is not needed.
-    if data_store.get_head() != request.headers["previous_revision"]:
+        session = commit_session((repository, session_token), data_store)
+        with commit_sessions_lock: commit_sessions[session.key] = session
+        attach_commit_session(context, session)
+
+    # Commits may be based on an older revision than the head, in which case the commit
+    # is rebased onto the head when it completes, as long as none of it's changes overlap
+    # the changes made since. Overlapping changes may conflict, these are resolved during
+    # a client update so they are handled by the client, and a server interface for this
+    # is not needed.
+    if not data_store.is_ancestor(request.headers["previous_revision"], data_store.get_head()):
         if data_store.get_active_commit() is not None: data_store.rollback()
+        detach_commit_session(context)
         return fail(need_to_update_msg)
 
+    session.base_revision = request.headers["previous_revision"]
+
     # if the last active commit was by the same user and ip, get the partial committed files
     # and send them back to allow resume, otherwise do rollback if needed.
     active_commit = data_store.get_active_commit()
@@ -445,6 +753,30 @@ def begin_commit(request: Request, context: ConnectionContext) -> Responce:
     return success(data={'partial_commit' : commit_files})
 
 
+#===============================================================================
+@route('join_commit')
+def join_commit(request: Request, context: ConnectionContext) -> Responce:
+    """ Join the commit session begun by another connection using the same session token """
+
+    session_token = request.headers['session_token'].encode('utf8')
+    repository    = request.headers['repository']
+
+    #===
+    current_user = have_authenticated_user(request.remote_addr, repository, session_token)
+    if current_user is False: return fail(user_auth_fail_msg)
+
+    #===
+    detach_commit_session(context)
+
+    with commit_sessions_lock:
+        session = commit_sessions.get((repository, session_token))
+
+    if session is None or not session.active: return fail(lock_fail_msg)
+
+    attach_commit_session(context, session)
+    return success()
+
+
 #===============================================================================
 @route('push_file')
 def push_file(request: Request, context: ConnectionContext) -> Responce:
@@ -461,7 +793,8 @@ def push_file(request: Request, context: ConnectionContext) -> Responce:
     repository_path = config['repositories'][repository]['path']
 
     #===
-    if not context.lock:
+    session = get_commit_session(context)
+    if session is None:
         return fail(lock_fail_msg)
 
     #===
@@ -475,19 +808,193 @@ def push_file(request: Request, context: ConnectionContext) -> Responce:
     if any(True for item in re.split(r'\\|/', file_path) if item in ['..', '.']): return fail()
 
     #===
-    tmp_path = cpjoin(repository_path, 'tmp_file')
-    with open(tmp_path, 'wb') as f:
-        while True:
-            chunk = request.body.read(1000 * 1000)
-            if chunk is None: break
-            f.write(chunk)
+    # Hash the file as it is received, so it does not have to be read back to store it
+    tmp_path = new_upload_tmp_path(repository_path)
+    hasher = hashlib.sha256()
+
+    try:
+        request.body.write_to_file(tmp_path, hasher)
+    except:
+        ignore(os.remove, tmp_path)
+        raise
 
     #===
-    file_info = data_store.fs_put_from_file(tmp_path, {'path' : file_path})
+    with session.mutex:
+        file_info = data_store.fs_put_from_file(tmp_path, {'path' : file_path}, hasher.hexdigest())
 
     return success({'file_info_json' : json.dumps(file_info)})
 
 
+#===============================================================================
+def new_upload_tmp_path(repository_path: str) -> str:
+    """ Uploads in the same commit session may be received concurrently, so each needs it's own temporary file """
+
+    fd, tmp_path = tempfile.mkstemp(prefix = 'tmp_file_', dir = repository_path)
+    os.close(fd)
+    return tmp_path
+
+
+#===============================================================================
+def record_received_files(data_store: versioned_storage, session: commit_session, received):
+    """ Move received files into the store and record them in the active commit, returns
+    the files recorded, which is none of them if the session ended while receiving """
+
+    with session.mutex:
+        if not session.active:
+            for file_info in received: ignore(os.remove, file_info['tmp_path'])
+            return []
+
+        data_store.store_files([(file_info.pop('tmp_path'), file_info['hash']) for file_info in received])
+        data_store.add_stored_files_to_commit(received)
+
+    return received
+
+
+#===============================================================================
+@route('push_files')
+def push_files(request: Request, context: ConnectionContext) -> Responce:
+    """ Push many files to the server in a framed request body. Each frame holds the
+    path of a file and it's contents. If the upload is interrupted, the files which
+    were completely received are still recorded in the active commit. """
+
+    session_token = request.headers['session_token'].encode('utf8')
+    repository    = request.headers['repository']
+
+    #===
+    current_user = have_authenticated_user(request.remote_addr, repository, session_token)
+    if current_user is False: return fail(user_auth_fail_msg)
+
+    #===
+    repository_path = config['repositories'][repository]['path']
+
+    #===
+    session = get_commit_session(context)
+    if session is None:
+        return fail(lock_fail_msg)
+
+    #===
+    data_store = versioned_storage(repository_path,
+                                   path_override = config['repositories'][repository]['transient_db_path_override'])
+
+    if data_store.get_active_commit() is None: return fail(no_active_commit_msg)
+
+    #===
+    received = []
+    recorded = []
+
+    try:
+        for frame_info, frame in read_frames(request.body):
+            # There is no valid reason for path traversal characters to be in a file path within this system
+            file_path = frame_info['path']
+            if any(True for item in re.split(r'\\|/', file_path) if item in ['..', '.']): return fail()
+
+            tmp_path = new_upload_tmp_path(repository_path)
+            hasher = hashlib.sha256()
+
+            try: frame.write_to_file(tmp_path, hasher)
+            except:
+                ignore(os.remove, tmp_path)
+                raise
+
+            received.append({'path' : file_path, 'hash' : hasher.hexdigest(), 'tmp_path' : tmp_path})
+
+            # Files are received concurrently on each connection in the session, moving
+            # them into the store and recording them in the active commit is serialised
+            if len(received) >= 100:
+                recorded += record_received_files(data_store, session, received)
+                received = []
+
+    finally:
+        recorded += record_received_files(data_store, session, received)
+
+    return success({}, {'files' : recorded})
+
+
+#===============================================================================
+@route('stage_files')
+def stage_files(request: Request, context: ConnectionContext) -> Responce: # pylint: disable=W0613
+    """ Upload files to the staging area in a framed request body, as push_files. This
+    does not require the write lock, allowing large uploads to happen while other
+    clients are committing. Staged files are added to a commit using add_staged. """
+
+    session_token = request.headers['session_token'].encode('utf8')
+    repository    = request.headers['repository']
+
+    #===
+    current_user = have_authenticated_user(request.remote_addr, repository, session_token)
+    if current_user is False: return fail(user_auth_fail_msg)
+
+    #===
+    repository_path = config['repositories'][repository]['path']
+
+    data_store = versioned_storage(repository_path,
+                                   path_override = config['repositories'][repository]['transient_db_path_override'])
+
+    #===
+    staged = []
+    for frame_info, frame in read_frames(request.body):
+        tmp_path = new_upload_tmp_path(repository_path)
+        hasher = hashlib.sha256()
+
+        try: frame.write_to_file(tmp_path, hasher)
+        except:
+            ignore(os.remove, tmp_path)
+            raise
+
+        data_store.stage_file(tmp_path, hasher.hexdigest())
+        staged.append({'path' : frame_info['path'], 'hash' : hasher.hexdigest()})
+
+    return success({}, {'files' : staged})
+
+
+#===============================================================================
+@route('add_staged')
+def add_staged(request: Request, context: ConnectionContext) -> Responce:
+    """ Add files which have been staged to the active commit. Files which are not in
+    the staging area, because they were garbage collected, are returned as missing
+    and must be pushed again. """
+
+    session_token = request.headers['session_token'].encode('utf8')
+    repository    = request.headers['repository']
+
+    #===
+    current_user = have_authenticated_user(request.remote_addr, repository, session_token)
+    if current_user is False: return fail(user_auth_fail_msg)
+
+    #===
+    repository_path = config['repositories'][repository]['path']
+    body_data = request.get_json()
+
+    #===
+    session = get_commit_session(context)
+    if session is None:
+        return fail(lock_fail_msg)
+
+    #===
+    data_store = versioned_storage(repository_path,
+                                   path_override = config['repositories'][repository]['transient_db_path_override'])
+
+    if data_store.get_active_commit() is None: return fail(no_active_commit_msg)
+
+    #===
+    files = body_data['files']
+
+    # There is no valid reason for path traversal characters to be in a file path within this system
+    for file_info in files:
+        if any(True for item in re.split(r'\\|/', file_info['path']) if item in ['..', '.']): return fail()
+        if re.fullmatch('[0-9a-f]{64}', file_info['hash']) is None: return fail('Invalid object hash')
+
+    with session.mutex:
+        stored = data_store.store_staged_files([file_info['hash'] for file_info in files])
+
+        added   = [{'path' : f['path'], 'hash' : f['hash']} for f in files if f['hash'] in stored]
+        missing = [f['path'] for f in files if f['hash'] not in stored]
+
+        data_store.add_stored_files_to_commit(added)
+
+    return success({}, {'files' : added, 'missing' : missing})
+
+
 #===============================================================================
 @route('delete_files')
 def delete_files(request: Request, context: ConnectionContext) -> Responce:
@@ -505,7 +1012,8 @@ def delete_files(request: Request, context: ConnectionContext) -> Responce:
     body_data = request.get_json()
 
     #===
-    if not context.lock:
+    session = get_commit_session(context)
+    if session is None:
         return fail(lock_fail_msg)
 
     #===
@@ -517,7 +1025,8 @@ def delete_files(request: Request, context: ConnectionContext) -> Responce:
 
         #-------------
         to_delete = json.loads(body_data['files'])
-        data_store.fs_delete(to_delete)
+        with session.mutex:
+            data_store.fs_delete(to_delete)
 
         return success()
 
@@ -541,7 +1050,8 @@ def commit(request: Request, context: ConnectionContext) -> Responce:
     repository_path = config['repositories'][repository]['path']
 
     #===
-    if not context.lock:
+    session = get_commit_session(context)
+    if session is None:
         return fail(lock_fail_msg)
 
     #===
@@ -550,13 +1060,30 @@ def commit(request: Request, context: ConnectionContext) -> Responce:
 
     if data_store.get_active_commit() is None: return fail(no_active_commit_msg)
 
+    body_data = request.get_json()
+
     result = {}
-    if request.headers['mode'] == 'commit':
-        new_head = data_store.commit(request.headers['commit_message'], current_user['username'])
-        result = {'head' : new_head}
-    else:
-        data_store.rollback()
+    overlapping = []
+    with session.mutex:
+        if request.headers['mode'] == 'commit':
+            head = data_store.get_head()
+            if session.base_revision != head:
+                overlapping = data_store.find_overlapping_changes(session.base_revision, head,
+                                                                  data_store.get_active_commit_changes(),
+                                                                  body_data.get('base_hashes', {}))
+
+            if overlapping != []:
+                data_store.rollback()
+            else:
+                new_head = data_store.commit(request.headers['commit_message'], current_user['username'])
+                result = {'head' : new_head, 'rebased' : str(int(session.base_revision != head))}
+        else:
+            data_store.rollback()
+
+        # Release the lock for every connection in the session
+        end_commit_session(session)
 
     # --------------------------
     context.shutdown_handler()
+    if overlapping != []: return fail(need_to_update_msg)
     return success(result)
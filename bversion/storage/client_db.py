@@ -28,15 +28,77 @@ class client_db:
                 path     Text,
                 last_mod Text,
                 created  Text,
-                server_file_hash Text
+                server_file_hash Text,
+                size     Integer,
+                inode    Integer
             )
             """)
 
+        # The size and inode identify the file server_file_hash was verified against,
+        # manifests made before they were recorded gain the columns empty
+        columns = [col['name'] for col in self.cur.execute("pragma table_info(files)").fetchall()]
+        for column in ['size', 'inode']:
+            if column not in columns: self.cur.execute("alter table files add column " + column + " Integer")
+
         self.cur.execute( """
             create unique index if not exists idx_path
             on files (path asc);
             """)
 
+        # ----------
+        # Files uploaded to the servers staging area which have not yet been committed
+        self.cur.execute( """
+            create table if not exists staged_files (
+                path     Text,
+                last_mod Text,
+                hash     Text
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_staged_path
+            on staged_files (path asc);
+            """)
+
+        # ----------
+        # Listings of directories in the working copy, allowing unchanged directories to be
+        # scanned without reading them again
+        self.cur.execute( """
+            create table if not exists dirs (
+                path     Text,
+                mtime_ns Text,
+                files    Text,
+                dirs     Text
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_dirs_path
+            on dirs (path asc);
+            """)
+
+        # ----------
+        # Paths changed in the working copy since the last full scan, recorded by 'bvn watch'
+        self.cur.execute( """
+            create table if not exists dirty_paths (
+                id   Integer primary key autoincrement,
+                path Text
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_dirty_path
+            on dirty_paths (path asc);
+            """)
+
+        self.cur.execute( """
+            create table if not exists watch_state (
+                watcher_pid   Integer,
+                journal_valid Integer,
+                sync_token    Text
+            )
+            """)
+
         # ----------
         self.cur.execute( """
             create table if not exists journal (
@@ -45,9 +107,13 @@ class client_db:
             """)
 
         self.init_system_meta()
+        self.init_watch_state()
 
         self.con.commit()
 
+        # Changes to the manifest are recorded in the dirty path journal while a watcher is running
+        self.journal_enabled = self.get_watch_state()['watcher_pid'] is not None
+
 
     # --------------
     def commit(self):
@@ -118,6 +184,17 @@ class client_db:
         res = prep_manifest_result(res.fetchall())
         return {fle['path'] : fle for fle in res}
 
+    # --------------
+    def iter_manifest(self):
+        """ Manifest records as compact tuples ordered by path, which are read from the
+        database as they are used """
+
+        cur = self.con.cursor()
+        cur.row_factory = None
+        for path, last_mod, created, server_file_hash in cur.execute(
+                "select path, last_mod, created, server_file_hash from files order by path"):
+            yield (path, float(last_mod), float(created), server_file_hash)
+
     # --------------
     def get_single_file_from_manifest(self, path):
         res = self.cur.execute("select * from files where path = ?", (path,))
@@ -134,8 +211,12 @@ class client_db:
                 path,
                 last_mod,
                 created,
-                server_file_hash
+                server_file_hash,
+                size,
+                inode
             ) values (
+                ?,
+                ?,
                 ?,
                 ?,
                 ?,
@@ -144,8 +225,101 @@ class client_db:
                 file_info['path'],
                 str(file_info['last_mod']),
                 str(file_info['created']),
-                file_info['server_file_hash']))
+                file_info['server_file_hash'],
+                file_info.get('size'),
+                file_info.get('inode')))
 
     # --------------
     def remove_file_from_manifest(self, path):
         self.cur.execute("delete from files where path = ?", (path,))
+        if self.journal_enabled: self.add_dirty_paths([path])
+
+
+# ===================================================
+# Handling of staged files
+# ===================================================
+    def get_staged_files(self):
+        res = self.cur.execute("select * from staged_files").fetchall()
+        return {fle['path'] : dict(fle, last_mod = float(fle['last_mod'])) for fle in res}
+
+    # --------------
+    def add_staged_file(self, path, last_mod, file_hash):
+        self.cur.execute("insert or replace into staged_files (path, last_mod, hash) values (?, ?, ?)",
+                         (path, str(last_mod), file_hash))
+
+    # --------------
+    def clear_staged_files(self):
+        self.cur.execute("delete from staged_files")
+
+
+# ===================================================
+# Handling of directory listings
+# ===================================================
+    def get_dir_listings(self):
+        res = self.cur.execute("select * from dirs").fetchall()
+        return {row['path'] : {'mtime_ns' : int(row['mtime_ns']),
+                               'files'    : json.loads(row['files']),
+                               'dirs'     : json.loads(row['dirs'])} for row in res}
+
+    # --------------
+    def update_dir_listings(self, updated, removed):
+        self.cur.executemany("insert or replace into dirs (path, mtime_ns, files, dirs) values (?, ?, ?, ?)",
+                             [(path, str(listing['mtime_ns']), json.dumps(listing['files']), json.dumps(listing['dirs']))
+                              for path, listing in updated.items()])
+
+        self.cur.executemany("delete from dirs where path = ?", [(path,) for path in removed])
+
+
+# ===================================================
+# Handling of the dirty path journal. The journal is only valid while a watcher
+# is running, and has been running since the last full scan of the working copy.
+# ===================================================
+    def init_watch_state(self):
+        if self.cur.execute("select rowid from watch_state").fetchone() is None:
+            self.cur.execute("insert into watch_state (watcher_pid, journal_valid) values (null, 0)")
+
+    # --------------
+    def get_watch_state(self):
+        return self.cur.execute("select watcher_pid, journal_valid, sync_token from watch_state").fetchone()
+
+    # --------------
+    def register_watcher(self, pid):
+        """ A new watcher has no record of changes made before it started """
+        self.cur.execute("update watch_state set watcher_pid = ?, journal_valid = 0, sync_token = null", (pid,))
+        self.cur.execute("delete from dirty_paths")
+
+    # --------------
+    def unregister_watcher(self, pid):
+        self.cur.execute("update watch_state set watcher_pid = null, journal_valid = 0 where watcher_pid = ?", (pid,))
+
+    # --------------
+    def invalidate_journal(self):
+        self.cur.execute("update watch_state set journal_valid = 0")
+
+    # --------------
+    def reset_journal(self):
+        """ Called before a full scan, changes made during the scan are journaled """
+        self.cur.execute("update watch_state set journal_valid = 1")
+        self.cur.execute("delete from dirty_paths")
+
+    # --------------
+    def set_sync_token(self, token):
+        self.cur.execute("update watch_state set sync_token = ?", (token,))
+
+    # --------------
+    def add_dirty_paths(self, paths):
+        self.cur.executemany("insert or replace into dirty_paths (path) values (?)", [(path,) for path in paths])
+
+    # --------------
+    def get_dirty_paths(self):
+        return self.cur.execute("select id, path from dirty_paths").fetchall()
+
+    # --------------
+    def remove_dirty_path(self, dirty_path):
+        """ Removes a dirty path, unless it has been dirtied again since it was read """
+        self.cur.execute("delete from dirty_paths where id = ? and path = ?", (dirty_path['id'], dirty_path['path']))
+
+    # --------------
+    def get_manifest_files_below(self, dir_path):
+        res = self.cur.execute("select * from files where path > ? and path < ?", (dir_path + '/', dir_path + '0'))
+        return prep_manifest_result(res.fetchall())
@@ -1,13 +1,13 @@
 import sqlite3
 
-def init_db(db_file_path):
+def init_db(db_file_path, cached_statements = 128):
     def dict_factory(cursor, row):
         d = {}
         for idx, col in enumerate(cursor.description):
             d[col[0]] = row[idx]
         return d
 
-    con = sqlite3.connect(db_file_path)
+    con = sqlite3.connect(db_file_path, cached_statements = cached_statements)
     con.row_factory = dict_factory
 
     cur = con.cursor()
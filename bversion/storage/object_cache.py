@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+#===============================================================================
+# Index objects are content addressed and never change once written, so the
+# parsed form of an object can be shared between every request handled by the
+# process. Cached objects are shared, callers must copy anything they intend
+# to modify.
+#===============================================================================
+class lru_object_cache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.items: 'OrderedDict[str, Tuple[Any, int]]' = OrderedDict()
+        self.total_bytes = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.mutex       = threading.Lock()
+
+
+#===============================================================================
+    def configure(self, max_entries: int, max_bytes: int) -> None:
+        with self.mutex:
+            self.max_entries = max_entries
+            self.max_bytes   = max_bytes
+            self.evict()
+
+
+#===============================================================================
+    def get(self, key: str) -> Any:
+        with self.mutex:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+
+#===============================================================================
+    def put(self, key: str, value: Any, size: int) -> None:
+        """ Add an item to the cache, size is the approximate cost of
+        the item in bytes, normally it's serialised length """
+
+        with self.mutex:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return
+
+            if size > self.max_bytes: return
+
+            self.items[key] = (value, size)
+            self.total_bytes += size
+            self.evict()
+
+
+#===============================================================================
+    def evict(self) -> None:
+        while len(self.items) > self.max_entries or self.total_bytes > self.max_bytes:
+            size = self.items.popitem(last=False)[1][1]
+            self.total_bytes -= size
+
+
+#===============================================================================
+    def clear(self) -> None:
+        with self.mutex:
+            self.items.clear()
+            self.total_bytes = 0
+            self.hits        = 0
+            self.misses      = 0
+
+
+#===============================================================================
+    def stats(self) -> Dict[str, int]:
+        with self.mutex:
+            return {'entries' : len(self.items),
+                    'bytes'   : self.total_bytes,
+                    'hits'    : self.hits,
+                    'misses'  : self.misses}
+
+
+#===============================================================================
+index_object_cache = lru_object_cache(max_entries = 200000, max_bytes = 256 * 1024 * 1024)
@@ -0,0 +1,228 @@
+import os, os.path, mmap, struct, hashlib, threading
+from typing import List, Dict, Optional, Tuple
+
+import bversion.common as sfs
+
+#===============================================================================
+# Packed storage for index objects
+#
+# Index objects are written as individual 'loose' files by versioned_storage.
+# Large repositories end up with hundreds of thousands of these, and reading a
+# tree then costs an open and read for every directory. Packs concatenate many
+# objects into a single append only file, with a separate sorted index mapping
+# object hashes to offsets within it.
+#
+# Pack file layout:
+#
+#     'BVNPACK1'
+#     repeated: 32 byte binary hash, 4 byte big endian length, serialised object
+#
+# Index file layout:
+#
+#     'BVNIDX01', 4 byte object count
+#     256 entry fanout table of 4 byte counts, entry n being the number of
+#     objects whose first hash byte is <= n
+#     sorted entries: 32 byte binary hash, 8 byte offset, 4 byte length
+#
+# The index is written after the pack and renamed into place, thus a pack is
+# only visible to readers once it is complete.
+#===============================================================================
+pack_magic   = b'BVNPACK1'
+index_magic  = b'BVNIDX01'
+
+record_header = struct.Struct('>32sI')
+index_header  = struct.Struct('>8sI')
+fanout_table  = struct.Struct('>256I')
+index_entry   = struct.Struct('>32sQI')
+
+fanout_offset  = index_header.size
+entries_offset = index_header.size + fanout_table.size
+
+
+#+++++++++++++++++++++++++++++++++
+class pack_file:
+    """ Read only access to a single pack and it's index """
+
+    def __init__(self, pack_path: str, index_path: str):
+        self.pack_path = pack_path
+
+        with open(index_path, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = index_header.unpack_from(self.index, 0)
+        if magic != index_magic: raise IOError('Invalid pack index: ' + index_path)
+
+        self.fanout = fanout_table.unpack_from(self.index, fanout_offset)
+
+        with open(pack_path, 'rb') as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.pack[:len(pack_magic)] != pack_magic: raise IOError('Invalid pack: ' + pack_path)
+
+
+#===============================================================================
+    def entry_at(self, i: int) -> Tuple[bytes, int, int]:
+        return index_entry.unpack_from(self.index, entries_offset + i * index_entry.size)
+
+
+#===============================================================================
+    def find(self, binary_hash: bytes) -> Optional[Tuple[int, int]]:
+        """ Binary search the index for a hash, bounded using the fanout table """
+
+        first_byte = binary_hash[0]
+        low  = 0 if first_byte == 0 else self.fanout[first_byte - 1]
+        high = self.fanout[first_byte]
+
+        while low < high:
+            mid = (low + high) // 2
+            entry_hash, offset, length = self.entry_at(mid)
+            if entry_hash < binary_hash:   low = mid + 1
+            elif entry_hash > binary_hash: high = mid
+            else: return offset, length
+
+        return None
+
+
+#===============================================================================
+    def read(self, binary_hash: bytes) -> Optional[bytes]:
+        location = self.find(binary_hash)
+        if location is None: return None
+        offset, length = location
+        return self.pack[offset : offset + length]
+
+
+#===============================================================================
+    def hashes(self) -> List[str]:
+        return [self.entry_at(i)[0].hex() for i in range(self.count)]
+
+
+#===============================================================================
+# Packs are immutable once written so opened packs are shared by every
+# versioned_storage instance in the process.
+#===============================================================================
+open_packs: Dict[str, pack_file] = {}
+open_packs_lock = threading.Lock()
+
+def get_pack(pack_path: str, index_path: str) -> pack_file:
+    with open_packs_lock:
+        if pack_path not in open_packs:
+            open_packs[pack_path] = pack_file(pack_path, index_path)
+        return open_packs[pack_path]
+
+
+#+++++++++++++++++++++++++++++++++
+class pack_store:
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self.packs: List[pack_file] = []
+        self.known_packs: Dict[str, None] = {}
+        self.have_scanned = False
+
+
+#===============================================================================
+    def scan(self) -> bool:
+        """ Look for packs which have been created since the last scan, returns
+        true if any new packs were found """
+
+        self.have_scanned = True
+
+        try: listing = os.listdir(self.pack_dir)
+        except FileNotFoundError: return False
+
+        found_new = False
+        for name in sorted(listing):
+            if not name.endswith('.idx'): continue
+
+            pack_name = name[:-len('.idx')]
+            if pack_name in self.known_packs: continue
+
+            pack_path = sfs.cpjoin(self.pack_dir, pack_name + '.pack')
+            self.packs.append(get_pack(pack_path, sfs.cpjoin(self.pack_dir, name)))
+            self.known_packs[pack_name] = None
+            found_new = True
+
+        return found_new
+
+
+#===============================================================================
+    def read(self, object_hash: str) -> Optional[bytes]:
+        """ Read an object from the packs, rescanning the pack directory once if it
+        is not found, as another process may have packed it since the last scan """
+
+        if not self.have_scanned: self.scan()
+
+        binary_hash = bytes.fromhex(object_hash)
+        for rescan in [False, True]:
+            if rescan and not self.scan(): break
+
+            for pack in self.packs:
+                data = pack.read(binary_hash)
+                if data is not None: return data
+
+        return None
+
+
+#===============================================================================
+    def contains(self, object_hash: str) -> bool:
+        if not self.have_scanned: self.scan()
+
+        binary_hash = bytes.fromhex(object_hash)
+        return any(pack.find(binary_hash) is not None for pack in self.packs)
+
+
+#===============================================================================
+    def all_hashes(self) -> Dict[str, str]:
+        """ Returns a dict of every packed object hash and the pack containing it """
+
+        self.scan()
+        return {object_hash : pack.pack_path for pack in self.packs for object_hash in pack.hashes()}
+
+
+#===============================================================================
+    def write_pack(self, objects: Dict[str, bytes]) -> Optional[str]:
+        """ Write a new pack containing the passed objects, keyed by hash """
+
+        if len(objects) == 0: return None
+
+        sorted_hashes = sorted(objects.keys())
+        pack_name = 'pack-' + hashlib.sha256(''.join(sorted_hashes).encode('utf8')).hexdigest()
+        pack_path  = sfs.cpjoin(self.pack_dir, pack_name + '.pack')
+        index_path = sfs.cpjoin(self.pack_dir, pack_name + '.idx')
+
+        if os.path.isfile(index_path): return pack_name
+
+        sfs.make_dirs_if_dont_exist(self.pack_dir + '/')
+
+        # Write the pack
+        entries = []
+        with open(pack_path + '.tmp', 'wb') as f:
+            f.write(pack_magic)
+            offset = len(pack_magic)
+
+            for object_hash in sorted_hashes:
+                data = objects[object_hash]
+                binary_hash = bytes.fromhex(object_hash)
+                f.write(record_header.pack(binary_hash, len(data)))
+                f.write(data)
+
+                offset += record_header.size
+                entries.append((binary_hash, offset, len(data)))
+                offset += len(data)
+
+            f.flush(); os.fsync(f.fileno())
+
+        # Write the index
+        fanout = [0] * 256
+        for binary_hash, _, _ in entries: fanout[binary_hash[0]] += 1
+        for i in range(1, 256): fanout[i] += fanout[i - 1]
+
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(index_header.pack(index_magic, len(entries)))
+            f.write(fanout_table.pack(*fanout))
+            for entry in entries: f.write(index_entry.pack(*entry))
+            f.flush(); os.fsync(f.fileno())
+
+        os.rename(pack_path + '.tmp', pack_path)
+        os.rename(index_path + '.tmp', index_path)
+
+        return pack_name
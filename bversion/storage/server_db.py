@@ -1,10 +1,14 @@
 import base64, threading, time
-from copy import deepcopy
+from contextlib import contextmanager
 import pysodium
 
 from bversion.common import cpjoin
 from bversion.storage.db_common import init_db
 
+#=====================================================
+# Connections are kept for each thread, as an sqlite connection can only be used
+# by the thread which created it, and for each database, so that a thread serving
+# requests for several repositories does not reconnect when it switches between them.
 #=====================================================
 threadLocal = threading.local()
 
@@ -13,30 +17,62 @@ def get_server_db_instance_for_thread(db_file_path, need_to_recreate = False, pa
     if path_override is not None:
         db_file_path = path_override
 
-    old_db_path = getattr(threadLocal, 'old_db_path', '')
-    if old_db_path != db_file_path:
-        need_to_recreate = True
+    db_instances = getattr(threadLocal, 'db_instances', None)
+    if db_instances is None:
+        db_instances = threadLocal.db_instances = {}
 
-    db_instance = getattr(threadLocal, 'db_instance', None)
-    if db_instance is None:
-        need_to_recreate = True
+    if need_to_recreate and db_file_path in db_instances:
+        db_instances.pop(db_file_path).con.close()
 
-    if need_to_recreate:
-        threadLocal.db_instance = server_db(db_file_path, path_override = path_override)
-        threadLocal.old_db_path = db_file_path
+    if db_file_path not in db_instances:
+        db_instances[db_file_path] = server_db(db_file_path, path_override = path_override)
 
-    return threadLocal.db_instance
+    return db_instances[db_file_path]
 
 
 #=====================================================
 class server_db:
     def __init__(self, base_path : str, path_override = None):
         if path_override is not None:
-            self.con, self.cur = init_db(path_override)
+            self.con, self.cur = init_db(path_override, cached_statements = 256)
         else:
-            self.con, self.cur = init_db(cpjoin(base_path, 'server_transient.db'))
+            self.con, self.cur = init_db(cpjoin(base_path, 'server_transient.db'), cached_statements = 256)
+
+        # The write ahead log allows requests to read while another writes, and only
+        # needs to sync when it is checkpointed. Committed transactions survive the
+        # server process crashing, power loss can lose the most recent of them but
+        # cannot corrupt the database.
+        self.con.execute('pragma journal_mode = wal')
+        self.con.execute('pragma synchronous = normal')
+
+        self.in_transaction = False
 
-        self.active_files = None
+
+    #===============================================================================
+    @contextmanager
+    def transaction(self):
+        """ Group the writes made in a block into a single transaction, which is rolled
+        back if the block raises. A block within another joins the outer transaction. """
+
+        if self.in_transaction:
+            yield; return
+
+        self.in_transaction = True
+        try:
+            yield
+            self.con.commit()
+        except:
+            self.con.rollback()
+            raise
+        finally:
+            self.in_transaction = False
+
+
+    #===============================================================================
+    def commit(self):
+        """ Commit, unless in a transaction block which will commit when it completes """
+
+        if not self.in_transaction: self.con.commit()
 
 
 #===============================================================================
@@ -98,6 +134,89 @@ class server_db:
             on active_commit_changes (path asc);
             """)
 
+        # ======================
+        # Flattened file manifests of commits, derived from the tree objects and
+        # built on demand. A commit only has a usable manifest if it is listed
+        # in manifest_commits, as rows are written in the same transaction.
+        self.con.execute("""
+            create table if not exists manifest_commits (
+                commit_hash Text,
+                created     int
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_manifest_commits
+            on manifest_commits (commit_hash asc);
+            """)
+
+        self.con.execute("""
+            create table if not exists manifest_files (
+                commit_hash Text,
+                path        Text,
+                hash        Text,
+                status      Text
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_manifest_files
+            on manifest_files (commit_hash asc, path asc);
+            """)
+
+        # ======================
+        # Commit graph, an index of the commit chain from the first commit to head.
+        # Generation is the distance of a commit from the root, the changes made by
+        # each commit are stored in the change log under the same generation.
+        self.con.execute("""
+            create table if not exists commit_graph (
+                commit_hash    Text,
+                parent         Text,
+                generation     int,
+                utc_date_time  Text,
+                commit_by      Text,
+                commit_message Text
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_commit_graph_hash
+            on commit_graph (commit_hash asc);
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_commit_graph_generation
+            on commit_graph (generation asc);
+            """)
+
+        self.con.execute("""
+            create table if not exists commit_change_log (
+                generation int,
+                hash       Text,
+                path       Text,
+                status     Text
+            )
+            """)
+
+        self.cur.execute( """
+            create index if not exists idx_commit_change_log_generation
+            on commit_change_log (generation asc);
+            """)
+
+        # ======================
+        # Blobs which have been uploaded to the staging area but not yet committed
+        self.con.execute("""
+            create table if not exists staged_blobs (
+                hash        Text,
+                staged_time Real
+            )
+            """)
+
+        self.cur.execute( """
+            create unique index if not exists idx_staged_blobs_hash
+            on staged_blobs (hash asc);
+            """)
+
         # ======================
         # Table to store if there is an active commit
         self.con.execute("""
@@ -119,7 +238,7 @@ class server_db:
 
         self.con.execute("insert into tokens (expires, token, ip) values (?,?,?)",
                         (time.time() + 30, auth_token, remote_addr))
-        self.con.commit()
+        self.commit()
 
         return auth_token
 
@@ -132,7 +251,7 @@ class server_db:
     #===============================================================================
     def delete_token(self, auth_token):
         self.con.execute("delete from tokens where token = ?", (auth_token,))
-        self.con.commit()
+        self.commit()
 
 
     #===============================================================================
@@ -140,7 +259,7 @@ class server_db:
         """ Garbage collection for expired authentication tokens """
 
         self.con.execute("delete from tokens where expires < ?", (time.time(),))
-        self.con.commit()
+        self.commit()
 
 
 #===============================================================================
@@ -150,7 +269,7 @@ class server_db:
         session_token = base64.b64encode(pysodium.randombytes(35))
         self.con.execute("insert into session_tokens (token, expires, ip, username) values (?,?,?,?)",
                         (session_token, time.time() + extend_session_duration, client_ip, user))
-        self.con.commit()
+        self.commit()
 
         return session_token
 
@@ -162,9 +281,12 @@ class server_db:
 
 
     #===============================================================================
-    def update_session_token_expiry(self, extend_session_duration, session_token, client_ip):
-        self.con.execute("update session_tokens set expires = ? where token = ? and ip = ?",
-                         (time.time() + extend_session_duration, session_token, client_ip))
+    def write_sessions(self, sessions):
+        """ Write the expiry of many sessions, sessions which have been garbage collected
+        by another process since they were read are written again """
+
+        self.con.executemany("insert or replace into session_tokens (token, expires, ip, username) values (?,?,?,?)",
+                             [(it['token'], it['expires'], it['ip'], it['username']) for it in sessions])
 
 
     #===============================================================================
@@ -178,14 +300,6 @@ class server_db:
                              (time.time(),))
 
 
-    #===============================================================================
-    def validate_session(self, session_token : str, client_ip : str):
-        self.con.execute("delete from session_tokens where expires < ?", (time.time(),))
-        self.con.commit()
-
-        res = self.con.execute("select * from session_tokens where token = ? and ip = ?", (session_token, client_ip)).fetchall()
-        return res
-
 
 #===============================================================================
 # Storage for transient commit data
@@ -200,10 +314,7 @@ class server_db:
 
 
     #===============================================================================
-    def begin_commit(self, active_files, user, user_ip, session_token):
-        # Add the existing files to the commit
-        self.active_files = active_files
-
+    def begin_commit(self, user, user_ip, session_token):
         # Ensure commit changes is empty
         self.con.execute("delete from active_commit_changes")
 
@@ -212,52 +323,43 @@ class server_db:
                          (user, user_ip, session_token))
 
         # ----------
-        self.con.commit()
+        self.commit()
 
 
     #===============================================================================
-    def resume_commit(self, active_files, session_token):
-        # Add the existing files to the commit
-        self.active_files = active_files
-
+    def resume_commit(self, session_token):
         self.con.execute("update active_commit_exists set session_token = ?", (session_token,))
-        self.con.commit()
-
-    #===============================================================================
-    def file_exists_in_commit(self, file_path):
-        if self.active_files is None: raise Exception('active files not initilised')
-
-        result = []
-        if file_path in self.active_files:
-            result.append(self.active_files[file_path])
-
-        return result
-
+        self.commit()
 
     #===============================================================================
     def add_to_commit(self, file_info):
-
-        file_info['status'] = 'changed' if self.file_exists_in_commit (file_info['path']) != [] else 'new'
+        """ Record a new or changed file, file_info must include the status """
 
         # Update commit changes
-        self.con.execute("insert into active_commit_changes (hash, path, status) values (?, ?, ?)",
+        self.con.execute("insert or replace into active_commit_changes (hash, path, status) values (?, ?, ?)",
                          (file_info['hash'], file_info['path'], file_info['status']))
 
-        self.con.commit()
+        self.commit()
 
         return file_info
 
 
+    #===============================================================================
+    def add_many_to_commit(self, file_infos):
+        """ Record many new or changed files in a single transaction """
+
+        self.con.executemany("insert or replace into active_commit_changes (hash, path, status) values (?, ?, ?)",
+                             [(it['hash'], it['path'], it['status']) for it in file_infos])
+
+        self.commit()
+
+
     #===============================================================================
     def remove_from_commit(self, files):
+        """ Record deleted files, files must be the file info of files in the head commit """
 
         for it in files:
-            file_path = it['path']
-
-            # We don't need to do anything if the file doesnt exist
-            the_file = self.file_exists_in_commit(file_path)
-            if the_file == []: return
-            file_info = the_file[0]
+            file_info = dict(it)
 
             # Update commit changes
             already_deleted = self.con.execute("select * from active_commit_changes where status='deleted' and path = ?",
@@ -265,36 +367,17 @@ class server_db:
 
             if already_deleted == []:
                 file_info['status'] = 'deleted'
-                self.con.execute("insert into active_commit_changes (hash, path, status) values (?, ?, ?)",
+                self.con.execute("insert or replace into active_commit_changes (hash, path, status) values (?, ?, ?)",
                                 (file_info['hash'], file_info['path'], file_info['status']))
 
-        self.con.commit()
+        self.commit()
 
     #===============================================================================
     def get_active_commit_changes(self):
         return self.con.execute("select * from active_commit_changes").fetchall()
 
-    #===============================================================================
-    def get_commit_state(self):
-        if self.active_files is None: raise Exception('active files not initilised')
-
-        current_changes = self.get_active_commit_changes()
-
-        for item in current_changes:
-            if item['status'] in ['new', 'changed']:
-                # we must deep copy this or changes to active files
-                # also affects changes
-                self.active_files[item['path']] = deepcopy(item)
-
-            elif item['status'] == 'deleted':
-                del self.active_files[item['path']]
-
-        return current_changes, self.active_files
-
-
     #===============================================================================
     def clean_commit_state(self):
-        self.active_files = None
         self.con.execute("delete from active_commit_changes")
         self.con.execute("delete from gc_log")
         self.con.execute("delete from active_commit_exists")
@@ -304,11 +387,127 @@ class server_db:
 # Storage of GC log
 #===============================================================================
     def gc_log_item(self, item_type: str, item_hash: str) -> None:
-        self.con.execute("insert into gc_log (item_type, item_hash) values (?,?)",
-                         (item_type, item_hash))
+        self.gc_log_items([(item_type, item_hash)])
+
+
+    #===============================================================================
+    def gc_log_items(self, items) -> None:
+        """ Log (item_type, item_hash) pairs. The log is always committed immediately, as it
+        must be stored before the objects are written, thus this cannot be used in a transaction """
+
+        if self.in_transaction: raise Exception('The gc log cannot be written within a transaction')
+
+        self.con.executemany("insert into gc_log (item_type, item_hash) values (?,?)", items)
         self.con.commit()
 
 
     #===============================================================================
     def get_gc_log(self):
         return self.con.execute("select * from gc_log").fetchall()
+
+
+#===============================================================================
+# Staged blobs
+#===============================================================================
+    def stage_blob(self, blob_hash: str) -> None:
+        self.con.execute("insert or replace into staged_blobs (hash, staged_time) values (?, ?)",
+                         (blob_hash, time.time()))
+        self.commit()
+
+
+    #===============================================================================
+    def unstage_blob(self, blob_hash: str) -> None:
+        self.con.execute("delete from staged_blobs where hash = ?", (blob_hash,))
+        self.commit()
+
+
+    #===============================================================================
+    def get_staged_blobs_before(self, staged_time: float):
+        return [row['hash'] for row in
+                self.con.execute("select hash from staged_blobs where staged_time < ?", (staged_time,)).fetchall()]
+
+
+#===============================================================================
+# Cache of flattened commit manifests
+#===============================================================================
+    def get_commit_manifest(self, commit_hash: str):
+        res = self.con.execute("select * from manifest_commits where commit_hash = ?", (commit_hash,)).fetchall()
+        if res == []: return None
+
+        rows = self.con.execute("select hash, path, status from manifest_files where commit_hash = ?", (commit_hash,))
+        return {row['path'] : row for row in rows}
+
+
+    #===============================================================================
+    def store_commit_manifest(self, commit_hash: str, files, keep_manifests: int) -> None:
+        """ Store the manifest of a commit, removing the oldest stored manifests
+        so that at most keep_manifests are retained """
+
+        self.con.executemany("insert or ignore into manifest_files (commit_hash, path, hash, status) values (?,?,?,?)",
+                             ((commit_hash, path, info['hash'], info.get('status')) for path, info in files.items()))
+
+        self.con.execute("insert or ignore into manifest_commits (commit_hash, created) values (?,?)",
+                         (commit_hash, time.time()))
+
+        expired = self.con.execute("select commit_hash from manifest_commits order by created desc limit -1 offset ?",
+                                   (keep_manifests,)).fetchall()
+
+        for item in expired:
+            self.con.execute("delete from manifest_commits where commit_hash = ?", (item['commit_hash'],))
+            self.con.execute("delete from manifest_files where commit_hash = ?", (item['commit_hash'],))
+
+        self.commit()
+
+
+#===============================================================================
+# Commit graph
+#===============================================================================
+    def get_commit_graph_entry(self, commit_hash: str):
+        res = self.con.execute("select * from commit_graph where commit_hash = ?", (commit_hash,)).fetchall()
+        return res[0] if res != [] else None
+
+
+    #===============================================================================
+    def add_commits_to_graph(self, commits, parent_generation: int) -> None:
+        """ Add commits to the graph, commits must be ordered oldest first with
+        the first being a child of the commit at parent_generation. Anything
+        already indexed after parent_generation is from a history which head no
+        longer follows, for instance if head was restored from a backup, or was
+        indexed by another request at the same time, so is replaced. """
+
+        with self.transaction():
+            self.con.execute("delete from commit_graph where generation > ?", (parent_generation,))
+            self.con.execute("delete from commit_change_log where generation > ?", (parent_generation,))
+
+            generation = parent_generation
+            for commit_hash, commit in commits:
+                generation += 1
+
+                self.con.execute("""insert into commit_graph
+                                        (commit_hash, parent, generation, utc_date_time, commit_by, commit_message)
+                                        values (?,?,?,?,?,?)""",
+                                 (commit_hash, commit['parent'], generation, commit['utc_date_time'],
+                                  commit['commit_by'], commit['commit_message']))
+
+                self.con.executemany("insert into commit_change_log (generation, hash, path, status) values (?,?,?,?)",
+                                     ((generation, change['hash'], change['path'], change['status']) for change in commit['changes']))
+
+
+    #===============================================================================
+    def get_changes_between_generations(self, from_generation: int, to_generation: int):
+        """ Gets the changes made after from_generation up to and including to_generation, oldest first """
+
+        return self.con.execute("""select hash, path, status from commit_change_log
+                                   where generation > ? and generation <= ?
+                                   order by generation asc, rowid asc""",
+                                (from_generation, to_generation)).fetchall()
+
+
+    #===============================================================================
+    def get_commit_graph_chain(self, to_generation: int, limit: int, offset: int):
+        """ Gets commits from to_generation back towards the first commit, newest first """
+
+        return self.con.execute("""select commit_hash, utc_date_time, commit_by, commit_message from commit_graph
+                                   where generation <= ?
+                                   order by generation desc limit ? offset ?""",
+                                (to_generation, limit, offset)).fetchall()
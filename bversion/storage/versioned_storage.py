@@ -1,12 +1,14 @@
-import json, hashlib, os, os.path, shutil, fcntl, errno
+import json, hashlib, os, os.path, shutil, fcntl, errno, time
 from  collections import defaultdict
 from datetime import datetime
 
-from typing import List, Dict, Any, cast
+from typing import List, Dict, Set, Any, Optional, cast
 from typing_extensions import TypedDict
 
 import bversion.common as sfs
 from bversion.storage.server_db import get_server_db_instance_for_thread
+from bversion.storage.pack_store import pack_store
+from bversion.storage.object_cache import index_object_cache
 
 #+++++++++++++++++++++++++++++++++
 class indexObject(TypedDict):
@@ -27,6 +29,47 @@ class indexObjectCommit(indexObject):
     changes:        Any
 
 
+# Number of flattened commit manifests retained in the transient DB
+cached_manifest_limit = 8
+
+# Staged blobs which have not been committed after this many seconds are garbage collected
+staged_file_max_age = 24 * 60 * 60
+
+
+#+++++++++++++++++++++++++++++++++
+class lazy_tree_lookup:
+    """ Resolves paths against a tree, reading only the tree objects on the
+    path being looked up. Directories are memoised, so looking up many files
+    in the same directory only reads it's tree once. """
+
+    def __init__(self, data_store, tree_root):
+        self.data_store = data_store
+        self.nodes: Dict[str, Any] = {'' : None if tree_root is None else data_store.read_tree_index_object(tree_root)}
+
+#===============================================================================
+    def get_dir(self, dir_path: str):
+        if dir_path in self.nodes: return self.nodes[dir_path]
+
+        parent_path, _, name = dir_path.rpartition('/')
+        parent = self.get_dir(parent_path)
+
+        node = None
+        if parent is not None and name in parent['dirs']:
+            node = self.data_store.read_tree_index_object(parent['dirs'][name])
+
+        self.nodes[dir_path] = node
+        return node
+
+#===============================================================================
+    def get_file(self, file_path: str):
+        """ Returns the file info of a file, or None if it does not exist """
+
+        dir_path, _, name = file_path.rpartition('/')
+        node = self.get_dir(dir_path)
+        if node is None or name not in node['files']: return None
+        return dict(node['files'][name], path = file_path)
+
+
 #+++++++++++++++++++++++++++++++++
 #+++++++++++++++++++++++++++++++++
 class versioned_storage:
@@ -36,6 +79,8 @@ class versioned_storage:
         sfs.make_dirs_if_dont_exist(sfs.cpjoin(base_path, 'index') + '/')
         sfs.make_dirs_if_dont_exist(sfs.cpjoin(base_path, 'files') + '/')
         self.lock_file = None
+        self.packs     = pack_store(sfs.cpjoin(base_path, 'index', 'pack'))
+        self.head_lookup: Optional[lazy_tree_lookup] = None
 
 
 #===============================================================================
@@ -47,7 +92,7 @@ class versioned_storage:
         target_base = sfs.cpjoin(self.base_path, 'index',object_hash[:2])
 
         # Does an object with this hash already exist?
-        if os.path.isfile(sfs.cpjoin(target_base, object_hash[2:])):
+        if self.index_object_exists(object_hash):
             return object_hash
 
         # log items which do not exist for garbage collection
@@ -63,13 +108,42 @@ class versioned_storage:
 
 
 #===============================================================================
-    def read_index_object(self, object_hash: str, expected_object_type: str) -> indexObject:
+    def index_object_exists(self, object_hash: str) -> bool:
+        if os.path.isfile(sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:])):
+            return True
+
+        return self.packs.contains(object_hash)
+
+
+#===============================================================================
+    def read_index_object_bytes(self, object_hash: str) -> bytes:
+        """ Read the serialised form of an index object, which may either be
+        stored as a loose file or within a pack """
+
         # Hashes must only contain hex digits
-        if not set(object_hash) <= set('0123456789abcdef'):
+        if len(object_hash) != 64 or not set(object_hash) <= set('0123456789abcdef'):
             raise IOError('Invalid object hash')
 
-        # ==============
-        index_object: indexObject = json.loads(sfs.file_get_contents(sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:])))
+        try:
+            return sfs.file_get_contents(sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:]))
+        except FileNotFoundError:
+            data = self.packs.read(object_hash)
+            if data is None: raise
+            return data
+
+
+#===============================================================================
+    def read_index_object(self, object_hash: str, expected_object_type: str) -> indexObject:
+        """ Read and parse an index object. Parsed objects are shared through the
+        process wide cache so must not be modified by the caller. """
+
+        index_object: indexObject = index_object_cache.get(object_hash)
+
+        if index_object is None:
+            serialised = self.read_index_object_bytes(object_hash)
+            index_object = json.loads(serialised)
+            index_object_cache.put(object_hash, index_object, len(serialised))
+
         if index_object['type'] != expected_object_type: raise IOError('Type of object does not match expected type')
         return index_object
 
@@ -115,7 +189,7 @@ class versioned_storage:
         def helper(tree, leading_path = ''):
             dirs  = tree['dirs']; files = tree['files']
             for name, file_info in files.items():
-                file_info['path'] = leading_path + '/'  + name
+                file_info = dict(file_info, path = leading_path + '/'  + name)
                 result[file_info['path']] = file_info
 
             for name, contents in dirs.items():
@@ -151,6 +225,40 @@ class versioned_storage:
         return self.write_index_object('tree', {'files' : files, 'dirs': child_dirs})
 
 
+#===============================================================================
+    def write_changed_tree(self, tree_hash, changes, is_root: bool = True):
+        """ Write a new tree by applying changes to the existing tree at tree_hash,
+        only the trees on the paths of changed files are rewritten, all other
+        subtrees keep their existing hashes. Changes are a list of tuples of the
+        split path relative to this tree, and the change info. Returns None
+        if a non-root tree would be empty. """
+
+        files: Dict[str, Any] = {}; dirs: Dict[str, str] = {}
+        if tree_hash is not None:
+            tree = self.read_tree_index_object(tree_hash)
+            files = dict(tree['files']); dirs = dict(tree['dirs'])
+
+        child_changes = defaultdict(list)
+        for split_path, change in changes:
+            if len(split_path) == 1:
+                if change['status'] == 'deleted':
+                    files.pop(split_path[0], None)
+                else:
+                    # store only the file name instead of the whole path
+                    files[split_path[0]] = {'hash' : change['hash'], 'path' : split_path[0], 'status' : change['status']}
+
+            elif len(split_path) > 1:
+                child_changes[split_path[0]].append((split_path[1:], change))
+
+        for name, sub_changes in child_changes.items():
+            child_hash = self.write_changed_tree(dirs.get(name), sub_changes, is_root = False)
+            if child_hash is None: dirs.pop(name, None)
+            else:                  dirs[name] = child_hash
+
+        if not is_root and files == {} and dirs == {}: return None
+        return self.write_index_object('tree', {'files' : files, 'dirs': dirs})
+
+
 #===============================================================================
     def get_active_commit(self) -> bool:
         """ Checks if there is an active commit owned by the specified user """
@@ -202,19 +310,30 @@ class versioned_storage:
     def begin(self, user, user_ip, session_token, resume: bool = False) -> None:
         if resume is False and self.get_active_commit() is not None: raise Exception()
 
-        active_files = {}
-        head = self.get_head()
-
-        if head != 'root':
-            commit = self.read_commit_index_object(head)
-            active_files = self.flatten_dir_tree(self.read_dir_tree(commit['tree_root']))
-
+        self.head_lookup = None
         sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
 
         if resume:
-            sdb.resume_commit(active_files, session_token)
+            sdb.resume_commit(session_token)
         else:
-            sdb.begin_commit(active_files, user, user_ip, session_token)
+            sdb.begin_commit(user, user_ip, session_token)
+
+#===============================================================================
+    def get_version_lookup(self, version_id: str) -> lazy_tree_lookup:
+        """ Lookup of files in an arbitrary commit """
+
+        tree_root = None if version_id == 'root' else self.read_commit_index_object(version_id)['tree_root']
+        return lazy_tree_lookup(self, tree_root)
+
+
+#===============================================================================
+    def get_head_lookup(self) -> lazy_tree_lookup:
+        """ Lookup of files in the head commit, which the active commit is based on """
+
+        if self.head_lookup is None:
+            self.head_lookup = self.get_version_lookup(self.get_head())
+
+        return self.head_lookup
 
 #===============================================================================
     def get_active_commit_changes(self):
@@ -222,40 +341,152 @@ class versioned_storage:
         return sdb.get_active_commit_changes()
 
 #===============================================================================
-    def fs_put_from_file(self, source_file: str, file_info) -> None:
-        if self.get_active_commit() is None: raise Exception()
+    def store_file(self, source_file: str, file_hash: Optional[str] = None) -> str:
+        """ Move a file into the file store, returning it's hash """
+
+        if file_hash is None: file_hash = sfs.hash_file(source_file)
+        self.store_files([(source_file, file_hash)])
+        return file_hash
 
-        file_info['hash'] = file_hash = sfs.hash_file(source_file)
+
+#===============================================================================
+    def store_files(self, files) -> None:
+        """ Move many files, given as (source_file, file_hash) pairs, into the file store """
 
         sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
 
-        target_base = sfs.cpjoin(self.base_path, 'files',file_hash[:2])
-        target = sfs.cpjoin(target_base, file_hash[2:])
-        if not os.path.isfile(target):
-            # log items which don't already exist so that we do not have to read the objects referenced in
-            # all existing commits to determine if the new objects are garbage in case of a commit roll back
-            sdb.gc_log_item('file', file_hash)
+        targets = []
+        for source_file, file_hash in files:
+            target = sfs.cpjoin(self.base_path, 'files', file_hash[:2], file_hash[2:])
+            if os.path.isfile(target): os.remove(source_file)
+            else:                      targets.append((source_file, file_hash, target))
+
+        # log items which don't already exist so that we do not have to read the objects referenced in
+        # all existing commits to determine if the new objects are garbage in case of a commit roll back.
+        # The log is committed before any are moved, so that none can be left unreferenced by a crash.
+        sdb.gc_log_items([('file', file_hash) for _, file_hash, _ in targets])
 
-            # ---
-            sfs.make_dirs_if_dont_exist(target_base)
+        for source_file, file_hash, target in targets:
+            sfs.make_dirs_if_dont_exist(os.path.dirname(target) + '/')
             shutil.move(source_file, target)
-        else:
-            os.remove(source_file)
+
+
+#===============================================================================
+# Staging
+#
+# Clients upload blobs to the staging area without holding the write lock, and
+# then add them to a commit once it has begun. Blobs are content addressed, thus
+# a blob staged by several clients is stored once. Blobs which are never
+# committed are removed by gc_staged_files.
+#===============================================================================
+    def get_staged_file_path(self, file_hash: str) -> str:
+        return sfs.cpjoin(self.base_path, 'staging', file_hash[:2], file_hash[2:])
+
+
+#===============================================================================
+    def stage_file(self, source_file: str, file_hash: str) -> None:
+        """ Move an uploaded file, which the caller has hashed, into the staging area """
+
+        target = self.get_staged_file_path(file_hash)
+        sfs.make_dirs_if_dont_exist(os.path.dirname(target) + '/')
+        os.replace(source_file, target)
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        sdb.stage_blob(file_hash)
+
+
+#===============================================================================
+    def store_staged_files(self, file_hashes) -> Set[str]:
+        """ Move staged blobs into the file store, returns the hashes of those which are now
+        stored. Blobs which were not staged, or were garbage collected before they were
+        committed, are left out. """
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+
+        stored = set()
+        to_store = []
+        for file_hash in dict.fromkeys(file_hashes):
+            staged_path = self.get_staged_file_path(file_hash)
+
+            if os.path.isfile(sfs.cpjoin(self.get_file_directory_path(file_hash), file_hash[2:])):
+                sfs.ignore(os.remove, staged_path)
+
+            elif os.path.isfile(staged_path):
+                to_store.append((staged_path, file_hash))
+
+            else:
+                continue
+
+            stored.add(file_hash)
+
+        self.store_files(to_store)
+
+        with sdb.transaction():
+            for file_hash in stored:
+                sdb.unstage_blob(file_hash)
+
+        return stored
+
+
+#===============================================================================
+    def gc_staged_files(self, max_age: float) -> int:
+        """ Remove staged blobs older than max_age seconds, returns the number removed """
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+
+        expired = sdb.get_staged_blobs_before(time.time() - max_age)
+        with sdb.transaction():
+            for file_hash in expired:
+                sfs.ignore(os.remove, self.get_staged_file_path(file_hash))
+                sdb.unstage_blob(file_hash)
+
+        return len(expired)
+
+
+#===============================================================================
+    def fs_put_from_file(self, source_file: str, file_info, file_hash: Optional[str] = None) -> None:
+        """ Store a file and add it to the active commit. If the caller hashed the
+        file as it was written, pass the hash to avoid reading it again. """
+
+        if self.get_active_commit() is None: raise Exception()
+
+        file_info['hash'] = self.store_file(source_file, file_hash)
 
         # Update commit changes
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        file_info['status'] = 'changed' if self.get_head_lookup().get_file(file_info['path']) is not None else 'new'
         sdb.add_to_commit(file_info)
 
         return file_info
 
 
+#===============================================================================
+    def add_stored_files_to_commit(self, file_infos) -> None:
+        """ Record files which have been put in the file store using store_file
+        in the active commit, using a single transaction """
+
+        if self.get_active_commit() is None: raise Exception()
+
+        head_lookup = self.get_head_lookup()
+        for file_info in file_infos:
+            file_info['status'] = 'changed' if head_lookup.get_file(file_info['path']) is not None else 'new'
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        sdb.add_many_to_commit(file_infos)
+
+
 #===============================================================================
     def fs_delete(self, files) -> None:
         if self.get_active_commit() is None: raise Exception()
 
         # As we always store all history, simply removing the files from the manifest
-        # of this commit is all we need to do
+        # of this commit is all we need to do. We don't need to do anything for files
+        # which do not exist.
+        head_lookup = self.get_head_lookup()
+        existing_files = [head_lookup.get_file(it['path']) for it in files]
+
         sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
-        sdb.remove_from_commit(files)
+        sdb.remove_from_commit([it for it in existing_files if it is not None])
 
 
 #===============================================================================
@@ -263,13 +494,10 @@ class versioned_storage:
         if self.get_active_commit() is None: raise Exception()
 
         sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
-        current_changes, active_files = sdb.get_commit_state()
-
-        if current_changes == []: return self.get_head()
-
-        # Create and store the file tree
-        tree_root   = self.write_dir_tree(self.build_dir_tree(active_files))
+        current_changes = sdb.get_active_commit_changes()
 
+        head = self.get_head()
+        if current_changes == []: return head
 
         # If no commit message is passed store an indication of what was changed
         if commit_message == '':
@@ -287,8 +515,13 @@ class versioned_storage:
         commit_timestamp = commit_datetime.strftime("%d-%m-%Y %H:%M:%S:%f")
 
 
+        # Create and store the file tree, reusing unchanged subtrees of the parent commit
+        parent_tree = None if head == 'root' else self.read_commit_index_object(head)['tree_root']
+        tree_root   = self.write_changed_tree(parent_tree, [(change['path'].split('/')[1:], change)
+                                                            for change in current_changes])
+
         # Create commit
-        commit_object_hash = self.write_index_object('commit', {'parent'         : self.get_head(),
+        commit_object_hash = self.write_index_object('commit', {'parent'         : head,
                                                                 'utc_date_time'  : commit_timestamp,
                                                                 'commit_by'      : commit_by,
                                                                 'commit_message' : commit_message,
@@ -302,6 +535,7 @@ class versioned_storage:
         #and clean up working state
         sdb.clean_commit_state()
         sdb.con.commit()
+        self.head_lookup = None
 
         return commit_object_hash
 
@@ -332,8 +566,69 @@ class versioned_storage:
         sdb.con.commit()
 
 
+#===============================================================================
+    def index_commit_graph(self, head: str):
+        """ Ensure that all commits from head back to the first commit are in the
+        commit graph, only reading commits which have not been indexed before.
+        Returns the graph entry for head. """
+
+        if head == 'root': return None
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+
+        pending = []
+        seen_pointers: Dict[str, None] = {}
+        pointer = head
+        parent_generation = 0
+
+        while pointer != 'root':
+            entry = sdb.get_commit_graph_entry(pointer)
+            if entry is not None:
+                parent_generation = entry['generation']
+                break
+
+            if pointer in seen_pointers: raise Exception("Cycle detected")
+            seen_pointers[pointer] = None
+
+            commit = self.read_commit_index_object(pointer)
+            pending.append((pointer, commit))
+            pointer = commit['parent']
+
+        if pending != []:
+            sdb.add_commits_to_graph(reversed(pending), parent_generation)
+
+        return sdb.get_commit_graph_entry(head)
+
+
 #===============================================================================
     def get_changes_since(self, version_id: str, head: str):
+        """ Get the net changes made after version_id up to and including head """
+
+        if head == version_id: return {}
+
+        head_entry = self.index_commit_graph(head)
+        if head_entry is None: return self.walk_changes_since(version_id, head)
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+
+        if version_id == 'root':
+            from_generation = 0
+        else:
+            from_entry = sdb.get_commit_graph_entry(version_id)
+
+            # Anything not in the graph is not an ancestor of head, let the
+            # walk handle reporting the error.
+            if from_entry is None or from_entry['generation'] > head_entry['generation']:
+                return self.walk_changes_since(version_id, head)
+
+            from_generation = from_entry['generation']
+
+        changes = sdb.get_changes_between_generations(from_generation, head_entry['generation'])
+        return {change['path'] : change for change in changes}
+
+
+#===============================================================================
+    def walk_changes_since(self, version_id: str, head: str):
         pointer = head
         if pointer == version_id: return {}
 
@@ -349,29 +644,96 @@ class versioned_storage:
             seen_pointers[pointer] = None
             pointer = commit['parent']
 
-        return {change['path'] : change for change_log in reversed(change_logs) for change in change_log['changes']}
+        return {change['path'] : dict(change) for change_log in reversed(change_logs) for change in change_log['changes']}
 
 
 #===============================================================================
-    def get_commit_chain(self, commit_limit = 50):
-        pointer = self.get_head()
-        if pointer == 'root': return []
+    def is_ancestor(self, version_id: str, head: str) -> bool:
+        """ Check if version_id is head or one of it's ancestors """
 
-        commits = []; limiter = 0
-        while True:
-            # store the id of this commit, not it's parent
-            commit = self.read_commit_index_object(pointer)
-            commits.append({'id'             : pointer,
-                            'utc_date_time'  : commit['utc_date_time'],
-                            'commit_by'      : commit['commit_by'],
-                            'commit_message' : commit['commit_message']})
+        if version_id in ['root', head]: return True
 
-            #--
-            pointer = commit['parent']
-            if pointer == 'root': break
-            if commit_limit is not None and limiter > commit_limit: break
-            limiter += 1
-        return commits
+        head_entry = self.index_commit_graph(head)
+        if head_entry is None: return version_id in self.walk_commit_ids(head)
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        entry = sdb.get_commit_graph_entry(version_id)
+
+        # History is linear, so every commit in the graph older than head is an ancestor of it
+        return entry is not None and entry['generation'] < head_entry['generation']
+
+
+#===============================================================================
+    def walk_commit_ids(self, head: str, limit = None) -> List[str]:
+        """ List commit ids from head back to the first commit by reading each commit,
+        used where the commit graph is not available """
+
+        commit_ids: Dict[str, None] = {}
+        pointer = head
+        while pointer != 'root' and (limit is None or len(commit_ids) < limit):
+            if pointer in commit_ids: raise Exception("Cycle detected")
+            commit_ids[pointer] = None
+            pointer = self.read_commit_index_object(pointer)['parent']
+
+        return list(commit_ids)
+
+
+#===============================================================================
+    def find_overlapping_changes(self, version_id: str, head: str, changes, base_hashes = None) -> List[str]:
+        """ Find paths in changes which overlap the changes made after version_id up to head.
+        Paths overlap if they are the same, or if one is a directory containing the other.
+        base_hashes optionally maps paths to the hash the change was based on, None for
+        files which did not exist. A path whose hash in head matches it does not overlap,
+        as the change since version_id was one the client has already seen, such as an
+        earlier commit of it's own which was rebased. """
+
+        server_changes = self.get_changes_since(version_id, head)
+
+        if base_hashes:
+            head_lookup = self.get_version_lookup(head)
+            for path in [path for path in server_changes if path in base_hashes]:
+                head_file = head_lookup.get_file(path)
+                if base_hashes[path] == (None if head_file is None else head_file['hash']):
+                    del server_changes[path]
+
+        def parent_dirs(path):
+            return [path[:i] for i, c in enumerate(path) if c == '/' and i > 0]
+
+        changed_paths = set(server_changes.keys())
+        changed_dirs  = {d for path in changed_paths for d in parent_dirs(path)}
+
+        return [change['path'] for change in changes
+                if change['path'] in changed_paths
+                or change['path'] in changed_dirs
+                or any(d in changed_paths for d in parent_dirs(change['path']))]
+
+
+#===============================================================================
+    def get_commit_chain(self, commit_limit = 50, offset = 0):
+        """ List commits from head backwards, skipping the newest 'offset' commits """
+
+        head = self.get_head()
+        head_entry = self.index_commit_graph(head)
+
+        if head_entry is None:
+            walk_limit = None if commit_limit is None else offset + commit_limit
+            commits = [(commit_id, self.read_commit_index_object(commit_id))
+                       for commit_id in self.walk_commit_ids(head, walk_limit)[offset:]]
+
+            return [{'id'             : commit_id,
+                     'utc_date_time'  : commit['utc_date_time'],
+                     'commit_by'      : commit['commit_by'],
+                     'commit_message' : commit['commit_message']}
+                    for commit_id, commit in commits]
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        limit = -1 if commit_limit is None else commit_limit
+
+        return [{'id'             : commit['commit_hash'],
+                 'utc_date_time'  : commit['utc_date_time'],
+                 'commit_by'      : commit['commit_by'],
+                 'commit_message' : commit['commit_message']}
+                for commit in sdb.get_commit_graph_chain(head_entry['generation'], limit, offset)]
 
 
 #===============================================================================
@@ -382,8 +744,19 @@ class versioned_storage:
 
 #===============================================================================
     def get_commit_files(self, version_id: str):
-        commit = self.read_commit_index_object(version_id)
-        return self.flatten_dir_tree(self.read_dir_tree(commit['tree_root']))
+        """ Get the flattened manifest of a commit. As building this requires
+        walking the whole tree, the result is stored in the transient DB and
+        reused by later calls. """
+
+        sdb = get_server_db_instance_for_thread(self.base_path, path_override = self.path_override)
+        files = sdb.get_commit_manifest(version_id)
+
+        if files is None:
+            commit = self.read_commit_index_object(version_id)
+            files = self.flatten_dir_tree(self.read_dir_tree(commit['tree_root']))
+            sdb.store_commit_manifest(version_id, files, cached_manifest_limit)
+
+        return files
 
 
 #===============================================================================
@@ -410,7 +783,7 @@ class versioned_storage:
 
         split_path = file_path.split('/')
         split_path = split_path[1:] if split_path[0] == '' else split_path
-        result = helper(tree_root, split_path)
+        result = dict(helper(tree_root, split_path))
         result['path'] = file_path
         return result
 
@@ -468,15 +841,20 @@ class versioned_storage:
 #===============================================================================
     def get_all_object_hashes(self):
         objects = {
-            'index' : {},
-            'files' : {}
+            'index'  : {},
+            'packed' : {},
+            'files'  : {}
         }
 
-        # Enumerate index objects
+        # Enumerate loose index objects
         for it in os.listdir(sfs.cpjoin(self.base_path, 'index')):
+            if it == 'pack': continue
             for it2 in os.listdir(sfs.cpjoin(self.base_path, 'index', it)):
                 objects['index'][it + it2] = sfs.cpjoin(self.base_path, 'index', it, it2)
 
+        # Enumerate packed index objects
+        objects['packed'] = self.packs.all_hashes()
+
         # Enumerate file objects
         for it in os.listdir(sfs.cpjoin(self.base_path, 'files')):
             for it2 in os.listdir(sfs.cpjoin(self.base_path, 'files', it)):
@@ -500,9 +878,8 @@ class versioned_storage:
         # if head is root, but commits exists, this is suspisious
         #================================================================
         number_of_commits = 0
-        for object_hash in all_objects['index']:
-            object_path = sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:])
-            file_contents = json.loads(sfs.file_get_contents(object_path))
+        for object_hash in list(all_objects['index']) + list(all_objects['packed']):
+            file_contents = json.loads(self.read_index_object_bytes(object_hash))
             if file_contents['type'] == 'commit':
                 number_of_commits += 1
 
@@ -519,7 +896,8 @@ class versioned_storage:
         index_objects_that_should_exist =   set(reachable_objects['commits'].keys()) \
                                           | set(reachable_objects['trees'])
 
-        index_objects_that_do_exist     =   set(all_objects['index'].keys())
+        index_objects_that_do_exist     =   set(all_objects['index'].keys()) \
+                                          | set(all_objects['packed'].keys())
 
         # file objects
         file_objects_that_should_exist =   set(reachable_objects['files'].keys())
@@ -543,9 +921,9 @@ class versioned_storage:
         #================================================================
         # Re hash all objects to check that the hashes have not changed
         #================================================================
-        for object_hash, object_path in all_objects['index'].items():
-            print('Rehashing: ' + object_path)
-            current_hash = sfs.hash_file(object_path)
+        for object_hash in list(all_objects['index']) + list(all_objects['packed']):
+            print('Rehashing index object: ' + object_hash)
+            current_hash = hashlib.sha256(self.read_index_object_bytes(object_hash)).hexdigest()
             if object_hash != current_hash:
                 msg = 'Index opject hash has changed: ' + object_hash
                 print(msg)
@@ -568,6 +946,8 @@ class versioned_storage:
         if lock_status is False:
             return False, ['failed to lock']
 
+        self.gc_staged_files(staged_file_max_age)
+
         head, reachable_objects = self.get_reachable_objects()
         all_objects             = self.get_all_object_hashes()
 
@@ -577,9 +957,8 @@ class versioned_storage:
         # if head is root, but commits exists, this is suspisious
         #================================================================
         number_of_commits = 0
-        for object_hash in all_objects['index']:
-            object_path = sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:])
-            file_contents = json.loads(sfs.file_get_contents(object_path))
+        for object_hash in list(all_objects['index']) + list(all_objects['packed']):
+            file_contents = json.loads(self.read_index_object_bytes(object_hash))
             if file_contents['type'] == 'commit':
                 number_of_commits += 1
 
@@ -596,7 +975,8 @@ class versioned_storage:
         index_objects_that_should_exist =   set(reachable_objects['commits'].keys()) \
                                           | set(reachable_objects['trees'])
 
-        index_objects_that_do_exist     =   set(all_objects['index'].keys())
+        index_objects_that_do_exist     =   set(all_objects['index'].keys()) \
+                                          | set(all_objects['packed'].keys())
 
         # file objects
         file_objects_that_should_exist =   set(reachable_objects['files'].keys())
@@ -609,7 +989,9 @@ class versioned_storage:
         #================================================================
         # Delete garbage objects
         #================================================================
+        # Packed objects cannot be removed without rewriting the pack, so only loose objects are deleted
         for object_hash in garbage_index_objects:
+            if object_hash not in all_objects['index']: continue
             object_path = sfs.cpjoin(self.base_path, 'index', object_hash[:2], object_hash[2:])
             os.remove(object_path)
 
@@ -619,3 +1001,32 @@ class versioned_storage:
 
         self.unlock()
         return True
+
+#===============================================================================
+    def pack_objects(self):
+        """ Move loose index objects which are reachable from head into a new pack.
+        Unreachable objects are left loose, as they may belong to a failed commit
+        which rollback needs to remove. """
+
+        lock_status = self.lock()
+        if lock_status is False:
+            return False, ['failed to lock']
+
+        reachable_objects = self.get_reachable_objects()[1]
+        all_objects       = self.get_all_object_hashes()
+
+        to_pack = {}
+        for object_hash in list(reachable_objects['commits']) + list(reachable_objects['trees']):
+            if object_hash in all_objects['index']:
+                to_pack[object_hash] = sfs.file_get_contents(all_objects['index'][object_hash])
+
+        pack_name = self.packs.write_pack(to_pack)
+
+        # The pack index is now in place so the loose copies can be removed
+        for object_hash in to_pack:
+            target_base = sfs.cpjoin(self.base_path, 'index', object_hash[:2])
+            os.remove(sfs.cpjoin(target_base, object_hash[2:]))
+            sfs.ignore(os.rmdir, target_base)
+
+        self.unlock()
+        return True, ([] if pack_name is None else [pack_name])
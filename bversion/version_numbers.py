@@ -1,5 +1,5 @@
-client_version = 3
-server_version = 3
+client_version = 4
+server_version = 4
 
 minimum_client_version = 3
-minimum_server_version = 3
+minimum_server_version = 4
@@ -0,0 +1,249 @@
+import os, select, struct, signal, sqlite3, ctypes, ctypes.util, errno
+from typing import Dict, Callable
+
+from bversion.common import cpjoin, path_filter, file_or_default
+from bversion.storage.client_db import client_db
+
+#===============================================================================
+# Working copy watcher
+#
+# Uses Linux inotify to record the paths which change in a working copy into
+# the dirty path journal in the manifest database, allowing the client to check
+# only those paths for changes instead of scanning the whole working copy.
+#
+# Events are delivered asynchronously, so before the client trusts the journal
+# it writes a token to the sync file. Once the watcher has seen that write, it
+# has seen every earlier event, and it echoes the token back after recording
+# them. If events are lost, the journal is invalidated and the client falls
+# back to a full scan.
+#===============================================================================
+sync_file_name = 'watch_sync'
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+
+watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+event_header = struct.Struct('iIII')
+
+# Seconds between writing recorded paths to the database
+flush_interval = 0.5
+
+
+#===============================================================================
+class inotify:
+    """ Minimal wrapper of the inotify system calls """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        if not hasattr(libc, 'inotify_init1'): raise SystemExit('bvn watch requires Linux inotify')
+
+        self.libc = libc
+        self.fd   = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    #=============================================
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    #=============================================
+    def rm_watch(self, wd: int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    #=============================================
+    def read_events(self):
+        """ Read the events which are available, yielding (wd, mask, name) """
+
+        try: data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError: return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = os.fsdecode(data[offset : offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            yield wd, mask, name
+
+    #=============================================
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+#===============================================================================
+class working_copy_watcher:
+    def __init__(self, base_path: str, cdb: client_db, load_ignore_matcher: Callable[[], path_filter]):
+        self.base_path           = base_path
+        self.cdb                 = cdb
+        self.load_ignore_matcher = load_ignore_matcher
+
+        self.ignore_matcher = load_ignore_matcher()
+        self.notify         = inotify()
+        self.watches: Dict[int, str] = {} # wd : internal directory path
+        self.dirty: Dict[str, None]  = {}
+        self.sync_token             = None
+        self.invalidated            = False
+        self.reload_needed          = False
+        self.stopped                = False
+
+        self.bvn_wd = self.notify.add_watch(cpjoin(base_path, '.bvn'), IN_CLOSE_WRITE | IN_ONLYDIR)
+
+        # Don't wait for the client to finish writing, events must keep being read
+        self.cdb.con.execute('pragma busy_timeout = 100')
+
+    #=============================================
+    def watch_tree(self, int_path: str) -> None:
+        """ Watch a directory and every directory below it, except those which are ignored """
+
+        pending = [int_path]
+        while pending != []:
+            dir_path = pending.pop()
+            try:
+                wd = self.notify.add_watch(cpjoin(self.base_path, dir_path), watch_mask)
+                self.watches[wd] = dir_path
+
+                with os.scandir(cpjoin(self.base_path, dir_path)) as it:
+                    for entry in it:
+                        child_path = cpjoin(dir_path, entry.name)
+                        if entry.is_dir(follow_symlinks = False) and not self.ignore_matcher.matches_dir(child_path):
+                            pending.append(child_path)
+
+            except FileNotFoundError: # removed before it could be watched, the parent reports this
+                pass
+
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise SystemExit('Too many directories to watch, increase fs.inotify.max_user_watches')
+                raise
+
+    #=============================================
+    def unwatch_tree(self, int_path: str) -> None:
+        for wd, dir_path in list(self.watches.items()):
+            if dir_path == int_path or dir_path.startswith(int_path + '/'):
+                self.notify.rm_watch(wd)
+                del self.watches[wd]
+
+    #=============================================
+    def handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            self.invalidated = True; return
+
+        if wd == self.bvn_wd:
+            if name == sync_file_name:
+                self.sync_token = file_or_default(cpjoin(self.base_path, '.bvn', sync_file_name), b'').decode('utf8')
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None); return
+
+        dir_path = self.watches.get(wd)
+        if dir_path is None or name == '': return
+
+        path = cpjoin(dir_path, name)
+        self.dirty[path] = None
+
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE): self.unwatch_tree(path)
+            if mask & (IN_MOVED_TO | IN_CREATE) and not self.ignore_matcher.matches_dir(path): self.watch_tree(path)
+
+        # Changes to the ignore filters change which directories are watched
+        if path in ['/.bvn_ignore', '/.bvn_pull_ignore']:
+            self.reload_needed = True
+
+    #=============================================
+    def flush(self) -> bool:
+        """ Write recorded paths to the database, returns false if it is busy """
+
+        try:
+            if self.invalidated:
+                self.cdb.invalidate_journal()
+
+            self.cdb.add_dirty_paths(list(self.dirty.keys()))
+
+            if self.sync_token is not None:
+                self.cdb.set_sync_token(self.sync_token)
+
+            self.cdb.commit()
+
+        except sqlite3.OperationalError: # the client is writing to the database
+            self.cdb.con.rollback()
+            return False
+
+        self.dirty = {}; self.sync_token = None
+        return True
+
+    #=============================================
+    def start(self) -> None:
+        """ Watch the whole working copy, then register the watcher. The journal starts
+        invalid, as changes made before the watches were added were not seen. """
+
+        self.watch_tree('/')
+        self.cdb.register_watcher(os.getpid())
+        self.cdb.commit()
+
+    #=============================================
+    def reload(self) -> None:
+        """ Rebuild the watches after the ignore filters have changed """
+
+        for wd in list(self.watches): self.notify.rm_watch(wd)
+        self.watches = {}; self.dirty = {}
+        self.ignore_matcher = self.load_ignore_matcher()
+        self.watch_tree('/')
+        self.invalidated = True; self.reload_needed = False
+
+    #=============================================
+    def run(self) -> None:
+        self.start()
+        print('Watching ' + self.base_path)
+
+        try:
+            while not self.stopped:
+                try: select.select([self.notify.fd], [], [], flush_interval)
+                except InterruptedError: continue
+
+                for wd, mask, name in self.notify.read_events():
+                    self.handle_event(wd, mask, name)
+
+                if self.reload_needed: self.reload()
+
+                if self.dirty != {} or self.sync_token is not None or self.invalidated:
+                    if self.flush(): self.invalidated = False
+
+        finally:
+            self.cdb.con.rollback()
+            self.cdb.unregister_watcher(os.getpid())
+            self.cdb.commit()
+            self.notify.close()
+
+    #=============================================
+    def stop(self, *args) -> None: # pylint: disable=unused-argument
+        self.stopped = True
+
+
+#===============================================================================
+def watch(base_path: str, cdb: client_db, load_ignore_matcher: Callable[[], path_filter]) -> None:
+    """ Watch a working copy until SIGTERM or SIGINT is received """
+
+    watcher = working_copy_watcher(base_path, cdb, load_ignore_matcher)
+
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, watcher.stop)
+
+    watcher.run()
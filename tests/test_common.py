@@ -1,7 +1,10 @@
+import os, time
 from unittest import TestCase
 
 from tests.helpers import DATA_DIR, make_data_dir, delete_data_dir
-from bversion.common import cpjoin, file_put_contents, hash_file, find_manifest_changes
+from bversion.common import (cpjoin, file_put_contents, hash_file, find_manifest_changes, scan_file_list,
+                             make_dirs_if_dont_exist, path_filter, dir_listing_cache,
+                             find_sorted_manifest_changes)
 
 def get_state(path, last_mod):
     return {'path'     : path, 'last_mod' : last_mod}
@@ -23,6 +26,112 @@ class TestCommon(TestCase):
 
         delete_data_dir()
 
+#===============================================================================
+    def test_scan_file_list(self):
+        """ Files are listed in sorted order, skipping directories as requested """
+
+        make_data_dir()
+
+        for path in ['b/2', 'b/1', 'a', 'c/d/3', 'ignored/4']:
+            make_dirs_if_dont_exist(cpjoin(DATA_DIR, os.path.dirname(path)))
+            file_put_contents(cpjoin(DATA_DIR, path), b'')
+
+        result = [f['path'] for f in scan_file_list(DATA_DIR, lambda path: path == '/ignored', max_workers = 2)]
+        self.assertEqual(['/a', '/b/1', '/b/2', '/c/d/3'], result)
+
+        delete_data_dir()
+
+#===============================================================================
+    def test_scan_file_list_read_ahead(self):
+        """ Directories are only read a limited distance ahead of the caller """
+
+        make_data_dir()
+
+        for i in range(20):
+            make_dirs_if_dont_exist(cpjoin(DATA_DIR, 'd%02d' % i))
+            file_put_contents(cpjoin(DATA_DIR, 'd%02d' % i, 'f'), b'')
+
+        expected = ['/d%02d/f' % i for i in range(20)]
+        for read_ahead in [0, 1, 5]:
+            result = [f['path'] for f in scan_file_list(DATA_DIR, max_read_ahead = read_ahead)]
+            self.assertEqual(expected, result)
+
+        reads = []
+        scandir = os.scandir
+        def counting_scandir(path):
+            reads.append(path)
+            return scandir(path)
+
+        os.scandir = counting_scandir
+        try:
+            scan = scan_file_list(DATA_DIR, max_read_ahead = 2)
+            self.assertEqual('/d00/f', next(scan)['path'])
+            time.sleep(0.2)
+
+            # The root, and the two directories which were read ahead of the caller
+            self.assertEqual(3, len(reads))
+            scan.close()
+        finally:
+            os.scandir = scandir
+
+        delete_data_dir()
+
+#===============================================================================
+    def test_scan_file_list_dir_cache(self):
+        """ Unchanged directories are listed from the cache, but files are still checked """
+
+        make_data_dir()
+        make_dirs_if_dont_exist(cpjoin(DATA_DIR, 'a/b'))
+        file_put_contents(cpjoin(DATA_DIR, 'a/1'), b'')
+        file_put_contents(cpjoin(DATA_DIR, 'a/b/2'), b'')
+
+        # Directories modified very recently are not cached
+        for path in ['', 'a', 'a/b']: os.utime(cpjoin(DATA_DIR, path), (1000, 1000))
+
+        cache = dir_listing_cache({})
+        first = list(scan_file_list(DATA_DIR, dir_cache = cache))
+        self.assertEqual(['/', '/a', '/a/b'], sorted(cache.updated.keys()))
+
+        os.utime(cpjoin(DATA_DIR, 'a/b/2'), (2000, 2000))
+
+        scandir = os.scandir
+        os.scandir = None
+        try:
+            cache = dir_listing_cache(cache.updated)
+            second = list(scan_file_list(DATA_DIR, dir_cache = cache))
+        finally:
+            os.scandir = scandir
+
+        self.assertEqual([f['path'] for f in first], [f['path'] for f in second])
+        self.assertEqual(2000, second[1]['last_mod'])
+        self.assertEqual({}, cache.updated)
+
+        # Adding a file changes the directories modification time
+        file_put_contents(cpjoin(DATA_DIR, 'a/b/3'), b'')
+        third = list(scan_file_list(DATA_DIR, dir_cache = dir_listing_cache(cache.listings)))
+        self.assertEqual(['/a/1', '/a/b/2', '/a/b/3'], [f['path'] for f in third])
+
+        delete_data_dir()
+
+#===============================================================================
+    def test_path_filter(self):
+        matcher = path_filter(['/.bvn/*', '/literal', '*.tmp', '/build*', '/dir/?.o'])
+
+        self.assertTrue(matcher.matches('/.bvn/manifest.db'))
+        self.assertTrue(matcher.matches('/literal'))
+        self.assertTrue(matcher.matches('/deep/path/file.tmp'))
+        self.assertTrue(matcher.matches('/dir/a.o'))
+        self.assertFalse(matcher.matches('/literal2'))
+        self.assertFalse(matcher.matches('/dir/ab.o'))
+
+        # Only directories where every path within is matched can be skipped
+        self.assertTrue(matcher.matches_dir('/.bvn'))
+        self.assertTrue(matcher.matches_dir('/build'))
+        self.assertTrue(matcher.matches_dir('/build_output/sub'))
+        self.assertFalse(matcher.matches_dir('/dir'))
+        self.assertFalse(matcher.matches_dir('/literal'))
+        self.assertFalse(path_filter([]).matches_dir('/dir'))
+
 #===============================================================================
     def test_find_manifest_changes(self):
         def to_dict(lst): return {f['path'] : f for f in lst}
@@ -43,3 +152,20 @@ class TestCommon(TestCase):
         self.assertEqual(diff_4, {'/file_2': {'status': 'new', 'path': '/file_2', 'last_mod': 10}})
         self.assertEqual(diff_5, {'/file_2': {'status': 'changed', 'path': '/file_2', 'last_mod': 20},
                                   '/file_1': {'status': 'deleted', 'path': '/file_1', 'last_mod': 20}})
+
+#===============================================================================
+    def test_find_sorted_manifest_changes(self):
+        def to_rows(lst): return [(f['path'], f['last_mod'], 0, 'hash') for f in lst]
+        new_state = [get_state('/a', 10), get_state('/a.txt', 10), get_state('/a/b', 20), get_state('/d', 10)]
+        old_state = [get_state('/a.txt', 10), get_state('/a/b', 10), get_state('/c', 10), get_state('/d', 10)]
+
+        diff = find_sorted_manifest_changes(new_state, to_rows(old_state))
+        self.assertEqual({'/a' : 'new', '/a/b' : 'changed', '/c' : 'deleted'},
+                         {path : f['status'] for path, f in diff.items()})
+        self.assertEqual('hash', diff['/c']['server_file_hash'])
+
+        diff = find_sorted_manifest_changes(new_state, to_rows(old_state), include_unchanged = True)
+        self.assertEqual('unchanged', diff['/d']['status'])
+
+        # The scan must be ordered for the comparison to be correct
+        self.assertRaises(Exception, find_sorted_manifest_changes, list(reversed(new_state)), [])
@@ -0,0 +1,66 @@
+import hashlib
+from unittest import TestCase
+
+from tests.helpers import DATA_DIR, make_data_dir, delete_data_dir
+from bversion.common import cpjoin, file_get_contents
+from bversion.http.http_common import buffered_reader, read_body, read_frames, encode_frame_header
+
+def chunked_recv_into(data: bytes, chunk_size: int):
+    """ A recv_into which returns at most chunk_size bytes per call, as a socket may """
+
+    position = 0
+    def recv_into(view):
+        nonlocal position
+        length = min(len(view), chunk_size, len(data) - position)
+        view[:length] = data[position : position + length]
+        position += length
+        return length
+    return recv_into
+
+#===============================================================================
+class TestHttpCommon(TestCase):
+    def test_read_preamble(self):
+        """ Preambles split over many recv calls are found, and following data is kept for the body """
+
+        stream = b'POST /a HTTP/1.1\r\nContent-Length: 4\r\n\r\nbodyPOST /b HTTP/1.1\r\n\r\n'
+        reader = buffered_reader(chunked_recv_into(stream, 3), buffer_size = 48)
+
+        self.assertEqual(b'POST /a HTTP/1.1\r\nContent-Length: 4', reader.read_preamble())
+        self.assertEqual(b'body', read_body(reader, 4).read_all())
+        self.assertEqual(b'POST /b HTTP/1.1', reader.read_preamble())
+        self.assertRaises(Exception, reader.read_preamble)
+
+        reader = buffered_reader(chunked_recv_into(b'x' * 100, 7), buffer_size = 64)
+        self.assertRaises(Exception, reader.read_preamble, max_size = 32)
+
+#===============================================================================
+    def test_read_body(self):
+        """ Bodies are read to their length, including reads larger than the buffer """
+
+        make_data_dir()
+
+        data = bytes(range(256)) * 100
+        body = read_body(buffered_reader(chunked_recv_into(data + b'next', 1000), buffer_size = 64), len(data))
+        self.assertEqual(data[:10], body.read(10))
+
+        hasher = hashlib.sha256()
+        body.write_to_file(cpjoin(DATA_DIR, 'body'), hasher)
+        self.assertEqual(data[10:], file_get_contents(cpjoin(DATA_DIR, 'body')))
+        self.assertEqual(hashlib.sha256(data[10:]).hexdigest(), hasher.hexdigest())
+        self.assertIsNone(body.read())
+
+        # A connection closed part way through a body is an error
+        body = read_body(buffered_reader(chunked_recv_into(data, 1000)), len(data) + 1)
+        self.assertRaises(Exception, body.read_all)
+
+        delete_data_dir()
+
+#===============================================================================
+    def test_read_frames(self):
+        stream = (encode_frame_header({'path' : '/a'}, 3) + b'aaa' +
+                  encode_frame_header({'path' : '/b'}, 2) + b'bb')
+        body = read_body(buffered_reader(chunked_recv_into(stream, 5), buffer_size = 16), len(stream))
+
+        # Frames which are not read are skipped
+        frames = [(info['path'], frame.read() if info['path'] == '/b' else None) for info, frame in read_frames(body)]
+        self.assertEqual([('/a', None), ('/b', b'bb')], frames)
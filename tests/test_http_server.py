@@ -0,0 +1,40 @@
+import threading, time
+from unittest import TestCase
+
+from bversion.http.http_client import HTTPClient
+from bversion.http.http_server import ThreadPoolHTTPServer, Responce
+
+def echo_handler(request, context):
+    return Responce({'status' : 'ok'}, request.uri.encode('utf8'))
+
+def make_request(connection: HTTPClient, uri: str) -> bytes:
+    connection.send_headers(uri, {'Content-Length' : '0'})
+    return connection.read_responce()[1].read_all()
+
+#===============================================================================
+class TestHttpServer(TestCase):
+    def test_idle_connections_do_not_hold_workers(self):
+        """ A single worker serves many keep-alive connections, each idle between requests """
+
+        pool_server = ThreadPoolHTTPServer('127.0.0.1', 0, echo_handler, max_workers = 1)
+        thread = threading.Thread(target = pool_server.serve_forever, daemon = True)
+        thread.start()
+
+        while pool_server.listen_socket is None: time.sleep(0.01)
+        port = pool_server.listen_socket.getsockname()[1]
+
+        connections = [HTTPClient() for _ in range(3)]
+        for connection in connections: connection.connect('127.0.0.1', port)
+
+        for i in range(2):
+            for n, connection in enumerate(connections):
+                self.assertEqual(('/' + str(n) + '/' + str(i)).encode('utf8'),
+                                 make_request(connection, '/' + str(n) + '/' + str(i)))
+
+        # Idle connections are closed on shutdown
+        pool_server.shutdown(timeout = 5)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertRaises(Exception, make_request, connections[0], '/closed')
+
+        for connection in connections: connection.close()
@@ -0,0 +1,57 @@
+import time
+from unittest import TestCase
+
+from tests.helpers import DATA_DIR, make_data_dir, delete_data_dir
+from bversion.common import cpjoin, make_dirs_if_dont_exist
+from bversion.storage.server_db import get_server_db_instance_for_thread
+
+class TestServerDb(TestCase):
+############################################################################################
+    def setUp(self):
+        delete_data_dir()
+        make_data_dir()
+
+############################################################################################
+    def tearDown(self):
+        delete_data_dir()
+
+############################################################################################
+    def test_connection_per_repository(self):
+        """ Switching between repositories reuses each repositories connection """
+
+        make_dirs_if_dont_exist(cpjoin(DATA_DIR, 'a'))
+        make_dirs_if_dont_exist(cpjoin(DATA_DIR, 'b'))
+
+        sdb_a = get_server_db_instance_for_thread(cpjoin(DATA_DIR, 'a'), True)
+        sdb_b = get_server_db_instance_for_thread(cpjoin(DATA_DIR, 'b'), True)
+        self.assertIsNot(sdb_a, sdb_b)
+        self.assertIs(sdb_a, get_server_db_instance_for_thread(cpjoin(DATA_DIR, 'a')))
+        self.assertIs(sdb_b, get_server_db_instance_for_thread(cpjoin(DATA_DIR, 'b')))
+
+        self.assertIsNot(sdb_a, get_server_db_instance_for_thread(cpjoin(DATA_DIR, 'a'), True))
+        self.assertEqual('wal', sdb_b.con.execute('pragma journal_mode').fetchone()['journal_mode'])
+
+############################################################################################
+    def test_transaction(self):
+        sdb = get_server_db_instance_for_thread(DATA_DIR, True)
+        sdb.db_init()
+
+        # Nested blocks commit with the outer block
+        with sdb.transaction():
+            with sdb.transaction():
+                sdb.stage_blob('a')
+            self.assertTrue(sdb.con.in_transaction)
+            sdb.stage_blob('b')
+        self.assertFalse(sdb.con.in_transaction)
+
+        # Writes are rolled back on error
+        with self.assertRaises(ValueError):
+            with sdb.transaction():
+                sdb.stage_blob('c')
+                raise ValueError()
+
+        self.assertEqual(['a', 'b'], sorted(sdb.get_staged_blobs_before(time.time() + 1)))
+
+        # The gc log must be committed before objects are written, so cannot be deferred
+        with sdb.transaction():
+            self.assertRaises(Exception, sdb.gc_log_item, 'file', 'd')
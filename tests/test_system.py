@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 #from helpers import *
-import os, json, struct, hashlib, time, shutil
+import os, json, struct, hashlib, time, shutil, threading
 from unittest import TestCase
 from io import BytesIO
 from tests.helpers import DATA_DIR, delete_data_dir
 
-from bversion.common import file_get_contents, file_put_contents, make_dirs_if_dont_exist
+from bversion.common import file_get_contents, file_put_contents, make_dirs_if_dont_exist, cpjoin, path_filter
 from bversion import client
 from bversion import server
+from bversion import watcher
+from bversion.storage.client_db import client_db
 from bversion.server import Request, ConnectionContext
+from bversion.storage.server_db import get_server_db_instance_for_thread
+from bversion.http.http_server import ServeFrames
+from bversion.http.http_common import read_frames, encode_frames, framed_length, read_body, buffered_reader
 
 private_key = "bkUg07WLoxKcsWaupuVIyyMrVyWMdX8q8Zvta+wwKi6kmF7pCyklcIoNAOkfo1YR7O/Fb/Z0bJJ1j/lATtkKQ6c="
 public_key  = "mF7pCyklcIoNAOkfo1YR7O/Fb/Z0bJJ1j/lATtkKQ6c="
@@ -29,6 +34,9 @@ def setup():
     make_client_dirs('client2')
     make_dirs_if_dont_exist(DATA_DIR + 'server')
 
+    # the server db connection is cached per thread, and may refer to a database deleted by an earlier test
+    get_server_db_instance_for_thread(DATA_DIR + 'server', need_to_recreate = True)
+
 ############################################################################################
 def setup_client(name):
 
@@ -54,24 +62,8 @@ def setup_client(name):
 
 
     # Mock data reader that reads from a bytesio object instead of a socket
-    class mock_reader:
-        def __init__(self, reader_data):
-            self.reader = BytesIO(reader_data)
-
-        def read(self, length = None):
-            if length is None:
-                r = self.reader.read()
-
-            else:
-                r = self.reader.read(length)
-
-            if r == b'': return None
-            else: return r
-
-        def read_all(self):
-            r = self.read()
-            if r == b'': return None
-            else: return r
+    def mock_reader(reader_data):
+        return read_body(buffered_reader(BytesIO(reader_data).readinto), len(reader_data))
 
 
     # Override the server connection with a mock implementation that passes
@@ -80,6 +72,13 @@ def setup_client(name):
         def __init__(self):
             self.context = ConnectionContext()
 
+        def clone(self):
+            return mock_connection()
+
+        # Responces are read from memory, so there is nothing to abandon
+        def abort(self): pass
+        def close(self): pass
+
         def request_helper(self, url, headers, reader):
             headers_new = {}
             for k,v in headers.items():
@@ -102,15 +101,49 @@ def setup_client(name):
             res = self.request_helper(url, headers, reader)
 
             if gen:
-                def writer(path):
+                def writer(path, hasher = None):
                     with open(res.body.path, 'rb') as sf:
-                        with open(path, 'wb') as df:
-                            df.write(sf.read())
+                        data = sf.read()
+                    if hasher is not None: hasher.update(data)
+                    with open(path, 'wb') as df:
+                        df.write(data)
                 return writer, dict(res.headers)
 
             else:
                 return res.body, dict(res.headers)
 
+        def request_frames(self, url, headers, data = None):
+            res = self.request_helper(url, headers, mock_reader(json.dumps(data).encode('utf8')))
+            if not isinstance(res.body, ServeFrames): return iter([]), dict(res.headers)
+
+            body = b''
+            for header, path in res.body.headers_and_paths():
+                body += header
+                if path is not None: body += file_get_contents(path)
+
+            return read_frames(mock_reader(body)), dict(res.headers)
+
+        def send_frames(self, url, headers, frames, on_frame_sent = None):
+            # Read the body lazily, so that the client can be killed part way through sending it
+            chunks = encode_frames(frames, on_frame_sent)
+
+            class generator_reader:
+                def __init__(self):
+                    self.buffer = b''
+
+                def recv_into(self, view):
+                    if self.buffer == b'': self.buffer = next(chunks, b'')
+                    length = min(len(view), len(self.buffer))
+                    view[:length], self.buffer = self.buffer[:length], self.buffer[length:]
+                    return length
+
+            reader = read_body(buffered_reader(generator_reader().recv_into), framed_length(frames))
+            res = self.request_helper(url, headers, reader)
+
+            # The server stops at the end of the body, a real client sends all of it
+            for _ in chunks: pass
+            return res.body, dict(res.headers)
+
         def send_file(self, url, headers, file_path):
             reader = mock_reader(file_get_contents(file_path))
             res = self.request_helper(url, headers, reader)
@@ -119,6 +152,7 @@ def setup_client(name):
 
 
     client.server_connection = mock_connection()
+    client.connection_pool   = []
     client.init()
 
 
@@ -603,3 +637,268 @@ class TestSystem(TestCase):
 
         #==================================================
         delete_data_dir()
+
+    ############################################################################################
+    def test_lock_queue(self):
+        delete_data_dir()
+        make_dirs_if_dont_exist(DATA_DIR + 'server')
+        data_store = server.versioned_storage(DATA_DIR + 'server')
+
+        have_lock, first_ticket, _ = server.acquire_lock_in_turn(data_store, 'lock_test', None, wait = False)
+        self.assertTrue(have_lock)
+
+        # Clients which wait keep their place in the queue, in arrival order
+        have_lock, ticket_1, position_1 = server.acquire_lock_in_turn(data_store, 'lock_test', None, wait = True)
+        have_lock, ticket_2, position_2 = server.acquire_lock_in_turn(data_store, 'lock_test', None, wait = True)
+        self.assertFalse(have_lock)
+        self.assertEqual((position_1, position_2), (1, 2))
+
+        # A client which does not wait is refused without joining the queue
+        have_lock, _, position = server.acquire_lock_in_turn(data_store, 'lock_test', None, wait = False)
+        self.assertEqual((have_lock, position), (False, 3))
+
+        # Once the lock is released it goes to the head of the queue, not whoever asks first
+        data_store.unlock()
+        have_lock, _, _ = server.acquire_lock_in_turn(data_store, 'lock_test', ticket_2, wait = True)
+        self.assertFalse(have_lock)
+        have_lock, _, _ = server.acquire_lock_in_turn(data_store, 'lock_test', ticket_1, wait = True)
+        self.assertTrue(have_lock)
+
+        data_store.unlock()
+        del server.lock_queues['lock_test']
+        delete_data_dir()
+
+    ############################################################################################
+    def test_disjoint_commits(self):
+        delete_data_dir()
+        setup()
+
+        make_dirs_if_dont_exist(DATA_DIR + 'client1/a')
+        file_put_contents(DATA_DIR + 'client1/a/one', b'one')
+        setup_client('client1')
+        session_token = client.authenticate()
+        client.commit(session_token, 'initial commit')
+
+        setup_client('client2')
+        client.update(session_token)
+        make_dirs_if_dont_exist(DATA_DIR + 'client2/b')
+        file_put_contents(DATA_DIR + 'client2/b/two', b'two')
+
+        setup_client('client1')
+        file_put_contents(DATA_DIR + 'client1/a/one', b'one changed')
+        first_head = client.commit(session_token, 'change in a')
+
+        # client2 does not have the latest revision, but it's changes do not overlap
+        setup_client('client2')
+        second_head = client.commit(session_token, 'change in b')
+        self.assertNotEqual(first_head, second_head)
+
+        req_result = client.get_files_in_version(session_token, False, second_head)[0]
+        self.assertEqual({'/a/one', '/b/two'}, set(json.loads(req_result)['files'].keys()))
+
+        # Changing the same paths again does not overlap client2's own rebased commit
+        file_put_contents(DATA_DIR + 'client2/b/two', b'two changed')
+        third_head = client.commit(session_token, 'change in b again')
+        self.assertNotEqual(second_head, third_head)
+
+        # The working copy of client2 still needs to update to get the rebased over changes
+        client.update(session_token)
+        self.assertEqual(b'one changed', file_get_contents(DATA_DIR + 'client2/a/one'))
+
+        # Overlapping changes are rejected
+        setup_client('client1')
+        make_dirs_if_dont_exist(DATA_DIR + 'client1/b')
+        file_put_contents(DATA_DIR + 'client1/b/two', b'conflicting')
+        try:
+            client.commit(session_token, 'overlaps change in b')
+            self.fail()
+        except SystemExit as e:
+            self.assertEqual(server.need_to_update_msg, str(e))
+
+        delete_data_dir()
+
+    ############################################################################################
+    def test_watched_working_copy(self):
+        delete_data_dir()
+        setup()
+
+        file_put_contents(DATA_DIR + 'client1/test1', b'test 1')
+        file_put_contents(DATA_DIR + 'client1/test2', b'test 2')
+        setup_client('client1')
+        session_token = client.authenticate()
+        client.commit(session_token, 'initial commit')
+
+        # Run the watcher on a thread, it's database connection must be created there
+        base_path = client.config['data_dir']
+        watchers = []
+        def run_watcher():
+            watch_db = client_db(cpjoin(base_path, '.bvn', 'manifest.db'))
+            watchers.append(watcher.working_copy_watcher(base_path, watch_db, lambda: path_filter(client.config['ignore_filters'])))
+            watchers[0].run()
+
+        thread = threading.Thread(target = run_watcher)
+        thread.start()
+
+        try:
+            while not client.watcher_is_running(): time.sleep(0.01)
+
+            # The first scan is always a full scan, after which the journal is used
+            file_put_contents(DATA_DIR + 'client1/test1', b'changed before the first scan')
+            self.assertEqual({'/test1'}, set(client.find_local_changes().keys()))
+            self.assertTrue(client.cdb.get_watch_state()['journal_valid'])
+
+            full_scan = client.scan_file_list
+            client.scan_file_list = None
+            try:
+                file_put_contents(DATA_DIR + 'client1/test3', b'new file')
+                os.remove(DATA_DIR + 'client1/test2')
+                changes = client.find_local_changes()
+            finally:
+                client.scan_file_list = full_scan
+
+            self.assertEqual({'/test1' : 'changed', '/test2' : 'deleted', '/test3' : 'new'},
+                             {path : fle['status'] for path, fle in changes.items()})
+
+            # Once committed, the paths no longer need checking
+            client.commit(session_token, 'commit watched changes')
+            self.assertEqual({}, client.find_local_changes())
+            self.assertEqual([], client.cdb.get_dirty_paths())
+
+            # New directories are watched, and their contents found
+            make_dirs_if_dont_exist(DATA_DIR + 'client1/dir/sub')
+            file_put_contents(DATA_DIR + 'client1/dir/sub/test4', b'in a new directory')
+            self.assertEqual({'/dir/sub/test4'}, set(client.find_local_changes().keys()))
+
+        finally:
+            watchers[0].stop()
+            thread.join()
+
+        self.assertFalse(client.watcher_is_running())
+        delete_data_dir()
+
+    ############################################################################################
+    def test_verified_download(self):
+        delete_data_dir()
+        setup()
+
+        file_put_contents(DATA_DIR + 'client1/test1', b'test 1')
+        setup_client('client1')
+        session_token = client.authenticate()
+        client.commit(session_token, 'initial commit')
+
+        # The pulled file is recorded with its size and inode, so it's hash can be reused
+        setup_client('client2')
+        client.update(session_token)
+        manifest_item = client.cdb.get_single_file_from_manifest('/test1')
+        stat = os.stat(DATA_DIR + 'client2/test1')
+        self.assertEqual((6, stat.st_ino), (manifest_item['size'], manifest_item['inode']))
+
+        hash_file = client.hash_file
+        client.hash_file = None
+        try:
+            self.assertEqual(manifest_item['server_file_hash'], client.hash_working_copy_file('/test1'))
+        finally:
+            client.hash_file = hash_file
+
+        file_put_contents(DATA_DIR + 'client2/test1', b'changed')
+        self.assertEqual(hashlib.sha256(b'changed').hexdigest(), client.hash_working_copy_file('/test1'))
+
+        # A download which does not match it's hash is removed
+        def write_to_file(path, hasher):
+            file_put_contents(path, b'corrupt'); hasher.update(b'corrupt')
+
+        tmp_path = DATA_DIR + 'client2/.bvn/download_tmp'
+        writer = client.verified_writer(write_to_file, manifest_item['server_file_hash'])
+        self.assertRaises(client.download_hash_mismatch, writer, tmp_path)
+        self.assertFalse(os.path.exists(tmp_path))
+
+        delete_data_dir()
+
+    ############################################################################################
+    def test_session_cache(self):
+        delete_data_dir()
+        setup()
+        setup_client('client1')
+        session_token = client.authenticate()
+
+        sdb = get_server_db_instance_for_thread(DATA_DIR + 'server')
+        expires = sdb.get_session_token(session_token, '0.0.0.0')[0]['expires']
+
+        # Authenticating requests extends the session in memory only
+        time.sleep(0.01)
+        self.assertNotEqual(False, server.have_authenticated_user('0.0.0.0', repo_name, session_token))
+        self.assertFalse(server.have_authenticated_user('1.1.1.1', repo_name, session_token))
+        self.assertEqual(expires, sdb.get_session_token(session_token, '0.0.0.0')[0]['expires'])
+
+        server.flush_session_caches()
+        self.assertLess(expires, sdb.get_session_token(session_token, '0.0.0.0')[0]['expires'])
+
+        # Expired sessions are removed from both the cache and the database
+        cache = server.get_session_cache(repo_name)
+        cache.sessions[session_token]['expires'] = 0
+        sdb.write_sessions([cache.sessions[session_token]]); sdb.con.commit()
+
+        server.flush_session_caches()
+        self.assertFalse(server.have_authenticated_user('0.0.0.0', repo_name, session_token))
+        self.assertNotIn(session_token, cache.sessions)
+        self.assertEqual([], sdb.get_session_token(session_token, '0.0.0.0'))
+
+        delete_data_dir()
+
+    ############################################################################################
+    def test_parallel_pull(self):
+        class fake_frame:
+            def __init__(self, data):
+                self.data = data
+                self.remaining = len(data)
+
+            def write_to_file(self, path, hasher = None):
+                if hasher is not None: hasher.update(self.data)
+                file_put_contents(path, self.data)
+                self.remaining = 0
+
+        class fake_connection:
+            def __init__(self):
+                self.requests = []
+
+            def clone(self): return fake_connection()
+            def abort(self): pass
+            def close(self): pass
+
+            def request_frames(self, url, headers, data = None):
+                self.requests.append(data['files'])
+                return ((({'status' : 'ok', 'file_info' : {'hash' : hashlib.sha256(path.encode('utf8')).hexdigest()}},
+                          fake_frame(path.encode('utf8'))) for path in data['files']), {'status' : 'ok'})
+
+        delete_data_dir()
+        make_dirs_if_dont_exist(DATA_DIR + '.bvn')
+        client.config = {'repository' : repo_name, 'data_dir' : DATA_DIR, 'parallel_connections' : 4}
+        client.server_connection = fake_connection()
+        client.connection_pool   = []
+
+        # A few files are still split between every connection, and are yielded in order
+        # while only one file can be read ahead at a time
+        read_ahead_bytes = client.pull_read_ahead_bytes
+        client.pull_read_ahead_bytes = 1
+        try:
+            paths = ['/file_' + str(i) for i in range(10)]
+            for path, (frame_info, writer) in zip(paths, client.pull_files('token', 'head', paths)):
+                writer(DATA_DIR + 'pulled')
+                self.assertEqual(path.encode('utf8'), file_get_contents(DATA_DIR + 'pulled'))
+        finally:
+            client.pull_read_ahead_bytes = read_ahead_bytes
+
+        connections = [client.server_connection] + client.connection_pool
+        self.assertEqual(4, len(connections))
+        self.assertEqual([1, 3, 3, 3], sorted(len(r) for c in connections for r in c.requests))
+
+        # Stopping part way through removes the temporary files
+        pulled = client.pull_files('token', 'head', paths)
+        next(pulled)
+        pulled.close()
+        self.assertEqual(['.bvn', 'pulled'], sorted(os.listdir(DATA_DIR)))
+        self.assertEqual([], os.listdir(DATA_DIR + '.bvn'))
+
+        client.server_connection = None
+        client.connection_pool   = []
+        delete_data_dir()
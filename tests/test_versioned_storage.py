@@ -2,9 +2,11 @@ import os
 from unittest import TestCase
 
 from tests.helpers import DATA_DIR, make_data_dir, delete_data_dir
-from bversion.common import cpjoin, file_put_contents
+from bversion.common import cpjoin, file_put_contents, hash_file
+import bversion.common as sfs
 from bversion.storage.versioned_storage import versioned_storage
 from bversion.storage.server_db import get_server_db_instance_for_thread
+from bversion.storage.object_cache import lru_object_cache, index_object_cache
 
 CONF_DIR   = 'bvn'
 BACKUP_DIR = 'back'
@@ -75,3 +77,238 @@ class TestVersionedStorage(TestCase):
 
         self.assertEqual(os.listdir(cpjoin(DATA_DIR, 'files')), ['9f'])
         self.assertEqual(os.listdir(cpjoin(DATA_DIR, 'files', '9f')), ['86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'])
+
+############################################################################################
+    def test_pack_objects(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+        file_put_contents(cpjoin(DATA_DIR, 'test 2'), b'test 1')
+
+        #==================
+        data_store = versioned_storage(DATA_DIR)
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 1'), {'path' : '/test/path'})
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 2'), {'path' : '/another/path'})
+        head = data_store.commit('test msg', 'test user')
+
+        files_before = data_store.get_commit_files(head)
+
+        status, packs = data_store.pack_objects()
+        self.assertTrue(status)
+        self.assertEqual(len(packs), 1)
+
+        # All loose objects should have been moved into the pack
+        self.assertEqual(os.listdir(cpjoin(DATA_DIR, 'index')), ['pack'])
+
+        data_store = versioned_storage(DATA_DIR)
+        self.assertEqual(data_store.get_commit_files(head), files_before)
+        self.assertEqual(data_store.get_file_info_from_path('/test/path')['hash'],
+                         '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
+
+        self.assertEqual(data_store.verify_fs(), (True, []))
+
+############################################################################################
+    def test_index_object_cache(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+
+        data_store = versioned_storage(DATA_DIR)
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 1'), {'path' : '/test/path'})
+        data_store.commit('test msg', 'test user')
+
+        index_object_cache.clear()
+
+        # Modifying returned file info must not alter the cached tree
+        info = data_store.get_file_info_from_path('/test/path')
+        info['hash'] = 'modified'
+        self.assertEqual(index_object_cache.stats()['misses'], 3)
+
+        info = versioned_storage(DATA_DIR).get_file_info_from_path('/test/path')
+        self.assertEqual(info['hash'], '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
+        self.assertEqual(index_object_cache.stats()['hits'], 3)
+
+############################################################################################
+    def test_lru_object_cache_limits(self):
+        cache = lru_object_cache(max_entries = 2, max_bytes = 10)
+
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.get('a')
+        cache.put('c', 3, 4) # exceeds byte limit, evicts least recently used
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+############################################################################################
+    def test_commit_manifest_cache(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+        file_put_contents(cpjoin(DATA_DIR, 'test 2'), b'test 1')
+
+        data_store = versioned_storage(DATA_DIR)
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 1'), {'path' : '/test/path'})
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 2'), {'path' : '/another/path'})
+        head = data_store.commit('test msg', 'test user')
+
+        sdb = get_server_db_instance_for_thread(DATA_DIR)
+        self.assertEqual(sdb.get_commit_manifest(head), None)
+
+        # The manifest is built on first use and then read back from the DB
+        files = data_store.get_commit_files(head)
+        self.assertEqual(sdb.get_commit_manifest(head), files)
+        self.assertEqual(data_store.get_commit_files(head), files)
+        self.assertEqual(set(files.keys()), {'/test/path', '/another/path'})
+        self.assertEqual(files['/test/path'], {'hash'   : '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08',
+                                               'path'   : '/test/path',
+                                               'status' : 'new'})
+
+############################################################################################
+    def test_commit_graph(self):
+        commits = []
+        for i in range(4):
+            file_put_contents(cpjoin(DATA_DIR, 'test'), b'test ' + str(i).encode('utf8'))
+
+            data_store = versioned_storage(DATA_DIR)
+            data_store.begin('foo', '0.0.0.0', 'foo')
+            data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test'), {'path' : '/file ' + str(i % 2)})
+            commits.append(data_store.commit('msg ' + str(i), 'test user'))
+
+        # Results from the commit graph must match walking the commit chain
+        for version_id in ['root'] + commits:
+            self.assertEqual(data_store.get_changes_since(version_id, commits[-1]),
+                             data_store.walk_changes_since(version_id, commits[-1]))
+
+        self.assertEqual(set(data_store.get_changes_since(commits[1], commits[-1]).keys()), {'/file 0', '/file 1'})
+        self.assertEqual(data_store.get_changes_since(commits[2], commits[-1])['/file 1']['status'], 'changed')
+
+        # A commit indexed by two requests at once is only logged once
+        sdb = get_server_db_instance_for_thread(DATA_DIR)
+        head_entry = sdb.get_commit_graph_entry(commits[-1])
+        sdb.add_commits_to_graph([(commits[-1], data_store.read_commit_index_object(commits[-1]))],
+                                 head_entry['generation'] - 1)
+        self.assertEqual(len(sdb.get_changes_between_generations(0, head_entry['generation'])), 4)
+
+        chain = data_store.get_commit_chain()
+        self.assertEqual([c['id'] for c in chain], list(reversed(commits)))
+        self.assertEqual([c['commit_message'] for c in data_store.get_commit_chain(2, offset = 1)], ['msg 2', 'msg 1'])
+
+############################################################################################
+    def test_commit_graph_diverged_history(self):
+        """ If head is moved back, for instance by restoring a backup, commits made after
+        it replace the indexed history it no longer follows """
+
+        data_store = versioned_storage(DATA_DIR)
+        commits = {}
+        for name in ['a', 'b']:
+            file_put_contents(cpjoin(DATA_DIR, 'test'), name.encode('utf8'))
+            data_store.begin('foo', '0.0.0.0', 'foo')
+            data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test'), {'path' : '/' + name})
+            commits[name] = data_store.commit('msg ' + name, 'test user')
+
+        self.assertEqual(len(data_store.get_commit_chain()), 2)
+
+        file_put_contents(cpjoin(DATA_DIR, 'head'), commits['a'].encode('utf8'))
+        data_store.head_lookup = None
+
+        file_put_contents(cpjoin(DATA_DIR, 'test'), b'c')
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test'), {'path' : '/c'})
+        commits['c'] = data_store.commit('msg c', 'test user')
+
+        self.assertEqual(set(data_store.get_changes_since('root', commits['c']).keys()), {'/a', '/c'})
+        self.assertEqual(data_store.get_changes_since('root', commits['c']),
+                         data_store.walk_changes_since('root', commits['c']))
+        self.assertTrue(data_store.is_ancestor(commits['a'], commits['c']))
+        self.assertFalse(data_store.is_ancestor(commits['b'], commits['c']))
+        self.assertEqual([c['id'] for c in data_store.get_commit_chain()], [commits['c'], commits['a']])
+
+        # Without a graph entry for head the commits are walked instead
+        sdb = get_server_db_instance_for_thread(DATA_DIR)
+        sdb.con.execute("delete from commit_graph"); sdb.con.commit()
+        data_store.index_commit_graph = lambda head: None
+
+        self.assertEqual(set(data_store.get_changes_since('root', commits['c']).keys()), {'/a', '/c'})
+        self.assertTrue(data_store.is_ancestor(commits['a'], commits['c']))
+        self.assertEqual([c['id'] for c in data_store.get_commit_chain(1, offset = 1)], [commits['a']])
+
+############################################################################################
+    def test_incremental_commit(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+        file_put_contents(cpjoin(DATA_DIR, 'test 2'), b'test 1')
+        file_put_contents(cpjoin(DATA_DIR, 'test 3'), b'test 2')
+
+        data_store = versioned_storage(DATA_DIR)
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 1'), {'path' : '/a/file'})
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 2'), {'path' : '/b/c/file'})
+        id1 = data_store.commit('test msg', 'test user')
+        tree_1 = data_store.read_tree_index_object(data_store.read_commit_index_object(id1)['tree_root'])
+
+        # Changing a file in one directory must not rewrite unrelated subtrees
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 3'), {'path' : '/a/file'})
+        id2 = data_store.commit('test msg', 'test user')
+        tree_2 = data_store.read_tree_index_object(data_store.read_commit_index_object(id2)['tree_root'])
+
+        self.assertEqual(tree_1['dirs']['b'], tree_2['dirs']['b'])
+        self.assertNotEqual(tree_1['dirs']['a'], tree_2['dirs']['a'])
+        self.assertEqual(data_store.get_file_info_from_path('/a/file')['status'], 'changed')
+
+        # Deleting the only file in a directory removes the directory
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        data_store.fs_delete([{'path' : '/b/c/file'}])
+        id3 = data_store.commit('test msg', 'test user')
+        tree_3 = data_store.read_tree_index_object(data_store.read_commit_index_object(id3)['tree_root'])
+
+        self.assertEqual(list(tree_3['dirs'].keys()), ['a'])
+        self.assertEqual(list(data_store.get_commit_files(id3).keys()), ['/a/file'])
+
+############################################################################################
+    def test_staged_files(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+        file_put_contents(cpjoin(DATA_DIR, 'test 2'), b'test 1')
+        hash_1 = hash_file(cpjoin(DATA_DIR, 'test 1'))
+        hash_2 = hash_file(cpjoin(DATA_DIR, 'test 2'))
+
+        # Files are staged without an active commit
+        data_store = versioned_storage(DATA_DIR)
+        data_store.stage_file(cpjoin(DATA_DIR, 'test 1'), hash_1)
+        data_store.stage_file(cpjoin(DATA_DIR, 'test 2'), hash_2)
+
+        # Staged files move to the file store when added to a commit
+        data_store.begin('foo', '0.0.0.0', 'foo')
+        self.assertEqual(data_store.store_staged_files([hash_1, '0' * 64]), {hash_1})
+
+        # The gc log is committed before the files are moved into the store
+        sdb = get_server_db_instance_for_thread(DATA_DIR)
+        self.assertEqual([item['item_hash'] for item in sdb.get_gc_log()], [hash_1])
+        data_store.add_stored_files_to_commit([{'path' : '/test/path', 'hash' : hash_1}])
+        id1 = data_store.commit('test msg', 'test user')
+
+        self.assertEqual(data_store.get_commit_files(id1)['/test/path']['hash'], hash_1)
+        self.assertFalse(os.path.isfile(data_store.get_staged_file_path(hash_1)))
+
+        # Abandoned staged files are garbage collected
+        self.assertEqual(data_store.gc_staged_files(60), 0)
+        self.assertEqual(data_store.gc_staged_files(-1), 1)
+        self.assertFalse(os.path.isfile(data_store.get_staged_file_path(hash_2)))
+
+############################################################################################
+    def test_put_with_precomputed_hash(self):
+        file_put_contents(cpjoin(DATA_DIR, 'test 1'), b'test')
+        file_hash = hash_file(cpjoin(DATA_DIR, 'test 1'))
+
+        # A file hashed as it was received is not read again
+        data_store = versioned_storage(DATA_DIR)
+        data_store.begin('foo', '0.0.0.0', 'foo')
+
+        stored_hash_file = sfs.hash_file
+        sfs.hash_file = None
+        try:
+            file_info = data_store.fs_put_from_file(cpjoin(DATA_DIR, 'test 1'), {'path' : '/test/path'}, file_hash)
+        finally:
+            sfs.hash_file = stored_hash_file
+
+        self.assertEqual(file_hash, file_info['hash'])
+        self.assertTrue(os.path.isfile(cpjoin(data_store.get_file_directory_path(file_hash), file_hash[2:])))